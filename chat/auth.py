@@ -0,0 +1,168 @@
+"""
+Websocket authentication with a per-process cache of session -> user.
+
+channels' AuthMiddlewareStack reads the session row and then the user row
+on every handshake, so a reconnect storm after a deploy turns into two
+queries per socket. CachedAuthMiddlewareStack resolves each session key
+once and then serves the user from memory for CHAT_AUTH_CACHE_TTL
+seconds. It keeps at most CHAT_AUTH_CACHE_SIZE sessions, evicting the
+least recently used first; a size of 0 turns the cache off.
+
+On a miss the user is checked exactly as channels does it: the backend
+must be configured, the session hash must match and the account must be
+active. Only the columns the chat and that check need are loaded.
+
+A user's cached sessions are dropped when they log out and whenever their
+row is saved, which covers password changes and deactivation. That only
+reaches the process doing the save; other workers notice within the TTL.
+Hits and misses are counted in `metrics`.
+
+The receivers run in request threads while the event loop reads the map,
+so `lock` guards it.
+"""
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from channels.auth import AuthMiddleware
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth import (
+    BACKEND_SESSION_KEY,
+    HASH_SESSION_KEY,
+    SESSION_KEY,
+    get_user_model,
+    load_backend,
+    user_logged_out,
+)
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import AnonymousUser
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.crypto import constant_time_compare
+
+from .dbexecutor import db_call
+
+metrics = Counter()
+lock = threading.Lock()
+
+# Everything the consumers use, plus what verifying the session needs
+USER_FIELDS = ("id", "username", "password", "is_active")
+
+
+def setting(name, default):
+    return getattr(settings, f"CHAT_AUTH_CACHE_{name}", default)
+
+
+class SessionUsers:
+    """Bounded, expiring map of session key -> (user, expiry)."""
+
+    def __init__(self):
+        self.sessions = OrderedDict()
+
+    def get(self, session_key):
+        with lock:
+            cached = self.sessions.get(session_key)
+            if cached is None:
+                return None
+            user, expires = cached
+            if expires < time.monotonic():
+                del self.sessions[session_key]
+                return None
+            self.sessions.move_to_end(session_key)
+            return user
+
+    def put(self, session_key, user):
+        with lock:
+            expires = time.monotonic() + setting("TTL", 60)
+            self.sessions[session_key] = (user, expires)
+            self.sessions.move_to_end(session_key)
+            while len(self.sessions) > setting("SIZE", 10_000):
+                self.sessions.popitem(last=False)
+
+    def discard_user(self, user_id):
+        with lock:
+            stale = [
+                key for key, (user, _) in self.sessions.items() if user.id == user_id
+            ]
+            for session_key in stale:
+                del self.sessions[session_key]
+
+    def clear(self):
+        with lock:
+            self.sessions.clear()
+
+
+session_users = SessionUsers()
+
+
+def load_user(session):
+    """The session's user, like channels.auth.get_user but loading only USER_FIELDS."""
+    try:
+        user_id = get_user_model()._meta.pk.to_python(session[SESSION_KEY])
+        backend_path = session[BACKEND_SESSION_KEY]
+    except KeyError:
+        return AnonymousUser()
+    if backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return AnonymousUser()
+
+    backend = load_backend(backend_path)
+    if isinstance(backend, ModelBackend):
+        users = get_user_model()._default_manager.only(*USER_FIELDS)
+        user = users.filter(pk=user_id).first()
+        if user is not None and not backend.user_can_authenticate(user):
+            user = None
+    else:
+        user = backend.get_user(user_id)
+    if user is None:
+        return AnonymousUser()
+
+    session_hash = session.get(HASH_SESSION_KEY)
+    verified = session_hash and constant_time_compare(
+        session_hash, user.get_session_auth_hash()
+    )
+    if not verified:
+        session.flush()
+        return AnonymousUser()
+    return user
+
+
+async def resolve_user(scope):
+    """scope["session"]'s user, from the cache when it was resolved recently."""
+    session = scope["session"]
+    session_key = session.session_key
+    if session_key is None:
+        return AnonymousUser()  # no cookie, nothing to look up
+    if setting("SIZE", 10_000) <= 0:
+        return await db_call(load_user)(session)
+
+    user = session_users.get(session_key)
+    if user is not None:
+        metrics["hits"] += 1
+        return user
+    metrics["misses"] += 1
+    user = await db_call(load_user)(session)
+    if user.is_authenticated:
+        session_users.put(session_key, user)
+    return user
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    async def resolve_scope(self, scope):
+        scope["user"]._wrapped = await resolve_user(scope)
+
+
+def CachedAuthMiddlewareStack(inner):
+    """Drop-in replacement for channels.auth.AuthMiddlewareStack."""
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
+
+
+@receiver(user_logged_out)
+def forget_logged_out_user(sender, user=None, **kwargs):  # noqa: ARG001
+    if user is not None:
+        session_users.discard_user(user.id)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def forget_saved_user(sender, instance, **kwargs):  # noqa: ARG001
+    session_users.discard_user(instance.id)
@@ -0,0 +1,118 @@
+"""
+Bounded outbound queues between the chat consumers and their sockets.
+
+Event handlers never write to the socket themselves: they append frames
+to the connection's OutboundQueue and return, and a writer task per
+connection drains the queue at whatever pace the client reads. A slow
+client therefore can't stall its consumer or let undelivered events pile
+up in the channel layer; its backlog is capped at
+CHAT_OUTBOUND_QUEUE_LIMIT frames and, once full, handled according to
+CHAT_OUTBOUND_QUEUE_POLICY:
+
+* "drop_oldest" - discard the oldest queued frame for each new one.
+* "coalesce"    - collapse every queued chat message into one
+                  {"type": "resync", "rooms": [...]} frame telling the
+                  client to reload those rooms' history.
+* "disconnect"  - close the socket with code 4008; the client reconnects
+                  and catches up from history.
+
+Queue depths and overflow outcomes are counted in `metrics`.
+"""
+import asyncio
+from collections import Counter, deque
+
+from django.conf import settings
+
+metrics = Counter()
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+
+# Close code sent to clients disconnected for falling behind
+SLOW_CONSUMER = 4008
+
+
+def setting(name, default):
+    return getattr(settings, f"CHAT_OUTBOUND_QUEUE_{name}", default)
+
+
+class QueueItem:
+    __slots__ = ("frame", "room", "rooms")
+
+    def __init__(self, frame, room=None, rooms=None):
+        self.frame = frame  # send() kwargs
+        self.room = room  # set on chat messages, which "coalesce" may fold away
+        self.rooms = rooms  # set on the resync frame that replaced them
+
+
+class OutboundQueue:
+    def __init__(self, send, close, encode):
+        self.send = send
+        self.close = close
+        self.encode = encode
+        self.limit = setting("LIMIT", 100)
+        self.policy = setting("POLICY", COALESCE)
+        self.items = deque()
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.writer = asyncio.get_running_loop().create_task(self.drain())
+
+    @property
+    def depth(self):
+        return len(self.items)
+
+    async def put(self, frame, room=None):
+        """Queue send() kwargs for the writer; `room` marks a chat message."""
+        if self.closed:
+            return
+        if len(self.items) >= self.limit and not await self.overflow():
+            return
+        self.items.append(QueueItem(frame, room))
+        metrics["enqueued"] += 1
+        metrics["peak_depth"] = max(metrics["peak_depth"], len(self.items))
+        self.wakeup.set()
+
+    async def overflow(self):
+        """Make room according to the policy; False if the new frame must be dropped."""
+        if self.policy == DISCONNECT:
+            metrics["disconnected"] += 1
+            await self.shutdown()
+            await self.close(code=SLOW_CONSUMER)
+            return False
+        if self.policy == COALESCE:
+            self.coalesce()
+        if len(self.items) >= self.limit:
+            self.items.popleft()
+            metrics["dropped"] += 1
+        return True
+
+    def coalesce(self):
+        rooms = set()
+        kept = deque()
+        for item in self.items:
+            if item.room is not None:
+                rooms.add(item.room)
+            elif item.rooms is not None:
+                rooms |= item.rooms
+            else:
+                kept.append(item)
+        if rooms:
+            metrics["coalesced"] += len(self.items) - len(kept)
+            resync = self.encode({"type": "resync", "rooms": sorted(rooms)})
+            kept.append(QueueItem(resync, rooms=rooms))
+            self.items = kept
+
+    async def drain(self):
+        while True:
+            while not self.items:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            item = self.items.popleft()
+            await self.send(**item.frame)
+
+    async def shutdown(self):
+        """Stop writing and forget anything still queued."""
+        self.closed = True
+        self.items.clear()
+        self.writer.cancel()
@@ -0,0 +1,1251 @@
+"""
+Benchmark scenarios for the chat app, run with `manage.py bench_chat <name>`.
+
+Scenarios expect a database seeded with `manage.py seed_chat` unless they
+say otherwise, and write a plain-text report to the given stream.
+"""
+import asyncio
+import copy
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import statistics
+import time
+import tracemalloc
+from contextlib import contextmanager
+from importlib import import_module
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, migrations
+from django.db.models import Count, Q
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.module_loading import import_string
+
+from django_project.channel_layers import channel_layers_from_env
+
+from . import (
+    auth,
+    backpressure,
+    dbexecutor,
+    directory,
+    groups,
+    history,
+    historycache,
+    loadtest,
+    persistence,
+    ratelimit,
+    seed,
+)
+from .consumers import GroupChatConsumer, PrivateChatConsumer
+from .models import ChatRoom, Conversation, Message
+from .rooms import PrivateRoom
+
+SCENARIOS = {}
+
+
+def scenario(func):
+    SCENARIOS[func.__name__] = func
+    return func
+
+
+def summarize(samples):
+    """Milliseconds p50/p99/mean for a list of durations in seconds."""
+    ordered = sorted(samples)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    return {
+        "p50": statistics.median(ordered) * 1000,
+        "p99": p99 * 1000,
+        "mean": statistics.fmean(ordered) * 1000,
+    }
+
+
+def measure(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def format_stats(stats):
+    return "  ".join(f"{key}={value:.3f}ms" for key, value in stats.items())
+
+
+def hot_room():
+    """The room with the most messages; seed_chat makes one deliberately long."""
+    return (
+        ChatRoom.objects.annotate(n=Count("message"))
+        .order_by("-n")
+        .first()
+    )
+
+
+async def private_socket(user, other_username):
+    """An in-process websocket to PrivateChatConsumer, history frame consumed."""
+    communicator = WebsocketCommunicator(
+        PrivateChatConsumer.as_asgi(), f"/ws/private/{other_username}/"
+    )
+    communicator.scope["user"] = user
+    communicator.scope["url_route"] = {"kwargs": {"username": other_username}}
+    connected, _ = await communicator.connect()
+    if not connected:
+        raise RuntimeError(f"could not connect {user.username} -> {other_username}")
+    await communicator.receive_from()
+    return communicator
+
+
+def slow_reader(application, delay):
+    """
+    Wrap an ASGI app so each websocket frame it sends takes `delay` seconds
+    to go out, like a slow client.
+    """
+    async def app(scope, receive, send):
+        async def slow_send(message):
+            if message["type"] == "websocket.send":
+                await asyncio.sleep(delay)
+            await send(message)
+        return await application(scope, receive, slow_send)
+    return app
+
+
+def unlimited():
+    """Turn rate limiting off for scenarios that push traffic as fast as they can."""
+    return override_settings(CHAT_RATE_LIMIT_RATE=0, CHAT_RATE_LIMIT_USER_RATE=0)
+
+
+@contextmanager
+def without_chat_indexes():
+    """Temporarily drop the indexes added in chat.0003 to measure the baseline."""
+    migration = import_module(
+        "chat.migrations.0003_chatroom_unique_name_message_indexes"
+    )
+    added = migration.Migration.operations
+    indexes = [op.index for op in added if isinstance(op, migrations.AddIndex)]
+    name = ChatRoom._meta.get_field("name")
+    plain_name = copy.copy(name)
+    plain_name._unique = False
+    with connection.schema_editor() as editor:
+        for index in indexes:
+            editor.remove_index(Message, index)
+        editor.alter_field(ChatRoom, name, plain_name)
+    try:
+        yield
+    finally:
+        with connection.schema_editor() as editor:
+            editor.alter_field(ChatRoom, plain_name, name)
+            for index in indexes:
+                editor.add_index(Message, index)
+
+
+@scenario
+def indexes(out, options):
+    """Query plans and timings for the chat hot paths, with and without indexes."""
+    room = hot_room()
+    if room is None:
+        out.write("No rooms found; run `manage.py seed_chat` first.\n")
+        return
+    messages = Message.objects.filter(conversation=room)
+    user = messages.values_list("sender", flat=True).first()
+    count = Message.objects.filter(conversation=room).count()
+    out.write(f"room={room.name} messages={count}\n")
+
+    queries = {
+        "room lookup": lambda: ChatRoom.objects.filter(name=room.name),
+        "history page": lambda: messages.order_by("-time_stamp", "-id")[:51],
+        "recent chats": lambda: Message.objects.filter(
+            Q(sender=user) | Q(recipient=user)
+        ).order_by("-time_stamp")[:50],
+        "unread count": lambda: Message.objects.filter(
+            recipient=user, is_read=False
+        ).values("id"),
+    }
+
+    def run(label):
+        out.write(f"\n== {label}\n")
+        for name, build in queries.items():
+            out.write(f"-- {name}\n{build().explain()}\n")
+            stats = measure(lambda build=build: list(build()), options["repeat"])
+            out.write(f"   {format_stats(stats)}\n")
+        stats = measure(lambda: history.fetch_page(room), options["repeat"])
+        out.write(f"-- fetch_page\n   {format_stats(stats)}\n")
+
+    if options["compare"]:
+        with without_chat_indexes():
+            run("without indexes")
+    run("with indexes")
+
+
+@scenario
+def durability(out, options):
+    """Messages/sec through the consumer with sync writes vs. the write-behind queue."""
+    sender, peer = seed.seed_users(2, prefix="bench")
+    count = options["messages"]
+
+    async def pump():
+        communicator = await private_socket(sender, peer.username)
+        started = time.perf_counter()
+        for i in range(count):
+            await communicator.send_json_to({"message": f"bench {i}"})
+        for _ in range(count):
+            await communicator.receive_from(timeout=30)
+        broadcast = time.perf_counter() - started
+        await communicator.disconnect()
+        return broadcast, time.perf_counter() - started
+
+    for mode in (persistence.SYNC, persistence.BATCHED):
+        with override_settings(CHAT_MESSAGE_DURABILITY=mode), unlimited():
+            before = Message.objects.count()
+            broadcast, total = async_to_sync(pump)()
+            saved = Message.objects.count() - before
+        out.write(
+            f"{mode:>8}: {count / broadcast:9.0f} msg/s broadcast  "
+            f"{count / total:9.0f} msg/s incl. final flush  saved={saved}/{count}\n"
+        )
+
+
+@scenario
+def reconnect(out, options):
+    """
+    Server cost of a reconnect on the hot room: a fresh history page vs.
+    resuming after a few missed messages.
+    """
+    from . import wire
+
+    room = hot_room()
+    if room is None:
+        out.write("No rooms found; run `manage.py seed_chat` first.\n")
+        return
+    in_room = Message.objects.filter(conversation=room)
+    user_ids = list(in_room.values_list("sender", "recipient").first())
+    user, other = (get_user_model().objects.get(id=user_id) for user_id in user_ids)
+    conversation = PrivateRoom(user, other, room)
+    newest = in_room.order_by("-id").values_list("id", flat=True)
+
+    def report(label, load, frame_type):
+        with CaptureQueriesContext(connection) as queries:
+            messages, _ = load()
+        frame = wire.JSON.encode({"type": frame_type, "messages": messages})
+        size = len(frame["text_data"])
+        stats = measure(load, options["repeat"])
+        out.write(
+            f"{label:>22}: {format_stats(stats)}  "
+            f"queries={len(queries)}  bytes={size}\n"
+        )
+
+    out.write(f"room={room.name} messages={newest.count()}\n")
+    report("full history page", conversation.history_page, "history")
+    for missed in (1, 10, 50):
+        after = newest[missed]
+        report(
+            f"resume, {missed} missed",
+            lambda after=after: conversation.messages_after(after),
+            "resume",
+        )
+
+
+@scenario
+def history_cache(out, options):
+    """Opening the hot room's newest page with the history cache off, cold and warm."""
+    room = hot_room()
+    if room is None:
+        out.write("No rooms found; run `manage.py seed_chat` first.\n")
+        return
+    pair = Message.objects.filter(conversation=room).values_list("sender", "recipient")
+    sender, recipient = pair.first()
+    users = get_user_model().objects.in_bulk([sender, recipient])
+    conversation = PrivateRoom(users[sender], users[recipient], room)
+
+    def report(label, cold):
+        def load():
+            if cold:
+                historycache.local_rooms.clear()
+            conversation.history_page()
+        with CaptureQueriesContext(connection) as queries:
+            load()
+        stats = measure(load, options["repeat"])
+        out.write(f"{label:>6}: {format_stats(stats)}  queries={len(queries)}\n")
+
+    count = Message.objects.filter(conversation=room).count()
+    out.write(f"room={room.name} messages={count}\n")
+    with override_settings(CHAT_HISTORY_CACHE_SIZE=0):
+        report("off", cold=True)
+    historycache.metrics.clear()
+    report("cold", cold=True)
+    report("warm", cold=False)
+    metrics = historycache.metrics
+    out.write(f"hits={metrics['hits']} misses={metrics['misses']}\n")
+
+
+def export_room(count):
+    """A private room holding `count` messages, seeded on first use."""
+    users = seed.seed_users(2, prefix="export")
+    room, _, _ = seed.seed_rooms(users, 1)[0]
+    missing = count - Message.objects.filter(conversation=room).count()
+    if missing > 0:
+        seed.seed_messages([(room, *users)], missing)
+    return room
+
+
+@scenario
+def history_export(out, options):
+    """
+    Serializing a whole 100k-message room: model rows with a lazy sender per
+    row (--compare only; one query per message), model rows with
+    select_related, and the streaming values_list serializer, called
+    directly and as GET /rooms/<id>/history/ through the ASGI handler with
+    the sync generator (--compare only) and the async one the view serves.
+    """
+    from unittest import mock
+
+    from django.core.asgi import get_asgi_application
+
+    room = export_room(100_000)
+    messages = Message.objects.filter(conversation=room)
+    out.write(f"room={room.name} messages={messages.count()}\n")
+
+    def lazy_senders():
+        return json.dumps({"type": "history", "messages": [
+            {
+                "sender": m.sender.username,
+                "content": m.message,
+                "timestamp": m.time_stamp.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            for m in messages.order_by("time_stamp", "id")
+        ]})
+
+    def joined_models():
+        return json.dumps({"type": "history", "messages": [
+            history.serialize(m)
+            for m in messages.select_related("sender").order_by("time_stamp", "id")
+        ]})
+
+    def streamed():
+        # What StreamingHttpResponse does: write each chunk out and let it go
+        return sum(len(chunk) for chunk in history.stream_json(room))
+
+    asgi = get_asgi_application()
+    owner = messages.values_list("sender", flat=True).first()
+    cookie = loadtest.session_cookie(get_user_model().objects.get(id=owner))
+
+    async def get_over_asgi():
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": f"/rooms/{room.id}/history/",
+            "query_string": b"",
+            "headers": [(b"cookie", cookie.encode())],
+            "server": ("testserver", 80),
+            "client": ("127.0.0.1", 1),
+        }
+        sent = 0
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if requested:
+                # The client never disconnects; Django cancels this when done
+                await asyncio.Event().wait()
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            nonlocal sent
+            if message["type"] == "http.response.start" and message["status"] != 200:
+                raise RuntimeError(f"export returned {message['status']}")
+            sent += len(message.get("body", b""))
+
+        await asgi(scope, receive, send)
+        return sent
+
+    def asgi_async():
+        return async_to_sync(get_over_asgi)()
+
+    def asgi_sync():
+        # The view as first written: the sync generator whatever the handler
+        with mock.patch("chat.views.ASGIRequest", type(None)):
+            return async_to_sync(get_over_asgi)()
+
+    runs = [
+        ("select_related", joined_models),
+        ("streaming", streamed),
+        ("ASGI, async gen", asgi_async),
+    ]
+    if options["compare"]:
+        runs.insert(0, ("lazy sender", lazy_senders))
+        runs.insert(-1, ("ASGI, sync gen", asgi_sync))
+    queries = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    for label, serialize in runs:
+        queries = 0
+        started = time.perf_counter()
+        with connection.execute_wrapper(count_queries):
+            serialize()
+        elapsed = time.perf_counter() - started
+        # tracemalloc slows allocation-heavy code a lot, so memory gets its own run
+        tracemalloc.start()
+        serialize()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        out.write(
+            f"{label:>15}: {elapsed * 1000:9.1f}ms  queries={queries:6d}  "
+            f"peak memory={peak / 2**20:6.1f}MB\n"
+        )
+
+
+@scenario
+def load(out, options):
+    """
+    --clients simulated users in private pairs against the full ASGI stack,
+    in-process and, with --server, over TCP to a Daphne process: connect
+    latency, message round trips, throughput and (in-process) queries per
+    message. --messages is the total sent across all clients.
+    """
+    from django_project.asgi import application
+
+    client_count = max(2, options["clients"] - options["clients"] % 2)
+    users = seed.seed_users(client_count, prefix="load")
+    pairs = list(zip(users[::2], users[1::2], strict=True))
+    per_client = max(1, options["messages"] // len(users))
+    cookies = {user.id: loadtest.session_cookie(user) for user in users}
+
+    def report(label, result):
+        sent = len(users) * per_client
+        queries = "n/a"
+        if result.queries is not None:
+            queries = f"{result.queries / sent:.2f}"
+        out.write(
+            f"-- {label}: {len(users)} clients x {per_client} messages\n"
+            f"   connect:    {format_stats(summarize(result.connect_times))}\n"
+            f"   round trip: {format_stats(summarize(result.round_trips))}\n"
+            f"   {sent / result.elapsed:.0f} msg/s  queries/msg={queries}  "
+            f"resyncs={result.resyncs}\n"
+        )
+
+    def in_process(path, user):
+        return loadtest.InProcessClient(application, path, cookies[user.id])
+
+    with unlimited(), loadtest.counting_queries() as query_count:
+        result = async_to_sync(loadtest.run_load)(
+            in_process, pairs, per_client, query_count
+        )
+    report("in-process", result)
+
+    if options["server"]:
+        env = {"CHAT_RATE_LIMIT_RATE": "0", "CHAT_RATE_LIMIT_USER_RATE": "0"}
+        with loadtest.daphne_server(env) as port:
+            result = async_to_sync(loadtest.run_load)(
+                lambda path, user: loadtest.ServerClient(port, path, cookies[user.id]),
+                pairs,
+                per_client,
+            )
+        report("daphne", result)
+
+
+@scenario
+def handshake(out, options):
+    """
+    --clients websocket handshakes through the full ASGI stack with the
+    session cache off, cold and warm: latency up to the history frame and
+    queries per handshake.
+    """
+    from django_project.asgi import application
+
+    *users, peer = seed.seed_users(options["clients"] + 1, prefix="load")
+    cookies = [loadtest.session_cookie(user) for user in users]
+
+    async def connect_all():
+        samples = []
+        for cookie in cookies:
+            client = loadtest.InProcessClient(
+                application, f"/ws/private/{peer.username}/", cookie
+            )
+            started = time.perf_counter()
+            await client.connect()
+            await client.receive()
+            samples.append(time.perf_counter() - started)
+            await client.close()
+        return samples
+
+    def report(label):
+        # So only the session cache differs between runs
+        historycache.local_rooms.clear()
+        with loadtest.counting_queries() as query_count:
+            samples = async_to_sync(connect_all)()
+        per_handshake = query_count[0] / len(samples)
+        out.write(
+            f"{label:>5}: {format_stats(summarize(samples))}  "
+            f"queries/handshake={per_handshake:.2f}\n"
+        )
+
+    with unlimited():
+        with override_settings(CHAT_AUTH_CACHE_SIZE=0):
+            async_to_sync(connect_all)()  # creates the rooms so no run pays for it
+            report("off")
+        auth.session_users.clear()
+        report("cold")
+        report("warm")
+
+
+@scenario
+def sessions(out, options):
+    """
+    Requests/sec and session queries on the home page with each session
+    engine, using the configured cache; --compare repeats the cache-backed
+    engines against a local Redis stand-in for a shared cache.
+    """
+    from django.test import Client
+
+    from django_project.sessions import ENGINES, caches_from_env
+
+    owner = Conversation.objects.values_list("owner", flat=True).first()
+    if owner:
+        user = get_user_model().objects.get(id=owner)
+    else:
+        user = seed.seed_users(1, prefix="bench")[0]
+    count = options["repeat"]
+
+    def run(label):
+        client = Client()
+        client.force_login(user)
+        client.get("/home/")
+        session_queries = 0
+
+        def count_session_queries(execute, sql, params, many, context):
+            nonlocal session_queries
+            session_queries += "django_session" in sql
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count_session_queries):
+            for _ in range(count):
+                if client.get("/home/").status_code != 200:
+                    raise RuntimeError(f"{label}: home page did not render")
+        elapsed = time.perf_counter() - started
+        out.write(
+            f"{label:>24}: {count / elapsed:8.1f} req/s  "
+            f"session queries/request={session_queries / count:.2f}\n"
+        )
+
+    out.write(f"user={user.username} requests={count}\n")
+    for kind, engine in ENGINES.items():
+        with override_settings(SESSION_ENGINE=engine):
+            run(kind)
+    if options["compare"]:
+        urls, stop = start_fake_redis(1)
+        try:
+            with override_settings(CACHES=caches_from_env({"CACHE_URL": urls[0]})):
+                for kind in ("cached_db", "cache"):
+                    with override_settings(SESSION_ENGINE=ENGINES[kind]):
+                        run(f"{kind} (shared cache)")
+        finally:
+            stop()
+
+
+@scenario
+def connections(out, options):
+    """
+    The `load` traffic with DB connections closed after every consumer call
+    (CONN_MAX_AGE=0) vs. kept for 60s: round trips, throughput and
+    connections opened per message, in-process and, with --server, under
+    Daphne. On PostgreSQL with psycopg 3 the Daphne run adds DB_POOL=1.
+    """
+    from importlib.util import find_spec
+    from unittest import mock
+
+    from django.db import close_old_connections
+    from django.db import connections as databases
+    from django.db.backends.signals import connection_created
+
+    from django_project.asgi import application
+
+    client_count = max(2, options["clients"] - options["clients"] % 2)
+    users = seed.seed_users(client_count, prefix="load")
+    pairs = list(zip(users[::2], users[1::2], strict=True))
+    per_client = max(1, options["messages"] // len(users))
+    cookies = {user.id: loadtest.session_cookie(user) for user in users}
+    sent = len(users) * per_client
+
+    def report(label, result, opened=None):
+        opened = f"{opened / sent:.2f}" if opened is not None else "n/a"
+        out.write(
+            f"{label:>22}: round trip {format_stats(summarize(result.round_trips))}  "
+            f"{sent / result.elapsed:6.0f} msg/s  connections/msg={opened}\n"
+        )
+
+    opened = [0]
+
+    def count_connection(**_kwargs):
+        opened[0] += 1
+
+    out.write(f"{len(users)} clients x {per_client} messages\n")
+    connection_created.connect(count_connection)
+    try:
+        for max_age in (0, 60):
+            # channels' test communicator stubs out close_old_connections; a
+            # server doesn't
+            closing = mock.patch(
+                "channels.testing.application.no_op", close_old_connections
+            )
+            max_age_set = mock.patch.dict(
+                databases.settings["default"], {"CONN_MAX_AGE": max_age}
+            )
+            with unlimited(), closing, max_age_set:
+                databases.close_all()  # reopen with the patched CONN_MAX_AGE
+                # run_load reads the counter around the chatting only, so
+                # handshakes don't count
+                result = async_to_sync(loadtest.run_load)(
+                    lambda path, user: loadtest.InProcessClient(
+                        application, path, cookies[user.id]
+                    ),
+                    pairs,
+                    per_client,
+                    opened,
+                )
+                report(f"in-process max_age={max_age}", result, result.queries)
+    finally:
+        connection_created.disconnect(count_connection)
+        databases.close_all()
+
+    if options["server"]:
+        runs = {
+            "max_age=0": {"DB_CONN_MAX_AGE": "0"},
+            "max_age=60": {"DB_CONN_MAX_AGE": "60"},
+        }
+        if connection.vendor == "postgresql" and find_spec("psycopg_pool"):
+            runs["pool"] = {"DB_POOL": "1"}
+        for label, env in runs.items():
+            env = {
+                **env, "CHAT_RATE_LIMIT_RATE": "0", "CHAT_RATE_LIMIT_USER_RATE": "0"
+            }
+            with loadtest.daphne_server(env) as port:
+                result = async_to_sync(loadtest.run_load)(
+                    lambda path, user: loadtest.ServerClient(
+                        port, path, cookies[user.id]
+                    ),
+                    pairs,
+                    per_client,
+                )
+            report(f"daphne {label}", result)
+
+
+@scenario
+def db_threads(out, options):
+    """
+    The `load` traffic with chat DB calls on channels' single shared thread
+    vs. CHAT_DB_THREADS dedicated threads: round trips, throughput and how
+    long calls waited for a thread. --db-latency adds a network round trip
+    to every in-process query; --server repeats it under Daphne.
+    """
+    from django.db import connections as databases
+
+    from django_project.asgi import application
+
+    client_count = max(2, options["clients"] - options["clients"] % 2)
+    users = seed.seed_users(client_count, prefix="load")
+    pairs = list(zip(users[::2], users[1::2], strict=True))
+    per_client = max(1, options["messages"] // len(users))
+    cookies = {user.id: loadtest.session_cookie(user) for user in users}
+    sent = len(users) * per_client
+    sizes = (0, 2, 4)
+
+    def report(label, result, waits=""):
+        out.write(
+            f"{label:>20}: round trip {format_stats(summarize(result.round_trips))}  "
+            f"{sent / result.elapsed:6.0f} msg/s{waits}\n"
+        )
+
+    out.write(
+        f"{len(users)} clients x {per_client} messages  "
+        f"db latency={options['db_latency']}ms\n"
+    )
+    for size in sizes:
+        dbexecutor.metrics.clear()
+        latency = loadtest.query_latency(options["db_latency"] / 1000)
+        with unlimited(), override_settings(CHAT_DB_THREADS=size), latency:
+            result = async_to_sync(loadtest.run_load)(
+                lambda path, user: loadtest.InProcessClient(
+                    application, path, cookies[user.id]
+                ),
+                pairs,
+                per_client,
+            )
+        metrics = dbexecutor.metrics
+        mean_wait = metrics["wait_seconds"] / metrics["calls"]
+        report(
+            f"in-process threads={size}", result,
+            f"  wait mean={mean_wait * 1000:.3f}ms"
+            f" max={metrics['max_wait_seconds'] * 1000:.3f}ms"
+            f"  peak queued={metrics['peak_queued']}",
+        )
+    dbexecutor.pool.shutdown()
+    databases.close_all()
+
+    if options["server"]:
+        for size in sizes:
+            env = {
+                "CHAT_DB_THREADS": str(size),
+                "CHAT_RATE_LIMIT_RATE": "0",
+                "CHAT_RATE_LIMIT_USER_RATE": "0",
+            }
+            with loadtest.daphne_server(env) as port:
+                result = async_to_sync(loadtest.run_load)(
+                    lambda path, user: loadtest.ServerClient(
+                        port, path, cookies[user.id]
+                    ),
+                    pairs,
+                    per_client,
+                )
+            report(f"daphne threads={size}", result)
+
+
+@scenario
+def async_orm(out, options):
+    """
+    The `load` traffic through PrivateChatConsumer vs.
+    AsyncORMPrivateChatConsumer (CHAT_CONSUMER_ORM=async): round trips,
+    throughput, and per message the queries, hops from the event loop to a
+    sync thread and threads that ran SQL; --server repeats the round trips
+    under Daphne.
+    """
+    import threading
+    from unittest import mock
+
+    from asgiref.sync import SyncToAsync
+    from channels.routing import URLRouter
+    from django.db.backends.utils import CursorWrapper
+    from django.urls import re_path
+
+    from .consumers import AsyncORMPrivateChatConsumer
+
+    client_count = max(2, options["clients"] - options["clients"] % 2)
+    users = seed.seed_users(client_count, prefix="load")
+    pairs = list(zip(users[::2], users[1::2], strict=True))
+    per_client = max(1, options["messages"] // len(users))
+    cookies = {user.id: loadtest.session_cookie(user) for user in users}
+    sent = len(users) * per_client
+
+    hops = [0]
+    sql_threads = set()
+    call = SyncToAsync.__call__
+
+    async def counted_call(self, *args, **kwargs):
+        hops[0] += 1
+        return await call(self, *args, **kwargs)
+
+    def recording(execute):
+        def recorded(self, *args, **kwargs):
+            sql_threads.add(threading.get_ident())
+            return execute(self, *args, **kwargs)
+        return recorded
+
+    def clients(application):
+        return lambda path, user: loadtest.InProcessClient(
+            application, path, cookies[user.id]
+        )
+
+    out.write(f"{len(users)} clients x {per_client} messages\n")
+    for consumer in (PrivateChatConsumer, AsyncORMPrivateChatConsumer):
+        route = re_path(r"ws/private/(?P<username>\w+)/$", consumer.as_asgi())
+        application = auth.CachedAuthMiddlewareStack(URLRouter([route]))
+        historycache.local_rooms.clear()
+        sql_threads.clear()
+        with unlimited(), loadtest.counting_queries() as query_count, \
+                mock.patch.object(
+                    CursorWrapper, "execute", recording(CursorWrapper.execute)
+                ), \
+                mock.patch.object(SyncToAsync, "__call__", counted_call):
+            result = async_to_sync(loadtest.run_load)(
+                clients(application), pairs, per_client, query_count, {"hops": hops},
+            )
+        round_trip = format_stats(summarize(result.round_trips))
+        out.write(
+            f"{consumer.__name__:>27}: round trip {round_trip}  "
+            f"{sent / result.elapsed:6.0f} msg/s  "
+            f"queries/msg={result.queries / sent:.2f}  "
+            f"hops/msg={result.counts['hops'] / sent:.2f}  "
+            f"SQL threads={len(sql_threads)}\n"
+        )
+
+    if options["server"]:
+        for orm in ("sync", "async"):
+            env = {
+                "CHAT_CONSUMER_ORM": orm,
+                "CHAT_RATE_LIMIT_RATE": "0",
+                "CHAT_RATE_LIMIT_USER_RATE": "0",
+            }
+            with loadtest.daphne_server(env) as port:
+                result = async_to_sync(loadtest.run_load)(
+                    lambda path, user: loadtest.ServerClient(
+                        port, path, cookies[user.id]
+                    ),
+                    pairs,
+                    per_client,
+                )
+            round_trip = format_stats(summarize(result.round_trips))
+            out.write(
+                f"{'daphne ' + orm:>27}: round trip {round_trip}  "
+                f"{sent / result.elapsed:6.0f} msg/s\n"
+            )
+
+
+def serve_fake_redis(ports):
+    """Shard process body: serve one fakeredis instance and report its port."""
+    from fakeredis import TcpFakeServer
+
+    class Server(TcpFakeServer):
+        def get_request(self):
+            # Replies go out in several small writes; without NODELAY each
+            # command stalls on delayed ACKs and latency is dominated by that
+            sock, address = super().get_request()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock, address
+
+    server = Server(("127.0.0.1", 0), server_type="redis")
+    server.daemon_threads = True
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_fake_redis(count):
+    """
+    Start `count` Redis-protocol servers (fakeredis), each in its own process
+    so they don't share a GIL with the code under test. Returns (urls, stop).
+    Used as a local stand-in for a sharded Redis deployment.
+    """
+    ctx = multiprocessing.get_context("fork")
+    ports = ctx.Queue()
+    shards = [
+        ctx.Process(target=serve_fake_redis, args=(ports,), daemon=True)
+        for _ in range(count)
+    ]
+    for shard in shards:
+        shard.start()
+    urls = [f"redis://127.0.0.1:{ports.get(timeout=10)}" for _ in shards]
+
+    def stop():
+        for shard in shards:
+            shard.terminate()
+            shard.join()
+
+    return urls, stop
+
+
+def build_layer(config):
+    return import_string(config["BACKEND"])(**config.get("CONFIG", {}))
+
+
+def layer_receiver(config, group, count, results, timeout):
+    """Worker process body: join `group` on its own layer, count deliveries."""
+    async def run():
+        layer = build_layer(config)
+        channel = await layer.new_channel()
+        await layer.group_add(group, channel)
+        results.put(("ready", os.getpid()))
+        received, started = 0, None
+        try:
+            while received < count:
+                await asyncio.wait_for(layer.receive(channel), timeout)
+                started = started or time.perf_counter()
+                received += 1
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - started if started else 0.0
+        results.put(("done", received, elapsed))
+
+    asyncio.run(run())
+
+
+def cross_worker_fanout(
+    config, workers, count, group="private_chat_bench", timeout=10
+):
+    """
+    Fork `workers` processes that each join `group` through their own channel
+    layer instance, group_send `count` messages from this process, and report
+    what every worker received.
+    """
+    ctx = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(
+            target=layer_receiver, args=(config, group, count, results, timeout)
+        )
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for _ in processes:
+            results.get(timeout=timeout)
+
+        async def send():
+            layer = build_layer(config)
+            started = time.perf_counter()
+            for i in range(count):
+                await layer.group_send(
+                    group,
+                    {"type": "chat_message", "sender": "bench", "message": str(i)},
+                )
+            return time.perf_counter() - started
+
+        send_elapsed = async_to_sync(send)()
+        received, elapsed = [], []
+        for _ in processes:
+            _, n, seconds = results.get(timeout=timeout * 2)
+            received.append(n)
+            elapsed.append(seconds)
+    except queue.Empty:
+        raise RuntimeError(
+            "channel layer workers did not report back in time"
+        ) from None
+    finally:
+        for process in processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+    return {
+        "received": received,
+        "send_rate": count / send_elapsed,
+        "delivery_rate": sum(received) / max(max(elapsed), 1e-9),
+    }
+
+
+@scenario
+def channel_layer(out, options):
+    """Cross-process group_send delivery and throughput through the channel layer."""
+    config = settings.CHANNEL_LAYERS["default"]
+    stop = None
+    if "InMemory" in config["BACKEND"]:
+        urls, stop = start_fake_redis(options["shards"])
+        config = channel_layers_from_env({
+            "CHANNEL_LAYER": "redis",
+            "CHANNEL_REDIS_URLS": ",".join(urls),
+            "CHANNEL_LAYER_CAPACITY": str(options["messages"]),
+        })["default"]
+        out.write(
+            "CHANNEL_LAYER=memory cannot cross processes; "
+            f"using {len(urls)} fakeredis shards\n"
+        )
+    try:
+        report = cross_worker_fanout(config, options["workers"], options["messages"])
+    finally:
+        if stop:
+            stop()
+    out.write(
+        f"workers={options['workers']} messages={options['messages']} "
+        f"received={report['received']}\n"
+        f"group_send {report['send_rate']:.0f} msg/s, "
+        f"delivered {report['delivery_rate']:.0f} msg/s across workers\n"
+    )
+
+
+@scenario
+def users(out, options):
+    """The old render-every-user dashboard query vs. prefix-search directory pages."""
+    total = options["users"]
+    started = time.perf_counter()
+    me, *_ = seed.seed_users(total)
+    seeding = time.perf_counter() - started
+    out.write(
+        f"{get_user_model().objects.count()} users (seeding took {seeding:.1f}s)\n"
+    )
+
+    repeat = options["repeat"]
+    cases = {
+        "first page": {},
+        "prefix user12": {"prefix": "user12"},
+        "prefix user99999": {"prefix": "user99999"},
+        "deep page": {"after": f"user{total // 2}"},
+    }
+    out.write(f"-- plan (prefix)\n{directory.queryset(me, 'user12')[:51].explain()}\n")
+    for label, kwargs in cases.items():
+        stats = measure(
+            lambda kwargs=kwargs: directory.search(exclude=me, **kwargs), repeat
+        )
+        out.write(f"{label:>18}: {format_stats(stats)}\n")
+    if options["compare"]:
+        stats = measure(
+            lambda: list(get_user_model().objects.exclude(id=me.id)),
+            max(1, repeat // 10),
+        )
+        out.write(f"{'all users (old)':>18}: {format_stats(stats)}\n")
+
+
+def sample_frames(page_size):
+    """A full history page and a live message frame, as the consumers build them."""
+    now = int(time.time())
+    messages = [
+        {
+            "id": 1_000_000 + i,
+            "sender": ("alice_wonderland", "bob_builder")[i % 2],
+            "sender_id": (101, 202)[i % 2],
+            "content": f"message number {i}, about as long as a typical chat line",
+            "timestamp": now - page_size + i,
+        }
+        for i in range(page_size)
+    ]
+    live = {
+        **messages[-1],
+        "type": "chat_message",
+        "room": 42,
+        "message": messages[-1]["content"],
+    }
+    del live["content"]
+    history_frame = {
+        "type": "history",
+        "messages": messages,
+        "cursor": "MjAyNi0wMS0wMVQwMDowMDowMCswMDowMHwxMjM0NQ==",
+        "peer_online": True,
+        "users": {101: "alice_wonderland", 202: "bob_builder"},
+    }
+    return {"history page": history_frame, "live message": live}
+
+
+@scenario
+def wire_encoding(out, options):
+    """Bytes on the wire and encode CPU per frame, JSON vs. MessagePack; no data."""
+    from . import wire
+
+    encodings = {"json": wire.JSON}
+    if wire.MSGPACK is not None:
+        encodings["msgpack"] = wire.MSGPACK
+    else:
+        out.write("msgpack is not installed; only measuring JSON.\n")
+
+    frames = sample_frames(settings.CHAT_HISTORY_PAGE_SIZE)
+    rounds = options["messages"]
+    for label, frame in frames.items():
+        out.write(f"-- {label}\n")
+        for name, encoding in encodings.items():
+            size = len(next(iter(encoding.encode(frame).values())))
+            started = time.perf_counter()
+            for _ in range(rounds):
+                encoding.encode(frame)
+            per_frame = (time.perf_counter() - started) / rounds
+            # Every recipient encodes its own copy, so a 1:1 broadcast costs two encodes
+            out.write(
+                f"{name:>8}: {size:7d} bytes  {per_frame * 1e6:8.1f}us/encode  "
+                f"{2 * per_frame * 1e6:8.1f}us/broadcast (2 members)\n"
+            )
+
+
+@scenario
+def broadcast(out, options):
+    """
+    Cost of one group broadcast through an in-memory channel layer to 2, 50
+    and 500 members: every member encoding the event itself vs. members
+    writing out frames the sender encoded once. Needs no data.
+    """
+    from channels.layers import InMemoryChannelLayer
+
+    from . import wire
+
+    frame = sample_frames(1)["live message"]
+    frame["type"] = "message"
+    encoding = wire.JSON
+
+    async def fan_out(members, per_member):
+        layer = InMemoryChannelLayer(capacity=members * 2)
+        channels = [await layer.new_channel() for _ in range(members)]
+        for channel in channels:
+            await layer.group_add("bench", channel)
+        samples = []
+        for _ in range(options["repeat"]):
+            started = time.perf_counter()
+            if per_member:
+                await layer.group_send("bench", {**frame, "type": "chat_message"})
+            else:
+                frames = wire.encode_once(frame)
+                await layer.group_send(
+                    "bench", {"type": "chat_message", "frames": frames}
+                )
+            for channel in channels:
+                event = await layer.receive(channel)
+                if per_member:
+                    encoding.encode({**event, "type": "message"})
+                else:
+                    event["frames"][encoding.name]
+            samples.append(time.perf_counter() - started)
+        return summarize(samples)
+
+    for members in (2, 50, 500):
+        for label, per_member in (
+            ("encode per member", True), ("encode once", False)
+        ):
+            stats = async_to_sync(fan_out)(members, per_member)
+            out.write(f"{members:4d} members  {label:>17}: {format_stats(stats)}\n")
+
+    # The in-memory layer's own per-send bookkeeping dominates large rooms;
+    # this isolates what the sender and members spend on serialization
+    out.write("-- serialization only\n")
+    for members in (2, 50, 500):
+        per_member = measure(
+            lambda members=members: [encoding.encode(frame) for _ in range(members)],
+            options["repeat"],
+        )
+        once = measure(lambda: wire.encode_once(frame), options["repeat"])
+        out.write(
+            f"{members:4d} members  {'encode per member':>17}: "
+            f"{format_stats(per_member)}\n"
+        )
+        out.write(
+            f"{members:4d} members  {'encode once':>17}: {format_stats(once)}\n"
+        )
+
+
+@scenario
+def flood(out, options):
+    """
+    Round-trip latency for well-behaved users while one client floods the
+    server, with rate limiting off and on. Each polite user sends --repeat
+    messages 250ms apart, inside the default per-connection rate.
+    """
+    flooder, peer, *polite = seed.seed_users(6, prefix="flood")
+    count = options["repeat"]
+
+    async def run(flood_too=True):
+        flooding = await private_socket(flooder, peer.username)
+        sockets = [await private_socket(user, peer.username) for user in polite]
+        stop = asyncio.Event()
+        sent = 0
+
+        async def flood_forever():
+            nonlocal sent
+            while not stop.is_set():
+                await flooding.send_json_to({"message": f"flood {sent}"})
+                sent += 1
+                await asyncio.sleep(0)
+
+        async def chat(communicator):
+            samples = []
+            for i in range(count):
+                started = time.perf_counter()
+                await communicator.send_json_to({"message": f"hello {i}"})
+                reply = await communicator.receive_json_from(timeout=60)
+                if reply.get("type") == "error":
+                    raise RuntimeError(f"polite user was refused: {reply}")
+                samples.append(time.perf_counter() - started)
+                await asyncio.sleep(0.25)
+            return samples
+
+        if not flood_too:
+            stop.set()
+        flooding_task = asyncio.create_task(flood_forever())
+        results = await asyncio.gather(
+            *(chat(communicator) for communicator in sockets)
+        )
+        stop.set()
+        await flooding_task
+        for communicator in (flooding, *sockets):
+            await communicator.disconnect(timeout=60)
+        return [sample for samples in results for sample in samples], sent
+
+    runs = (("no flood", override_settings(), False), ("limits off", unlimited(), True),
+            ("limits on", override_settings(), True))
+    for label, limits, flood_too in runs:
+        ratelimit.metrics.clear()
+        ratelimit.user_buckets.buckets.clear()
+        before = Message.objects.count()
+        with limits:
+            samples, sent = async_to_sync(run)(flood_too)
+        saved = Message.objects.count() - before
+        metrics = ratelimit.metrics
+        throttled = metrics["throttled_connection"] + metrics["throttled_user"]
+        out.write(
+            f"{label:>10}: polite round trip {format_stats(summarize(samples))}\n"
+            f"{'':>10}  flooder sent={sent} saved={saved - len(samples)} "
+            f"throttled={throttled}\n"
+        )
+
+
+async def group_socket(user, room_id, application=None):
+    """An in-process websocket to GroupChatConsumer, history frame consumed."""
+    communicator = WebsocketCommunicator(
+        application or GroupChatConsumer.as_asgi(), f"/ws/room/{room_id}/"
+    )
+    communicator.scope["user"] = user
+    communicator.scope["url_route"] = {"kwargs": {"room_id": str(room_id)}}
+    connected, _ = await communicator.connect()
+    if not connected:
+        raise RuntimeError(f"could not connect {user.username} to room {room_id}")
+    await communicator.receive_from()
+    return communicator
+
+
+@scenario
+def slow_readers(out, options):
+    """
+    A group room with 10 fast and 10 slow (50ms per frame) readers: delivery
+    latency for the fast ones and peak Python memory, for each outbound
+    queue policy and for an effectively unbounded queue.
+    """
+    sender, *readers = seed.seed_users(21, prefix="slowread")
+    room = groups.create(sender, "slow readers", readers)
+    fast, slow = readers[:10], readers[10:]
+    count = min(options["messages"], 500)
+
+    async def run():
+        fast_sockets = [await group_socket(user, room.id) for user in fast]
+        slow_app = slow_reader(GroupChatConsumer.as_asgi(), 0.05)
+        slow_sockets = [await group_socket(user, room.id, slow_app) for user in slow]
+        sending = await group_socket(sender, room.id)
+
+        async def read(communicator):
+            latencies = []
+            for _ in range(count):
+                frame = await communicator.receive_json_from(timeout=60)
+                latencies.append(time.time() - float(frame["message"]))
+            return latencies
+
+        readers = [
+            asyncio.create_task(read(communicator)) for communicator in fast_sockets
+        ]
+        for _ in range(count):
+            await sending.send_json_to({"message": repr(time.time())})
+            await asyncio.sleep(0.01)
+        results = await asyncio.gather(*readers)
+        latencies = [sample for result in results for sample in result]
+        for communicator in (sending, *fast_sockets, *slow_sockets):
+            await communicator.disconnect(timeout=60)
+        return latencies
+
+    policies = [
+        ("unbounded", {"CHAT_OUTBOUND_QUEUE_LIMIT": 10 ** 9}),
+        *((policy, {"CHAT_OUTBOUND_QUEUE_POLICY": policy})
+          for policy in (
+              backpressure.DROP_OLDEST, backpressure.COALESCE, backpressure.DISCONNECT
+          )),
+    ]
+    for label, overrides in policies:
+        backpressure.metrics.clear()
+        tracemalloc.start()
+        # Write-behind so the sender's inserts don't dominate delivery latency
+        batched = override_settings(
+            CHAT_MESSAGE_DURABILITY=persistence.BATCHED, **overrides
+        )
+        with unlimited(), batched:
+            latencies = async_to_sync(run)()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        metrics = backpressure.metrics
+        out.write(
+            f"{label:>12}: fast readers {format_stats(summarize(latencies))}  "
+            f"peak memory={peak / 1e6:.1f}MB  "
+            f"peak queue depth={metrics['peak_depth']}  "
+            f"dropped={metrics['dropped']} coalesced={metrics['coalesced']} "
+            f"disconnected={metrics['disconnected']}\n"
+        )
@@ -1,99 +1,557 @@
-import json
+import time
+from urllib.parse import parse_qs
+
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.contrib.auth import get_user_model
-from .models import Message, ChatRoom
-from datetime import datetime
+from django.conf import settings
+
+from . import backpressure, groups, history, persistence, presence, ratelimit, wire
+from .dbexecutor import db_call
+from .rooms import GroupRoom, PrivateRoom
+
+
+class BaseChatConsumer(AsyncWebsocketConsumer):
+    """Frame handling shared by the per-peer, group and multiplexed chat sockets."""
+
+    encoding = wire.JSON
+    outbound = None
+
+    async def accept_connection(self):
+        """
+        Accept the socket, speaking MessagePack if the client offered it, and
+        set up its rate limits.
+        """
+        self.encoding = wire.negotiate(self.scope.get("subprotocols"))
+        self.limiter = ratelimit.Limiter(self.current_user.id)
+        await self.accept(subprotocol=self.encoding.subprotocol)
+        self.outbound = backpressure.OutboundQueue(
+            super().send, self.close, self.encoding.encode
+        )
+
+    async def join_user_group(self):
+        self.user_group_name = presence.user_group(self.current_user.id)
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+
+    async def disconnect(self, _close_code):
+        if self.outbound is not None:
+            await self.outbound.shutdown()
+        if hasattr(self, "user_group_name"):
+            await self.channel_layer.group_discard(
+                self.user_group_name, self.channel_name
+            )
+        await presence.tracker.disconnect(self.channel_name)
+        if persistence.durability() == persistence.BATCHED:
+            await persistence.write_behind.flush()
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        """Queue a frame for this connection's writer task, not writing it inline."""
+        if close or self.outbound is None:
+            await super().send(text_data, bytes_data, close)
+        else:
+            await self.outbound.put({"text_data": text_data, "bytes_data": bytes_data})
+
+    async def send_frame(self, frame):
+        await self.send(**self.encoding.encode(frame))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Handle new message from WebSocket: answer pings, rate-limit the rest,
+        then handle() them.
+        """
+        data = self.encoding.decode(text_data, bytes_data)
+        if data is None:
+            return  # ignore undecodable frames
+
+        # Any frame proves the socket is alive; idle clients send pings
+        await presence.tracker.heartbeat(self.channel_name)
+        if data.get("type") == "ping":
+            await self.send_frame({"type": "pong"})
+            return
+
+        # Before any database work, so a flooder can't tie up the DB threads
+        control = data.get("type") in ratelimit.CONTROL_FRAMES
+        allowed, retry_after = await self.limiter.admit(control=control)
+        if not allowed:
+            # The frame goes back so the client can retry it or show it wasn't sent
+            await self.send_frame({
+                "type": "error", "error": "rate limited",
+                "retry_after": round(retry_after, 3), "rejected": data,
+            })
+            return
+        await self.handle(data)
+
+    async def send_history(
+        self, conversation, frame_type, cursor=None, limit=None, **extra
+    ):
+        """Send a page of the conversation's history, or an error if `cursor` is bad."""
+        try:
+            messages, next_cursor = await self.load_history(
+                conversation, cursor, limit
+            )
+        except history.InvalidCursor:
+            await self.send_frame({"type": "error", "error": "invalid cursor", **extra})
+            return
+        await self.send_frame({
+            "type": frame_type,
+            **extra,
+            "messages": messages,
+            "cursor": next_cursor,
+            "users": conversation.users,
+        })
+
+    def resume_point(self):
+        """The ?after=<message id> a reconnecting client put on the socket URL."""
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        values = query.get("after")
+        return values[-1] if values else None
+
+    async def send_resume(self, conversation, after, limit=None, **extra):
+        """
+        Send the messages the client missed since message `after`. When
+        "more" is true it asks again with the last id it got, until it has
+        caught up.
+        """
+        try:
+            messages, more = await self.load_after(conversation, after, limit)
+        except history.InvalidCursor:
+            await self.send_frame(
+                {"type": "error", "error": "invalid resume point", **extra}
+            )
+            return
+        await self.send_frame({
+            "type": "resume",
+            **extra,
+            "messages": messages,
+            "more": more,
+            "users": conversation.users,
+        })
+
+    async def save_message(self, room, content):
+        """
+        Persist a message now and return it, or queue it for the next batch
+        in write-behind mode and return None.
+        """
+        if persistence.durability() == persistence.BATCHED:
+            persistence.write_behind.add(room.new_message(content))
+            return None
+        return await self.create_message(room, content)
+
+    # The queries behind the frames above, overridden by AsyncORMPrivateChatConsumer
+    async def load_history(self, conversation, cursor, limit):
+        return await db_call(conversation.history_page)(before=cursor, limit=limit)
 
-User = get_user_model()
+    async def load_after(self, conversation, after, limit):
+        return await db_call(conversation.messages_after)(after, limit=limit)
+
+    async def create_message(self, room, content):
+        return await db_call(room.create_message)(content)
+
+    async def post_message(self, room, content):
+        """Save a message, broadcast it and notify the recipient's other sockets."""
+        content = (content or "").strip()
+        if not content:
+            return
+        if not await room.is_member():
+            await self.send_frame(
+                {"type": "error", "error": "not a member", "room": room.id}
+            )
+            return
+
+        saved = await self.save_message(room, content)
+
+        # Broadcast message with timestamp; the id is unknown until a
+        # write-behind batch lands
+        frame = {
+            "type": "message",
+            "room": room.id,
+            "id": saved.id if saved else None,
+            "sender": self.current_user.username,
+            "sender_id": self.current_user.id,
+            "message": content,
+            "timestamp": int(time.time())
+        }
+        if room.recipient is None:
+            # Members can't be expected to know every sender's id; keep names
+            # in group frames
+            del frame["sender_id"]
+            groups.fanout.add(room.id, frame)
+            return
+
+        # Encoded here once per wire format; every member just writes its copy out
+        frames = wire.encode_once(frame)
+        await self.channel_layer.group_send(
+            room.group_name, {"type": "chat_message", "room": room.id, "frames": frames}
+        )
+        await self.channel_layer.group_send(
+            presence.user_group(room.other_user.id), {**frame, "type": "chat_notify"}
+        )
+
+    async def chat_message(self, event):
+        """Send a broadcast message, already encoded by the sender, to WebSocket."""
+        await self.outbound.put(event["frames"][self.encoding.name], room=event["room"])
+
+    async def chat_batch(self, event):
+        """Group messages the sender batched into one broadcast, already encoded."""
+        for frames in event["frames"]:
+            await self.outbound.put(frames[self.encoding.name], room=event["room"])
+
+    async def chat_notify(self, event):
+        """Only the multiplexed socket shows conversations it hasn't opened."""
+
+    async def room_members(self, event):
+        """Someone joined or left a group room this socket has open."""
+        await self.send_frame({
+            "type": "members",
+            "room": event["room"],
+            "user": event["user"],
+            "user_id": event["user_id"],
+            "joined": event["joined"]
+        })
+
+    async def mark_read(self, room, up_to):
+        """Mark everything the peer sent up to message `up_to` as read and tell them."""
+        try:
+            up_to = int(up_to)
+        except (TypeError, ValueError):
+            return
+        if await db_call(room.mark_read_up_to)(up_to):
+            await self.channel_layer.group_send(
+                room.group_name,
+                {
+                    "type": "read_receipt",
+                    "room": room.id,
+                    "reader": self.current_user.username,
+                    "reader_id": self.current_user.id,
+                    "up_to": up_to
+                }
+            )
+
+    async def presence(self, event):
+        """A contact came online or went offline."""
+        await self.send_frame({
+            "type": "presence",
+            "user": event["user"],
+            "user_id": event.get("user_id"),
+            "online": event["online"]
+        })
+
+    async def presence_expired(self, _event):
+        """The presence sweep found this socket silent past its heartbeat TTL."""
+        await self.close()
+
+
+class PrivateChatConsumer(BaseChatConsumer):
+    """One socket per conversation, at ws/private/<username>/."""
 
-class PrivateChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.other_username = self.scope['url_route']['kwargs']['username']
         self.current_user = self.scope['user']
 
-        # Create unique private room name
-        self.room_name = self.get_room_name(self.current_user.username, self.other_username)
-        self.room_group_name = f"private_chat_{self.room_name}"
+        # Resolve the peer and the room once; every later query reuses them
+        self.conversation = None
+        if self.current_user.is_authenticated:
+            self.conversation = await self.resolve(
+                self.current_user, self.other_username
+            )
+        if self.conversation is None:
+            await self.close()
+            return
+        self.other_user = self.conversation.other_user
+        self.room = self.conversation.room
+        self.room_group_name = self.conversation.group_name
 
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        await self.join_user_group()
+        await self.accept_connection()
+        await presence.tracker.connect(self.current_user, self.channel_name)
 
-        # Send old private messages
-        old_messages = await self.get_saved_messages(self.current_user.username, self.other_username)
-        await self.send(text_data=json.dumps({
-            "type": "history",
-            "messages": old_messages
-        }))
+        # Send the newest page of private messages, or only what a reconnecting
+        # client missed, and whether the peer is online
+        peer_online = await presence.tracker.is_online(self.other_user.id)
+        after = self.resume_point()
+        if after is not None:
+            await self.send_resume(self.conversation, after, peer_online=peer_online)
+        else:
+            await self.send_history(
+                self.conversation, "history", peer_online=peer_online
+            )
+
+    async def resolve(self, user, other_username):
+        return await db_call(PrivateRoom.resolve)(user, other_username)
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        if hasattr(self, "room_group_name"):
+            await self.channel_layer.group_discard(
+                self.room_group_name, self.channel_name
+            )
+        await super().disconnect(close_code)
 
-    async def receive(self, text_data):
-        """Handle new message from WebSocket."""
-        try:
-            data = json.loads(text_data)
-        except json.JSONDecodeError:
-            return  # ignore invalid JSON
+    async def handle(self, data):
+        if data.get("type") == "history":
+            if data.get("cursor"):
+                await self.send_history(
+                    self.conversation, "history_page", data["cursor"], data.get("limit")
+                )
+        elif data.get("type") == "resume":
+            await self.send_resume(
+                self.conversation, data.get("after"), data.get("limit")
+            )
+        elif data.get("type") == "read":
+            await self.mark_read(self.conversation, data.get("up_to"))
+        else:
+            await self.post_message(self.conversation, data.get("message"))
 
-        message = data.get("message", "").strip()
-        if not message:
+    async def read_receipt(self, event):
+        """Forward a read receipt to the sender's side only."""
+        if event["reader"] == self.current_user.username:
             return
+        await self.send_frame({
+            "type": "read",
+            "reader": event["reader"],
+            "reader_id": event.get("reader_id"),
+            "up_to": event["up_to"]
+        })
 
-        # Save message
-        await self.save_message(self.current_user.username, self.other_username, message)
 
-        # Broadcast message with timestamp
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "chat_message",
-                "sender": self.current_user.username,
-                "message": message,
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+class AsyncORMPrivateChatConsumer(PrivateChatConsumer):
+    """
+    PrivateChatConsumer resolving the room, loading history and saving
+    messages through Django's async ORM rather than one database_sync_to_async
+    call each. Served at ws/private/<username>/ when CHAT_CONSUMER_ORM is
+    "async". Django still runs each async query on a thread, outside
+    CHAT_DB_THREADS, so this swaps one hop per operation for one per query.
+    """
+
+    async def resolve(self, user, other_username):
+        return await PrivateRoom.aresolve(user, other_username)
+
+    async def load_history(self, conversation, cursor, limit):
+        return await conversation.ahistory_page(before=cursor, limit=limit)
+
+    async def load_after(self, conversation, after, limit):
+        return await conversation.amessages_after(after, limit=limit)
+
+    async def create_message(self, room, content):
+        return await room.acreate_message(content)
+
+
+def private_chat_consumer():
+    """The ws/private/ consumer class CHAT_CONSUMER_ORM picks."""
+    if getattr(settings, "CHAT_CONSUMER_ORM", "sync") == "async":
+        return AsyncORMPrivateChatConsumer
+    return PrivateChatConsumer
+
+
+class ChatConsumer(BaseChatConsumer):
+    """
+    One socket per user, at ws/chat/, multiplexing any number of
+    conversations.
+
+    The client opens a conversation with
+    {"type": "subscribe", "peer": <username>}, or a group room it is a
+    member of with {"type": "subscribe", "room": <id>}, and gets back its
+    history tagged with the room id; every later frame for that
+    conversation carries the same "room". Adding "after": <message id> to
+    the subscribe frame resumes it instead, with a "resume" frame of just
+    the messages after that one. Messages for private conversations that
+    aren't open arrive as "notify" frames.
+    """
+
+    async def connect(self):
+        self.current_user = self.scope['user']
+        if not self.current_user.is_authenticated:
+            await self.close()
+            return
+        self.subscriptions = {}  # room id -> PrivateRoom or GroupRoom
+        await self.join_user_group()
+        await self.accept_connection()
+        await presence.tracker.connect(self.current_user, self.channel_name)
+
+    async def disconnect(self, close_code):
+        for room in getattr(self, "subscriptions", {}).values():
+            await self.channel_layer.group_discard(
+                room.group_name, self.channel_name
+            )
+        await super().disconnect(close_code)
+
+    async def handle(self, data):
+        kind = data.get("type")
+        if kind == "subscribe":
+            if data.get("room") is not None:
+                await self.subscribe_group(data["room"], data.get("after"))
+            else:
+                await self.subscribe(data.get("peer"), data.get("after"))
+            return
+
+        room = self.subscriptions.get(data.get("room"))
+        if room is None:
+            await self.send_frame(
+                {"type": "error", "error": "not subscribed", "room": data.get("room")}
+            )
+        elif kind == "unsubscribe":
+            del self.subscriptions[room.id]
+            await self.channel_layer.group_discard(room.group_name, self.channel_name)
+        elif kind == "history":
+            if data.get("cursor"):
+                await self.send_history(
+                    room, "history_page", data["cursor"], data.get("limit"),
+                    room=room.id,
+                )
+        elif kind == "resume":
+            await self.send_resume(
+                room, data.get("after"), data.get("limit"), room=room.id
+            )
+        elif kind == "read":
+            await self.mark_read(room, data.get("up_to"))
+        elif kind == "message":
+            await self.post_message(room, data.get("message"))
+
+    async def subscribe(self, peer, after=None):
+        if not isinstance(peer, str) or peer == self.current_user.username:
+            await self.send_frame(
+                {"type": "error", "error": "unknown user", "peer": peer}
+            )
+            return
+        room = await db_call(PrivateRoom.resolve)(self.current_user, peer)
+        if room is None:
+            await self.send_frame(
+                {"type": "error", "error": "unknown user", "peer": peer}
+            )
+            return
+        if await self.add_subscription(room, peer=peer):
+            context = {
+                "room": room.id,
+                "peer": peer,
+                "peer_online": await presence.tracker.is_online(room.other_user.id),
             }
-        )
+            if after is not None:
+                await self.send_resume(room, after, **context)
+            else:
+                await self.send_history(room, "history", **context)
+
+    async def subscribe_group(self, room_id, after=None):
+        room = None
+        if isinstance(room_id, int):
+            room = await db_call(GroupRoom.resolve)(self.current_user, room_id)
+        if room is None:
+            await self.send_frame(
+                {"type": "error", "error": "not a member", "room": room_id}
+            )
+            return
+        if await self.add_subscription(room, room=room_id):
+            context = {"room": room.id, "title": room.room.title}
+            if after is not None:
+                await self.send_resume(room, after, **context)
+            else:
+                await self.send_history(room, "history", **context)
+
+    async def add_subscription(self, conversation, **context):
+        if conversation.id not in self.subscriptions:
+            limit = getattr(settings, "CHAT_MAX_SUBSCRIPTIONS", 100)
+            if len(self.subscriptions) >= limit:
+                await self.send_frame(
+                    {"type": "error", "error": "too many subscriptions", **context}
+                )
+                return False
+            self.subscriptions[conversation.id] = conversation
+            await self.channel_layer.group_add(
+                conversation.group_name, self.channel_name
+            )
+        return True
 
     async def chat_message(self, event):
-        """Send message to WebSocket."""
-        await self.send(text_data=json.dumps({
-            "sender": event["sender"],
-            "message": event["message"],
-            "timestamp": event.get("timestamp")
-        }))
-
-    @database_sync_to_async
-    def get_saved_messages(self, user1_username, user2_username):
-        """Load chat history between 2 users."""
-        try:
-            user1 = User.objects.get(username=user1_username)
-            user2 = User.objects.get(username=user2_username)
-        except User.DoesNotExist:
-            return []
-
-        room = self.get_or_create_room(user1, user2)
-        messages = Message.objects.filter(conversation=room).order_by("time_stamp")
-        return [
-            {
-                "sender": m.sender.username,
-                "content": m.message,
-                "timestamp": m.time_stamp.strftime("%Y-%m-%d %H:%M:%S")
-            }
-            for m in messages
-        ]
-
-    @database_sync_to_async
-    def save_message(self, sender_username, recipient_username, content):
-        sender = User.objects.get(username=sender_username)
-        recipient = User.objects.get(username=recipient_username)
-        room = self.get_or_create_room(sender, recipient)
-        Message.objects.create(sender=sender, recipient=recipient, conversation=room, message=content)
-
-    def get_room_name(self, u1, u2):
-        """Deterministic name so both users join same room."""
-        return "_".join(sorted([u1, u2]))
-
-    def get_or_create_room(self, user1, user2):
-        name = self.get_room_name(user1.username, user2.username)
-        room, _ = ChatRoom.objects.get_or_create(name=name)
-        return room
+        if event["room"] in self.subscriptions:
+            await super().chat_message(event)
+
+    async def chat_batch(self, event):
+        if event["room"] in self.subscriptions:
+            await super().chat_batch(event)
+
+    async def room_members(self, event):
+        room = self.subscriptions.get(event["room"])
+        if room is None:
+            return
+        if event["user_id"] == self.current_user.id and not event["joined"]:
+            del self.subscriptions[room.id]
+            await self.channel_layer.group_discard(room.group_name, self.channel_name)
+        await super().room_members(event)
+
+    async def chat_notify(self, event):
+        """A message in a conversation this socket hasn't opened."""
+        if event["room"] not in self.subscriptions:
+            await self.send_frame({
+                "type": "notify",
+                "room": event["room"],
+                "id": event.get("id"),
+                "sender": event["sender"],
+                "sender_id": event.get("sender_id"),
+                "message": event["message"],
+                "timestamp": event.get("timestamp")
+            })
+
+    async def read_receipt(self, event):
+        if event["reader"] == self.current_user.username:
+            return
+        if event["room"] not in self.subscriptions:
+            return
+        await self.send_frame({
+            "type": "read",
+            "room": event["room"],
+            "reader": event["reader"],
+            "reader_id": event.get("reader_id"),
+            "up_to": event["up_to"]
+        })
+
+
+class GroupChatConsumer(BaseChatConsumer):
+    """One socket per group room, at ws/room/<room id>/; members only."""
+
+    async def connect(self):
+        self.current_user = self.scope['user']
+        room_id = int(self.scope['url_route']['kwargs']['room_id'])
+        self.conversation = None
+        if self.current_user.is_authenticated:
+            self.conversation = await db_call(GroupRoom.resolve)(
+                self.current_user, room_id
+            )
+        if self.conversation is None:
+            await self.close()
+            return
+        self.room_group_name = self.conversation.group_name
+
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.accept_connection()
+        await presence.tracker.connect(self.current_user, self.channel_name)
+        after = self.resume_point()
+        context = {"room": room_id, "title": self.conversation.room.title}
+        if after is not None:
+            await self.send_resume(self.conversation, after, **context)
+        else:
+            await self.send_history(self.conversation, "history", **context)
+
+    async def disconnect(self, close_code):
+        if hasattr(self, "room_group_name"):
+            await self.channel_layer.group_discard(
+                self.room_group_name, self.channel_name
+            )
+        await super().disconnect(close_code)
+
+    async def handle(self, data):
+        if data.get("type") == "history":
+            if data.get("cursor"):
+                await self.send_history(
+                    self.conversation, "history_page", data["cursor"],
+                    data.get("limit"), room=self.conversation.id,
+                )
+        elif data.get("type") == "resume":
+            await self.send_resume(
+                self.conversation, data.get("after"), data.get("limit"),
+                room=self.conversation.id,
+            )
+        else:
+            await self.post_message(self.conversation, data.get("message"))
+
+    async def room_members(self, event):
+        if event["user_id"] == self.current_user.id and not event["joined"]:
+            await self.close()
+            return
+        await super().room_members(event)
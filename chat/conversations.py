@@ -0,0 +1,181 @@
+"""
+Per-user conversation summaries backing the recent chats page.
+
+Each private room has one Conversation row per participant holding the
+last message, its timestamp and the owner's unread count. Rows are
+updated as messages are saved, so listing recent chats is one indexed
+query instead of a scan over everything the user ever sent or received.
+"""
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import (
+    BigIntegerField,
+    Case,
+    Count,
+    F,
+    OuterRef,
+    Q,
+    Subquery,
+    Value,
+    When,
+)
+from django.db.models.functions import Greatest
+
+from . import history
+from .models import ChatRoom, Conversation, Message
+
+
+def record_messages(messages):
+    """Fold freshly saved messages into their rooms' summaries, one UPDATE a room."""
+    for room_id, latest, unread in summaries(messages):
+        changes = summary_changes(latest, unread)
+        if Conversation.objects.filter(room_id=room_id).update(**changes) < 2:
+            create_missing(room_id, latest, unread)
+
+
+async def arecord_messages(messages):
+    """record_messages through the async ORM."""
+    for room_id, latest, unread in summaries(messages):
+        changes = summary_changes(latest, unread)
+        if await Conversation.objects.filter(room_id=room_id).aupdate(**changes) < 2:
+            await acreate_missing(room_id, latest, unread)
+
+
+def summaries(messages):
+    """(room id, latest message, {recipient id: unread}) per private room."""
+    by_room = defaultdict(list)
+    for message in messages:
+        if message.conversation_id and message.recipient_id:
+            by_room[message.conversation_id].append(message)
+
+    for room_id, batch in by_room.items():
+        latest = max(batch, key=lambda m: (m.time_stamp, m.id))
+        yield room_id, latest, Counter(m.recipient_id for m in batch if not m.is_read)
+
+
+def summary_changes(latest, unread):
+    # Concurrent writers may land out of order; only move "last" forward
+    newer = Q(last_time_stamp__lte=latest.time_stamp)
+    changes = {
+        "last_message_id": Case(
+            When(newer, then=Value(latest.id)),
+            default=F("last_message_id"),
+            output_field=BigIntegerField(),
+        ),
+        "last_time_stamp": Case(
+            When(newer, then=Value(latest.time_stamp)), default=F("last_time_stamp")
+        ),
+    }
+    if unread:
+        changes["unread_count"] = F("unread_count") + Case(
+            *[When(owner_id=owner, then=Value(n)) for owner, n in unread.items()],
+            default=Value(0),
+        )
+    return changes
+
+
+def mark_read(owner, room, count):
+    """Take `count` newly read messages off the owner's unread counter."""
+    Conversation.objects.filter(owner=owner, room=room).update(
+        unread_count=Greatest(F("unread_count") - count, 0)
+    )
+
+
+def unread_counts(user):
+    """{other_user_id: unread} for every conversation of `user` with unread messages."""
+    return dict(
+        Conversation.objects.filter(owner=user, unread_count__gt=0)
+        .values_list("other_user_id", "unread_count")
+    )
+
+
+def create_missing(room_id, latest, unread):
+    """First message in a room: create whichever participant rows don't exist yet."""
+    owners = Conversation.objects.filter(room_id=room_id)
+    owners = owners.values_list("owner_id", flat=True)
+    rows = missing_rows(room_id, latest, unread, set(owners))
+    Conversation.objects.bulk_create(rows, ignore_conflicts=True)
+
+
+async def acreate_missing(room_id, latest, unread):
+    owners = Conversation.objects.filter(room_id=room_id)
+    owners = owners.values_list("owner_id", flat=True)
+    existing = {owner async for owner in owners}
+    rows = missing_rows(room_id, latest, unread, existing)
+    await Conversation.objects.abulk_create(rows, ignore_conflicts=True)
+
+
+def missing_rows(room_id, latest, unread, existing):
+    pair = (latest.sender_id, latest.recipient_id)
+    return [
+        Conversation(
+            owner_id=owner,
+            other_user_id=other,
+            room_id=room_id,
+            last_message=latest,
+            last_time_stamp=latest.time_stamp,
+            unread_count=unread.get(owner, 0),
+        )
+        for owner, other in (pair, pair[::-1])
+        if owner not in existing
+    ]
+
+
+def rebuild(batch_size=5000):
+    """Recompute every Conversation row from Message; for backfills and seeded data."""
+    latest = Message.objects.filter(conversation=OuterRef("pk"))
+    latest = latest.order_by("-time_stamp", "-id")
+    last_ids = (
+        ChatRoom.objects.annotate(last_id=Subquery(latest.values("id")[:1]))
+        .exclude(last_id=None)
+        .values_list("last_id", flat=True)
+    )
+    unread = {
+        (row["conversation"], row["recipient"]): row["n"]
+        for row in Message.objects.filter(is_read=False, recipient__isnull=False)
+        .values("conversation", "recipient")
+        .annotate(n=Count("id"))
+    }
+    with transaction.atomic():
+        Conversation.objects.all().delete()
+        rows = []
+        last_messages = Message.objects.filter(id__in=last_ids, recipient__isnull=False)
+        for message in last_messages.iterator():
+            pair = (message.sender_id, message.recipient_id)
+            for owner, other in (pair, pair[::-1]):
+                rows.append(Conversation(
+                    owner_id=owner,
+                    other_user_id=other,
+                    room_id=message.conversation_id,
+                    last_message=message,
+                    last_time_stamp=message.time_stamp,
+                    unread_count=unread.get((message.conversation_id, owner), 0),
+                ))
+        Conversation.objects.bulk_create(rows, batch_size=batch_size)
+
+
+def recent_for(user, before=None, limit=None):
+    """
+    Return (conversations, cursor) for `user`, most recently active first.
+    Keyset-paginated on (last_time_stamp, id) like chat history.
+    """
+    limit = limit or getattr(settings, "CHAT_RECENT_CHATS_PAGE_SIZE", 50)
+    qs = Conversation.objects.filter(owner=user)
+    if before:
+        stamp, pk = history.decode_cursor(before)
+        qs = qs.filter(
+            Q(last_time_stamp__lt=stamp) | Q(last_time_stamp=stamp, id__lt=pk)
+        )
+
+    rows = list(
+        qs.select_related("other_user", "last_message", "room")
+        .order_by("-last_time_stamp", "-id")[:limit + 1]
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    cursor = None
+    if has_more:
+        cursor = history.encode_cursor(rows[-1].last_time_stamp, rows[-1].id)
+    return rows, cursor
@@ -0,0 +1,107 @@
+"""
+The threads chat database calls run on.
+
+channels' database_sync_to_async is thread-sensitive. Outside a Django
+request, every call from every consumer in the process queues for the same
+single thread. So the database sees one query at a time no matter how many
+connections it could take. With CHAT_DB_THREADS > 0, db_call() runs calls
+on a dedicated pool of that many threads instead. Each thread holds its own
+connection, so size it to the connections one worker may use:
+DB_POOL_MAX_SIZE with the pool, otherwise the worker's share of the
+server's max_connections. 0 (the default) keeps channels' behaviour.
+
+Either way `metrics` counts the calls, how many are waiting for a thread
+right now ("queued") and at most ("peak_queued"), and how long they waited
+in total and at worst ("wait_seconds", "max_wait_seconds"). When the queue
+and the waits keep growing, the database side is the bottleneck.
+"""
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+metrics = Counter()
+lock = threading.Lock()
+
+
+def threads():
+    return getattr(settings, "CHAT_DB_THREADS", 0)
+
+
+class Pool:
+    """The process-wide executor, rebuilt when CHAT_DB_THREADS changes."""
+
+    def __init__(self):
+        self.size = 0
+        self.executor = None
+
+    def get(self):
+        size = threads()
+        if size <= 0:
+            return None
+        with lock:
+            if self.size != size:
+                self.shutdown()
+                self.executor = ThreadPoolExecutor(
+                    max_workers=size, thread_name_prefix="chat-db"
+                )
+                self.size = size
+            return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.size = 0
+        self.executor = None
+
+
+pool = Pool()
+
+
+class Wait:
+    """One call's time in the queue, until a thread picks it up or it is cancelled."""
+
+    def __init__(self):
+        self.queued_at = time.perf_counter()
+        self.waiting = True
+        with lock:
+            metrics["calls"] += 1
+            metrics["queued"] += 1
+            metrics["peak_queued"] = max(metrics["peak_queued"], metrics["queued"])
+
+    def end(self):
+        with lock:
+            if not self.waiting:
+                return
+            self.waiting = False
+            waited = time.perf_counter() - self.queued_at
+            metrics["queued"] -= 1
+            metrics["wait_seconds"] += waited
+            metrics["max_wait_seconds"] = max(metrics["max_wait_seconds"], waited)
+
+
+def db_call(func):
+    """database_sync_to_async(func), timed, on the chat threads if CHAT_DB_THREADS."""
+    @wraps(func)
+    def started(wait, *args, **kwargs):
+        wait.end()
+        return func(*args, **kwargs)
+
+    executor = pool.get()
+    if executor is None:
+        call = DatabaseSyncToAsync(started)
+    else:
+        call = DatabaseSyncToAsync(started, thread_sensitive=False, executor=executor)
+
+    async def run(*args, **kwargs):
+        wait = Wait()
+        try:
+            return await call(wait, *args, **kwargs)
+        finally:
+            wait.end()
+
+    return run
@@ -0,0 +1,45 @@
+"""
+Prefix search over usernames for the "Available Users" page.
+
+Results are keyset-paginated by username and only fetch the columns the
+page shows, so the cost of a page doesn't grow with the number of accounts.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+User = get_user_model()
+
+FIELDS = ("id", "username", "last_login")
+
+# Sorts after any character a username can contain
+PREFIX_END = "\U0010ffff"
+
+
+def queryset(exclude=None, prefix="", after=None):
+    qs = User.objects.all()
+    if exclude is not None:
+        qs = qs.exclude(id=exclude.id)
+    if prefix:
+        # The range lets any backend seek the username index; startswith
+        # keeps the match exact where collation order differs from bytes
+        qs = qs.filter(
+            username__gte=prefix,
+            username__lt=prefix + PREFIX_END,
+            username__startswith=prefix,
+        )
+    if after:
+        qs = qs.filter(username__gt=after)
+    return qs.order_by("username").values(*FIELDS)
+
+
+def search(exclude=None, prefix="", after=None, limit=None):
+    """
+    Return (users, next_after) where `users` are dicts of FIELDS ordered by
+    username and `next_after` is the username to pass as `after` for the
+    next page, or None on the last page.
+    """
+    limit = limit or getattr(settings, "CHAT_DIRECTORY_PAGE_SIZE", 50)
+    rows = list(queryset(exclude, prefix, after)[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return rows, rows[-1]["username"] if has_more else None
@@ -0,0 +1,135 @@
+"""
+Multi-member chat rooms, keyed by ChatRoom id.
+
+Membership lives in ChatRoom.participants. Sockets check it against a
+cached frozenset of member ids ("chat:members:<room id>", kept for
+CHAT_GROUP_MEMBERS_CACHE_TTL seconds) instead of querying on every
+message. join() and leave() drop the cached set once their transaction
+commits and tell the room's sockets, so a member who leaves stops
+receiving the room straight away. Configure a cache shared between
+workers to make the invalidation reach all of them; otherwise other
+workers catch up when their copy expires.
+
+Messages to a group are handed to the process-wide `fanout` batcher,
+which sends everything posted to a room within CHAT_GROUP_BATCH_WINDOW
+seconds as one group_send. With thousands of members that is one trip
+through the channel layer per batch rather than per message.
+"""
+import asyncio
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from . import wire
+from .dbexecutor import db_call
+from .models import ChatRoom
+
+
+def setting(name, default):
+    return getattr(settings, f"CHAT_GROUP_{name}", default)
+
+
+def group_name(room_id):
+    """Channel layer group every socket with the room open joins."""
+    return f"chat_room_{room_id}"
+
+
+def members_key(room_id):
+    return f"chat:members:{room_id}"
+
+
+def load_members(room_id):
+    rows = ChatRoom.participants.through.objects.filter(chatroom_id=room_id)
+    members = frozenset(rows.values_list("user_id", flat=True))
+    cache.set(members_key(room_id), members, timeout=setting("MEMBERS_CACHE_TTL", 60))
+    return members
+
+
+def member_ids(room_id):
+    members = cache.get(members_key(room_id))
+    return members if members is not None else load_members(room_id)
+
+
+async def amember_ids(room_id):
+    members = await cache.aget(members_key(room_id))
+    if members is None:
+        members = await db_call(load_members)(room_id)
+    return members
+
+
+def create(owner, title, members=()):
+    """Create a group room owned by `owner` with `members` in it."""
+    with transaction.atomic():
+        room = ChatRoom.objects.create(title=title, is_group=True)
+        room.participants.add(owner, *members)
+    return room
+
+
+def join(room, user):
+    room.participants.add(user)
+    membership_changed(room.id, user, joined=True)
+
+
+def leave(room, user):
+    room.participants.remove(user)
+    membership_changed(room.id, user, joined=False)
+
+
+def membership_changed(room_id, user, joined):
+    """Once committed, drop the cached member set and tell the room's open sockets."""
+    event = {
+        "type": "room_members",
+        "room": room_id,
+        "user": user.username,
+        "user_id": user.id,
+        "joined": joined,
+    }
+
+    def notify():
+        cache.delete(members_key(room_id))
+        async_to_sync(get_channel_layer().group_send)(group_name(room_id), event)
+    transaction.on_commit(notify)
+
+
+class FanOut:
+    """Per-room batching of outbound group messages; used from the event loop."""
+
+    def __init__(self):
+        self.pending = {}  # room id -> [encoded frames]
+        self.timer = None
+        self.timer_loop = None
+        self.tasks = set()
+
+    def add(self, room_id, frame):
+        batch = self.pending.setdefault(room_id, [])
+        batch.append(wire.encode_once(frame))
+        loop = asyncio.get_running_loop()
+        if len(batch) >= setting("BATCH_SIZE", 50):
+            self.spawn_flush()
+        elif self.timer is None or self.timer_loop is not loop:
+            self.timer_loop = loop
+            window = setting("BATCH_WINDOW", 0.01)
+            self.timer = loop.call_later(window, self.spawn_flush)
+
+    def spawn_flush(self):
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, {}
+        layer = get_channel_layer()
+        for room_id, frames in pending.items():
+            await layer.group_send(
+                group_name(room_id),
+                {"type": "chat_batch", "room": room_id, "frames": frames},
+            )
+
+
+fanout = FanOut()
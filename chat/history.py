@@ -0,0 +1,210 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from . import wire
+from .models import Message
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(stamp, pk):
+    """Opaque cursor just before the row at (stamp, pk) in (timestamp, id) order."""
+    raw = f"{stamp.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        stamp, pk = raw.rsplit("|", 1)
+        return datetime.fromisoformat(stamp), int(pk)
+    except (binascii.Error, UnicodeError, ValueError, AttributeError):
+        raise InvalidCursor(cursor) from None
+
+
+def clamp_limit(limit):
+    default = getattr(settings, "CHAT_HISTORY_PAGE_SIZE", 50)
+    maximum = getattr(settings, "CHAT_HISTORY_MAX_PAGE_SIZE", 200)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(limit, maximum))
+
+
+def fetch_page(room, before=None, limit=None):
+    """
+    Return (messages, cursor) for the newest `limit` messages of `room`
+    older than `before`. Messages come back oldest first; `cursor` is None
+    when there is nothing older left.
+
+    Uses a keyset seek on (time_stamp, id) so the cost does not depend on
+    how deep into the conversation the page is.
+    """
+    limit = clamp_limit(limit)
+    return to_page(list(page_query(room, before)[:limit + 1]), limit)
+
+
+async def afetch_page(room, before=None, limit=None):
+    """fetch_page through the async ORM."""
+    limit = clamp_limit(limit)
+    rows = page_query(room, before)[:limit + 1]
+    return to_page([message async for message in rows], limit)
+
+
+def page_query(room, before):
+    qs = Message.objects.filter(conversation=room)
+    if before:
+        stamp, pk = decode_cursor(before)
+        qs = qs.filter(Q(time_stamp__lt=stamp) | Q(time_stamp=stamp, id__lt=pk))
+    return qs.select_related("sender").order_by("-time_stamp", "-id")
+
+
+def to_page(rows, limit):
+    """(rows oldest first, cursor) from up to limit + 1 rows fetched newest first."""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    cursor = encode_cursor(rows[-1].time_stamp, rows[-1].id) if has_more else None
+    rows.reverse()
+    return rows, cursor
+
+
+def fetch_after(room, after, limit=None):
+    """
+    Return (messages, more) for up to `limit` messages of `room` with ids
+    greater than `after`, oldest first; `more` says whether there are
+    newer ones still to fetch.
+
+    This is how a reconnecting client catches up: one range scan over the
+    (conversation, id) index starting at the last message it saw.
+    """
+    qs = after_query(room, after)
+    limit = clamp_limit(limit)
+    rows = list(qs[:limit + 1])
+    return rows[:limit], len(rows) > limit
+
+
+async def afetch_after(room, after, limit=None):
+    """fetch_after through the async ORM."""
+    qs = after_query(room, after)
+    limit = clamp_limit(limit)
+    rows = [message async for message in qs[:limit + 1]]
+    return rows[:limit], len(rows) > limit
+
+
+def after_query(room, after):
+    try:
+        after = int(after)
+    except (TypeError, ValueError):
+        raise InvalidCursor(after) from None
+    qs = Message.objects.filter(conversation=room, id__gt=after)
+    return qs.select_related("sender").order_by("id")
+
+
+def stream_json(room, chunk_size=None):
+    """
+    The whole history of `room` as one JSON "history" frame, in the format
+    JSON websocket clients get, yielded a chunk of messages at a time.
+
+    Rows are read as tuples, sender name joined in the same query, through
+    a server-side cursor `chunk_size` at a time, so neither Message
+    instances nor the whole room are ever held in memory.
+    """
+    export = JSONExport(room, chunk_size)
+    yield export.start()
+    for row in export.rows().iterator(chunk_size=export.chunk_size):
+        chunk = export.add(row)
+        if chunk:
+            yield chunk
+    yield export.end()
+
+
+async def astream_json(room, chunk_size=None):
+    """
+    stream_json for ASGI, where StreamingHttpResponse would read a sync
+    iterator into memory whole. Each chunk of rows is fetched on a thread,
+    as QuerySet.aiterator() does; aiterator() itself can't be used because
+    values_list() runs its query as soon as it is iterated, on the event loop.
+    """
+    export = JSONExport(room, chunk_size)
+    rows = export.rows().iterator(chunk_size=export.chunk_size)
+    next_rows = sync_to_async(lambda: list(islice(rows, export.chunk_size)))
+    yield export.start()
+    while batch := await next_rows():
+        for row in batch:
+            chunk = export.add(row)
+            if chunk:
+                yield chunk
+    yield export.end()
+
+
+class JSONExport:
+    """Builds the export frame for stream_json and astream_json, chunk by chunk."""
+
+    def __init__(self, room, chunk_size=None):
+        self.room = room
+        self.chunk_size = chunk_size or getattr(
+            settings, "CHAT_HISTORY_EXPORT_CHUNK_SIZE", 2000
+        )
+        # Looked up once: timezone.localtime() would fetch it again for every row
+        self.tz = timezone.get_current_timezone()
+        self.chunk = []
+        self.separator = ""
+
+    def rows(self):
+        return (
+            Message.objects.filter(conversation=self.room)
+            .order_by("time_stamp", "id")
+            .values_list("id", "sender__username", "message", "time_stamp")
+        )
+
+    def start(self):
+        return f'{{"type": "history", "room": {self.room.id}, "messages": ['
+
+    def add(self, row):
+        """Add a row; returns the chunk once `chunk_size` rows built up, else None."""
+        pk, sender, content, stamp = row
+        timestamp = stamp.astimezone(self.tz).strftime(wire.TIMESTAMP_FORMAT)
+        self.chunk.append(
+            self.separator + json.dumps({
+                "id": pk, "sender": sender, "content": content, "timestamp": timestamp,
+            })
+        )
+        self.separator = ", "
+        if len(self.chunk) < self.chunk_size:
+            return None
+        chunk, self.chunk = "".join(self.chunk), []
+        return chunk
+
+    def end(self):
+        return "".join(self.chunk) + "]}"
+
+
+def serialize(message):
+    return {
+        "id": message.id,
+        "sender": message.sender.username,
+        "content": message.message,
+        "timestamp": message.time_stamp.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def entry(message):
+    """A message as the consumers put it in frames; chat.wire encodes it per client."""
+    return {
+        "id": message.id,
+        "sender": message.sender.username,
+        "sender_id": message.sender_id,
+        "content": message.message,
+        "timestamp": wire.epoch(message.time_stamp),
+    }
@@ -0,0 +1,280 @@
+"""
+Cache of the newest messages of recently opened rooms.
+
+Opening a conversation sends its newest history page. For busy rooms that
+is the same query over and over, so the first page is served from the
+last CHAT_HISTORY_CACHE_SIZE messages of each room, kept as ready-made
+history entries. Rooms are loaded on a miss and then kept current by
+append() as messages are saved, instead of being reloaded.
+
+With CHAT_HISTORY_CACHE_BACKEND = "local" the rooms live in
+this process, at most CHAT_HISTORY_CACHE_ROOMS of them with the least
+recently opened evicted first, each for CHAT_HISTORY_CACHE_TTL seconds.
+A process only sees the messages it saved itself, so with several
+workers a room can miss other workers' messages until it expires. The
+"cache" backend keeps rooms in the Django cache instead, shared by every
+worker; it is the default when CACHE_URL is set, and without it a
+multi-worker deployment defaults to no cache at all. The cache API has no
+compare-and-set, so two workers appending at once could lose a message.
+For that reason a save invalidates the shared copy rather than appending
+to it.
+
+A message saved while a miss is loading its room may be missing from the
+loaded snapshot, and append() can't add it to a room that isn't cached
+yet. So each room has a generation that every save changes: the local
+backend skips storing a snapshot whose generation moved during the load,
+and the shared backend only serves a room stored under the current one.
+
+A CHAT_HISTORY_CACHE_SIZE of 0 turns the cache off. Hits, misses,
+evictions and discarded stale loads are counted in `metrics`.
+
+Local rooms are read from the event loop and, with CHAT_DB_THREADS, written
+from the database threads too, so `lock` guards them.
+"""
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import history
+
+metrics = Counter()
+lock = threading.Lock()
+
+LOCAL = "local"
+SHARED = "cache"
+
+
+def setting(name, default):
+    return getattr(settings, f"CHAT_HISTORY_CACHE_{name}", default)
+
+
+def cache_key(room_id):
+    return f"chat:history:{room_id}"
+
+
+def generation_key(room_id):
+    return f"chat:history:generation:{room_id}"
+
+
+def sort_key(message):
+    """History order, which is also the order cursors walk."""
+    return message.time_stamp, message.id
+
+
+class RoomHistory:
+    """The newest messages of one room as (sort key, entry) pairs, oldest first."""
+
+    def __init__(self, items, complete, size):
+        self.items = deque(items, maxlen=size)
+        self.complete = complete  # True while the room has no messages older than these
+        self.expires = time.monotonic() + setting("TTL", 60)
+        self.generation = None  # the room's generation when it was loaded
+
+    @classmethod
+    def load(cls, messages, cursor, size):
+        """A room from history.fetch_page's newest page of `size` messages."""
+        items = ((sort_key(m), history.entry(m)) for m in messages)
+        return cls(items, cursor is None, size)
+
+    def page(self, limit):
+        """(entries, cursor) exactly as history.fetch_page returns the newest page."""
+        with lock:
+            held = list(self.items)
+            complete = self.complete
+        items = held[-limit:]
+        has_more = len(held) > limit or not complete
+        cursor = history.encode_cursor(*items[0][0]) if has_more and items else None
+        return [entry for _, entry in items], cursor
+
+    def append(self, key, entry):
+        """
+        Add a newer message; False if it doesn't sort after the ones held, so
+        the room must be reloaded.
+        """
+        if self.items and key < self.items[-1][0]:
+            return False
+        if len(self.items) == self.items.maxlen:
+            self.complete = False
+        self.items.append((key, entry))
+        return True
+
+
+class LocalRooms:
+    """Per-process LRU of RoomHistory objects by room id."""
+
+    # Generations are counted in a fixed number of slots shared by room id,
+    # so they take no memory per room; a shared slot can only skip a put
+    SLOTS = 4096
+
+    def __init__(self):
+        self.rooms = OrderedDict()
+        self.generations = [0] * self.SLOTS
+
+    def generation(self, room_id):
+        with lock:
+            return self.generations[hash(room_id) % self.SLOTS]
+
+    def get(self, room_id):
+        with lock:
+            room = self.rooms.get(room_id)
+            if room is None:
+                return None
+            if room.expires < time.monotonic():
+                del self.rooms[room_id]
+                return None
+            self.rooms.move_to_end(room_id)
+            return room
+
+    def put(self, room_id, room, generation):
+        with lock:
+            if self.generations[hash(room_id) % self.SLOTS] != generation:
+                metrics["stale"] += 1
+                return
+            self.rooms[room_id] = room
+            self.rooms.move_to_end(room_id)
+            while len(self.rooms) > setting("ROOMS", 1000):
+                self.rooms.popitem(last=False)
+                metrics["evicted"] += 1
+
+    def append(self, room_id, key, entry):
+        with lock:
+            self.generations[hash(room_id) % self.SLOTS] += 1
+            room = self.rooms.get(room_id)
+            if room is not None and not room.append(key, entry):
+                del self.rooms[room_id]
+
+    # Nothing to wait for in memory; these match SharedRooms for the async path
+    async def aget(self, room_id):
+        return self.get(room_id)
+
+    async def ageneration(self, room_id):
+        return self.generation(room_id)
+
+    async def aput(self, room_id, room, generation):
+        self.put(room_id, room, generation)
+
+    async def aappend(self, room_id, key, entry):
+        self.append(room_id, key, entry)
+
+    def clear(self):
+        with lock:
+            self.rooms.clear()
+
+
+class SharedRooms:
+    """RoomHistory objects in the Django cache, served under their generation."""
+
+    @staticmethod
+    def current(room_id, found):
+        room = found.get(cache_key(room_id))
+        if room is None or room.generation != found.get(generation_key(room_id)):
+            return None
+        return room
+
+    def get(self, room_id):
+        keys = [cache_key(room_id), generation_key(room_id)]
+        return self.current(room_id, cache.get_many(keys))
+
+    def generation(self, room_id):
+        return cache.get(generation_key(room_id))
+
+    def put(self, room_id, room, generation):
+        room.generation = generation
+        cache.set(cache_key(room_id), room, timeout=setting("TTL", 60))
+
+    def append(self, room_id, _key, _entry):
+        # A fresh token rather than a counter: it needs no read, and a token
+        # lost to eviction can't come back to match an old room
+        cache.set(generation_key(room_id), uuid.uuid4().hex, timeout=None)
+
+    async def aget(self, room_id):
+        keys = [cache_key(room_id), generation_key(room_id)]
+        return self.current(room_id, await cache.aget_many(keys))
+
+    async def ageneration(self, room_id):
+        return await cache.aget(generation_key(room_id))
+
+    async def aput(self, room_id, room, generation):
+        room.generation = generation
+        await cache.aset(cache_key(room_id), room, timeout=setting("TTL", 60))
+
+    async def aappend(self, room_id, _key, _entry):
+        await cache.aset(generation_key(room_id), uuid.uuid4().hex, timeout=None)
+
+
+local_rooms = LocalRooms()
+shared_rooms = SharedRooms()
+
+
+def rooms():
+    return shared_rooms if setting("BACKEND", LOCAL) == SHARED else local_rooms
+
+
+def first_page(room, limit=None):
+    """The newest history page of `room` as (entries, cursor), cached when possible."""
+    limit = history.clamp_limit(limit)
+    size = setting("SIZE", 100)
+    if limit > size:
+        messages, cursor = history.fetch_page(room, limit=limit)
+        return [history.entry(m) for m in messages], cursor
+
+    backend = rooms()
+    cached = backend.get(room.id)
+    if cached is not None:
+        metrics["hits"] += 1
+        return cached.page(limit)
+
+    metrics["misses"] += 1
+    generation = backend.generation(room.id)
+    messages, cursor = history.fetch_page(room, limit=size)
+    cached = RoomHistory.load(messages, cursor, size)
+    backend.put(room.id, cached, generation)
+    return cached.page(limit)
+
+
+async def afirst_page(room, limit=None):
+    """first_page through the async ORM and cache APIs."""
+    limit = history.clamp_limit(limit)
+    size = setting("SIZE", 100)
+    if limit > size:
+        messages, cursor = await history.afetch_page(room, limit=limit)
+        return [history.entry(m) for m in messages], cursor
+
+    backend = rooms()
+    cached = await backend.aget(room.id)
+    if cached is not None:
+        metrics["hits"] += 1
+        return cached.page(limit)
+
+    metrics["misses"] += 1
+    generation = await backend.ageneration(room.id)
+    messages, cursor = await history.afetch_page(room, limit=size)
+    cached = RoomHistory.load(messages, cursor, size)
+    await backend.aput(room.id, cached, generation)
+    return cached.page(limit)
+
+
+def append(messages):
+    """Add just-saved messages to their rooms, if those rooms are cached."""
+    if setting("SIZE", 100) <= 0:
+        return
+    backend = rooms()
+    for message in messages:
+        if message.conversation_id is not None:
+            entry = history.entry(message)
+            backend.append(message.conversation_id, sort_key(message), entry)
+
+
+async def aappend(messages):
+    """append() for the async path."""
+    if setting("SIZE", 100) <= 0:
+        return
+    backend = rooms()
+    for message in messages:
+        if message.conversation_id is not None:
+            entry = history.entry(message)
+            await backend.aappend(message.conversation_id, sort_key(message), entry)
@@ -0,0 +1,254 @@
+"""
+Simulated chat clients for the `load` benchmark scenario.
+
+Clients log in through a real session cookie and talk to the whole ASGI
+stack (django_project.asgi.application, auth middleware included), either
+in-process through channels' WebsocketCommunicator or over TCP to a Daphne
+server started for the run. Each client opens the private conversation
+with its partner and then sends messages one after another, timing each
+from send to its own echo coming back.
+"""
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from importlib import import_module
+from unittest import mock
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.db.backends.utils import CursorWrapper
+
+# Seconds to wait for a handshake or a frame before giving up on the run
+TIMEOUT = 30
+
+
+def session_cookie(user):
+    """Save a logged-in session for `user`; returns the Cookie header for it."""
+    store = import_module(settings.SESSION_ENGINE).SessionStore()
+    store[SESSION_KEY] = str(user.pk)
+    store[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    store[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    store.save()
+    return f"{settings.SESSION_COOKIE_NAME}={store.session_key}"
+
+
+class InProcessClient:
+    def __init__(self, application, path, cookie):
+        headers = [(b"cookie", cookie.encode())]
+        self.communicator = WebsocketCommunicator(application, path, headers=headers)
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=TIMEOUT)
+        if not connected:
+            raise ConnectionError("socket refused")
+
+    async def send(self, frame):
+        await self.communicator.send_json_to(frame)
+
+    async def receive(self):
+        return await self.communicator.receive_json_from(timeout=TIMEOUT)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+def frame_queue_protocol():
+    """An autobahn client protocol (autobahn ships with Daphne) queueing frames."""
+    from autobahn.asyncio.websocket import WebSocketClientProtocol
+
+    class FrameQueueProtocol(WebSocketClientProtocol):
+        def __init__(self):
+            super().__init__()
+            self.opened = asyncio.get_running_loop().create_future()
+            self.frames = asyncio.Queue()
+
+        def onOpen(self):
+            self.opened.set_result(None)
+
+        def onMessage(self, payload, _is_binary):
+            self.frames.put_nowait(payload)
+
+        def onClose(self, _was_clean, code, reason):
+            if not self.opened.done():
+                error = ConnectionError(reason or f"closed with {code}")
+                self.opened.set_exception(error)
+
+    return FrameQueueProtocol
+
+
+class ServerClient:
+    """InProcessClient's interface over a real websocket to 127.0.0.1:`port`."""
+
+    def __init__(self, port, path, cookie):
+        from autobahn.asyncio.websocket import WebSocketClientFactory
+
+        self.port = port
+        self.factory = WebSocketClientFactory(
+            f"ws://127.0.0.1:{port}{path}", headers={"Cookie": cookie}
+        )
+        self.factory.protocol = frame_queue_protocol()
+        self.protocol = None
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        _, self.protocol = await loop.create_connection(
+            self.factory, "127.0.0.1", self.port
+        )
+        await asyncio.wait_for(self.protocol.opened, TIMEOUT)
+
+    async def send(self, frame):
+        self.protocol.sendMessage(json.dumps(frame).encode())
+
+    async def receive(self):
+        frame = await asyncio.wait_for(self.protocol.frames.get(), TIMEOUT)
+        return json.loads(frame)
+
+    async def close(self):
+        self.protocol.sendClose()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def daphne_server(env=None):
+    """Run django_project.asgi:application under Daphne on a free port; yields it."""
+    port = free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "daphne", "-b", "127.0.0.1", "-p", str(port),
+            "django_project.asgi:application",
+        ],
+        env={**os.environ, **(env or {})},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("Daphne did not start") from None
+                time.sleep(0.1)
+        yield port
+    finally:
+        process.terminate()
+        process.wait(timeout=TIMEOUT)
+
+
+def patch_cursor(wrap):
+    """Patch CursorWrapper.execute and executemany with wrap(method)."""
+    return mock.patch.multiple(
+        CursorWrapper,
+        execute=wrap(CursorWrapper.execute),
+        executemany=wrap(CursorWrapper.executemany),
+    )
+
+
+@contextmanager
+def counting_queries():
+    """Count SQL statements any thread in this process runs; yields [count]."""
+    count = [0]
+    lock = threading.Lock()
+
+    def wrap(method):
+        def counted(self, *args, **kwargs):
+            with lock:
+                count[0] += 1
+            return method(self, *args, **kwargs)
+        return counted
+
+    with patch_cursor(wrap):
+        yield count
+
+
+@contextmanager
+def query_latency(seconds):
+    """
+    Sleep `seconds` before every SQL statement any thread runs, as a network
+    round trip to the database would.
+    """
+    def wrap(method):
+        def delayed(self, *args, **kwargs):
+            time.sleep(seconds)
+            return method(self, *args, **kwargs)
+        return delayed
+
+    with patch_cursor(wrap):
+        yield
+
+
+class LoadResult:
+    def __init__(self):
+        self.connect_times = []
+        self.round_trips = []
+        self.resyncs = 0
+        self.elapsed = 0.0
+        self.queries = None
+        self.counts = {}
+
+
+async def run_load(make_client, pairs, messages, query_count=None, counters=None):
+    """
+    Open a client for each side of every (user, peer) pair, then have each
+    send `messages` messages, waiting for its own echo before the next.
+    Pass the list from counting_queries() as `query_count` to count the
+    queries run while messages are being sent, and any other one-item
+    counter lists by name in `counters` for result.counts.
+    """
+    result = LoadResult()
+
+    async def open_client(user, peer):
+        client = make_client(f"/ws/private/{peer.username}/", user)
+        started = time.perf_counter()
+        await client.connect()
+        await client.receive()  # history
+        result.connect_times.append(time.perf_counter() - started)
+        return user, client
+
+    async def chat(user, client):
+        for i in range(messages):
+            token = f"{user.username} {i}"
+            started = time.perf_counter()
+            await client.send({"message": token})
+            while True:
+                frame = await client.receive()
+                if frame.get("type") == "resync":
+                    # Fell behind and the echo was folded away; stop timing this one
+                    result.resyncs += 1
+                    break
+                if frame.get("message") == token:
+                    result.round_trips.append(time.perf_counter() - started)
+                    break
+
+    sides = [(user, peer) for a, b in pairs for user, peer in ((a, b), (b, a))]
+    clients = await asyncio.gather(
+        *(open_client(user, peer) for user, peer in sides)
+    )
+    queries_before = query_count[0] if query_count else 0
+    counts_before = {
+        name: counter[0] for name, counter in (counters or {}).items()
+    }
+    started = time.perf_counter()
+    await asyncio.gather(*(chat(user, client) for user, client in clients))
+    result.elapsed = time.perf_counter() - started
+    if query_count:
+        result.queries = query_count[0] - queries_before
+    result.counts = {
+        name: counters[name][0] - before for name, before in counts_before.items()
+    }
+    await asyncio.gather(*(client.close() for _, client in clients))
+    return result
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.benchmarks import SCENARIOS
+
+
+class Command(BaseCommand):
+    help = "Run a chat benchmark scenario and print its report."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "scenario", help=f"One of: {', '.join(sorted(SCENARIOS))}"
+        )
+        parser.add_argument("--repeat", type=int, default=50)
+        parser.add_argument("--messages", type=int, default=2000,
+                            help="Messages pushed through the consumer by load "
+                                 "scenarios.")
+        parser.add_argument("--users", type=int, default=1_000_000,
+                            help="Users to make sure exist for directory scenarios.")
+        parser.add_argument("--workers", type=int, default=4,
+                            help="Worker processes for multi-process scenarios.")
+        parser.add_argument("--shards", type=int, default=2,
+                            help="Local Redis stand-in shards when no shared channel "
+                                 "layer is configured.")
+        parser.add_argument("--compare", action="store_true",
+                            help="Also measure the baseline the scenario compares "
+                                 "against.")
+        parser.add_argument("--clients", type=int, default=50,
+                            help="Simulated websocket clients for the load scenario.")
+        parser.add_argument("--server", action="store_true",
+                            help="Also run the load scenario against a real Daphne "
+                                 "server.")
+        parser.add_argument("--db-latency", type=float, default=0,
+                            help="Milliseconds added to every SQL statement run "
+                                 "in-process, like a database across the network.")
+
+    def handle(self, *_args, **options):
+        try:
+            run = SCENARIOS[options["scenario"]]
+        except KeyError:
+            raise CommandError(
+                f"Unknown scenario {options['scenario']!r}; "
+                f"pick one of {sorted(SCENARIOS)}"
+            ) from None
+        run(self.stdout, options)
@@ -0,0 +1,40 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat import seed
+
+
+class Command(BaseCommand):
+    help = "Seed synthetic users, private rooms and messages for benchmarking."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--rooms", type=int, default=5000)
+        parser.add_argument("--messages", type=int, default=1_000_000)
+        parser.add_argument("--hot-room-share", type=float, default=0.1,
+                            help="Fraction of messages sent to one very long "
+                                 "conversation.")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *_args, **options):
+        rng = random.Random(options["seed"])
+        started = time.perf_counter()
+
+        users = seed.seed_users(options["users"], batch_size=options["batch_size"])
+        self.stdout.write(f"{len(users)} users")
+        rooms = seed.seed_rooms(users, options["rooms"], rng=rng)
+        self.stdout.write(f"{len(rooms)} rooms")
+        seed.seed_messages(
+            rooms,
+            options["messages"],
+            batch_size=options["batch_size"],
+            rng=rng,
+            hot_room_share=options["hot_room_share"],
+        )
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"{options['messages']} messages seeded in {elapsed:.1f}s"
+        ))
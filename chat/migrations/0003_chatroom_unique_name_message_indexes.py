@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:44
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def merge_duplicate_rooms(apps, _schema_editor):
+    """Fold rooms created twice by racing get_or_create calls into the oldest one."""
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Message = apps.get_model('chat', 'Message')
+    duplicates = (
+        ChatRoom.objects.values('name')
+        .annotate(n=models.Count('id'), keep=models.Min('id'))
+        .filter(n__gt=1)
+    )
+    for row in duplicates:
+        extra = ChatRoom.objects.filter(name=row['name']).exclude(id=row['keep'])
+        moved = Message.objects.filter(conversation__in=extra)
+        moved.update(conversation_id=row['keep'])
+        extra.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_alter_message_conversation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_rooms, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='chatroom',
+            name='name',
+            field=models.CharField(max_length=200, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(
+                fields=['conversation', 'time_stamp'], name='msg_conversation_ts'
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'time_stamp'], name='msg_sender_ts'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(
+                fields=['recipient', 'time_stamp'], name='msg_recipient_ts'
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(
+                fields=['recipient', 'is_read'], name='msg_recipient_unread'
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:46
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chatroom_unique_name_message_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='time_stamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,115 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:53
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_conversations(apps, _schema_editor):
+    """One Conversation per participant of every room that already has messages."""
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+
+    latest = Message.objects.filter(conversation=models.OuterRef('pk'))
+    latest = latest.order_by('-time_stamp', '-id')
+    last_ids = (
+        ChatRoom.objects.annotate(last_id=models.Subquery(latest.values('id')[:1]))
+        .exclude(last_id=None)
+        .values_list('last_id', flat=True)
+    )
+    unread = {
+        (row['conversation'], row['recipient']): row['n']
+        for row in Message.objects.filter(is_read=False, recipient__isnull=False)
+        .values('conversation', 'recipient')
+        .annotate(n=models.Count('id'))
+    }
+    rows = []
+    last_messages = Message.objects.filter(id__in=last_ids, recipient__isnull=False)
+    for message in last_messages.iterator():
+        pair = (message.sender_id, message.recipient_id)
+        for owner, other in (pair, pair[::-1]):
+            rows.append(Conversation(
+                owner_id=owner,
+                other_user_id=other,
+                room_id=message.conversation_id,
+                last_message_id=message.id,
+                last_time_stamp=message.time_stamp,
+                unread_count=unread.get((message.conversation_id, owner), 0),
+            ))
+    Conversation.objects.bulk_create(rows, batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_time_stamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                (
+                    'id',
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('last_time_stamp', models.DateTimeField()),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                (
+                    'last_message',
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name='+',
+                        to='chat.message',
+                    ),
+                ),
+                (
+                    'other_user',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='+',
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    'owner',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='conversations',
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    'room',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='summaries',
+                        to='chat.chatroom',
+                    ),
+                ),
+            ],
+            options={
+                'indexes': [
+                    models.Index(
+                        fields=['owner', '-last_time_stamp', '-id'],
+                        name='conversation_owner_recent',
+                    )
+                ],
+                'constraints': [
+                    models.UniqueConstraint(
+                        fields=('owner', 'room'), name='conversation_owner_room'
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,65 @@
+from django.db import migrations
+
+FTS_TABLE = 'chat_message_fts'
+
+SQLITE_CREATE = [
+    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+    "message, content='chat_message', content_rowid='id', "
+    "tokenize='porter unicode61')",
+    "CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_message BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, message) VALUES (new.id, new.message); END",
+    "CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_message BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message) "
+    "VALUES ('delete', old.id, old.message); END",
+    "CREATE TRIGGER chat_message_fts_update AFTER UPDATE OF message ON chat_message "
+    f"BEGIN INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message) "
+    "VALUES ('delete', old.id, old.message); "
+    f"INSERT INTO {FTS_TABLE}(rowid, message) VALUES (new.id, new.message); END",
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+]
+
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS chat_message_fts_insert",
+    "DROP TRIGGER IF EXISTS chat_message_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_message_fts_update",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+
+def search_index():
+    from django.contrib.postgres.indexes import GinIndex
+    from django.contrib.postgres.search import SearchVector
+
+    # Same expression chat.search queries with, so the planner can use it
+    return GinIndex(
+        SearchVector('message', config='english'), name='msg_message_search'
+    )
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for statement in SQLITE_CREATE:
+            schema_editor.execute(statement)
+    elif vendor == 'postgresql':
+        schema_editor.add_index(apps.get_model('chat', 'Message'), search_index())
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for statement in SQLITE_DROP:
+            schema_editor.execute(statement)
+    elif vendor == 'postgresql':
+        schema_editor.remove_index(apps.get_model('chat', 'Message'), search_index())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='is_group',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='title',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AlterField(
+            model_name='chatroom',
+            name='name',
+            field=models.CharField(blank=True, max_length=200, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:28
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_chatroom_groups'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(
+                fields=['conversation', 'id'], name='msg_conversation_id'
+            ),
+        ),
+    ]
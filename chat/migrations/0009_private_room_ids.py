@@ -0,0 +1,86 @@
+from django.db import migrations, models
+
+
+def rebuild_summaries(Conversation, Message, room_ids):
+    """Recreate the rooms' Conversation rows from their messages, as 0005 did."""
+    Conversation.objects.filter(room_id__in=room_ids).delete()
+    rows = []
+    for room_id in room_ids:
+        messages = Message.objects.filter(conversation_id=room_id)
+        messages = messages.filter(recipient__isnull=False)
+        last = messages.order_by('-time_stamp', '-id').first()
+        if last is None:
+            continue
+        unread = dict(
+            messages.filter(is_read=False).values_list('recipient').annotate(n=models.Count('id'))
+        )
+        pair = (last.sender_id, last.recipient_id)
+        for owner, other in (pair, pair[::-1]):
+            rows.append(Conversation(
+                owner_id=owner,
+                other_user_id=other,
+                room_id=room_id,
+                last_message_id=last.id,
+                last_time_stamp=last.time_stamp,
+                unread_count=unread.get(owner, 0),
+            ))
+    Conversation.objects.bulk_create(rows, batch_size=5000)
+
+
+def rekey_private_rooms(apps, _schema_editor):
+    """
+    Rename private rooms from "user1_user2" to "<id>:<id>". Usernames may
+    contain "_", so one old name could stand for two pairs of users (a and
+    b_c, a_b and c) whose messages ended up in the same room. Each pair that
+    wrote in a room gets a room of its own, and the summaries of the rooms
+    that were split are rebuilt.
+    """
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+
+    rebuild = set()
+    legacy = ChatRoom.objects.filter(is_group=False, name__isnull=False)
+    legacy = legacy.exclude(name__contains=':')
+    for room in legacy.iterator():
+        messages = Message.objects.filter(conversation=room)
+        senders = messages.filter(recipient__isnull=False)
+        senders = senders.values_list('sender_id', 'recipient_id').distinct()
+        pairs = sorted({tuple(sorted(pair)) for pair in senders})
+        if not pairs:
+            # Nothing says whose room it is; an empty one is recreated when opened
+            if not messages.exists():
+                room.delete()
+            continue
+
+        for low, high in pairs:
+            name = f'{low}:{high}'
+            target = ChatRoom.objects.filter(name=name).first()
+            if target is None and len(pairs) == 1:
+                room.name = name
+                room.save(update_fields=['name'])
+                break
+            if target is None:
+                target = ChatRoom.objects.create(name=name)
+            between = messages.filter(
+                sender_id__in=(low, high), recipient_id__in=(low, high)
+            )
+            between.update(conversation=target)
+            rebuild.update((room.id, target.id))
+
+        if not messages.exists():
+            room.delete()
+            rebuild.discard(room.id)
+
+    rebuild_summaries(Conversation, Message, rebuild)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_message_conversation_id_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(rekey_private_rooms, migrations.RunPython.noop),
+    ]
@@ -1,12 +1,17 @@
 from django.db import models
 from django.conf import settings  
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 
 # Create your models here.
 
 class ChatRoom(models.Model):
-  name=models.CharField(max_length=200)
+  # "<lower user id>:<higher user id>" for private rooms; group rooms have no
+  # name and are keyed by id
+  name=models.CharField(max_length=200, unique=True, null=True, blank=True)
+  title=models.CharField(max_length=200, blank=True)
+  is_group=models.BooleanField(default=False)
   participants=models.ManyToManyField(settings.AUTH_USER_MODEL)
   created=models.DateTimeField(auto_now_add=True)
   last_active=models.DateTimeField(auto_now=True)
@@ -16,9 +21,48 @@ class Message(models.Model):
   recipient = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='received_messages', null=True, blank=True)
   conversation=models.ForeignKey(ChatRoom, on_delete=models.CASCADE,null=True,blank=True)
   message=models.TextField()
-  time_stamp=models.DateTimeField(auto_now_add=True)
+  # default rather than auto_now_add so write-behind batches keep the send time
+  time_stamp=models.DateTimeField(default=timezone.now)
   is_read=models.BooleanField(default=False)
 
+  class Meta:
+    indexes = [
+      models.Index(fields=["conversation", "time_stamp"], name="msg_conversation_ts"),
+      models.Index(fields=["conversation", "id"], name="msg_conversation_id"),
+      models.Index(fields=["sender", "time_stamp"], name="msg_sender_ts"),
+      models.Index(fields=["recipient", "time_stamp"], name="msg_recipient_ts"),
+      models.Index(fields=["recipient", "is_read"], name="msg_recipient_unread"),
+    ]
+
+
+class Conversation(models.Model):
+  """
+  One row per (owner, room): what the owner's recent-chats list shows.
+  Maintained by chat.conversations.record_messages on every message save.
+  """
+  owner=models.ForeignKey(
+    settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='conversations'
+  )
+  other_user=models.ForeignKey(
+    settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+'
+  )
+  room=models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='summaries')
+  last_message=models.ForeignKey(
+    Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+  )
+  last_time_stamp=models.DateTimeField()
+  unread_count=models.PositiveIntegerField(default=0)
+
+  class Meta:
+    constraints = [
+      models.UniqueConstraint(fields=["owner", "room"], name="conversation_owner_room"),
+    ]
+    indexes = [
+      models.Index(
+        fields=["owner", "-last_time_stamp", "-id"], name="conversation_owner_recent"
+      ),
+    ]
+
 
 # class ChatUser(model.Model):
 
@@ -0,0 +1,101 @@
+"""
+Message persistence for the websocket path.
+
+With CHAT_MESSAGE_DURABILITY = "sync" (the default) each message is
+INSERTed before it is broadcast. With "batched" the consumer hands unsaved
+Message instances to the process-wide write-behind queue below, broadcasts
+straight away, and the queue writes them with bulk_create once
+CHAT_WRITE_BEHIND_BATCH_SIZE messages are pending or
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL seconds have passed. Anything still
+pending is flushed on consumer disconnect and at interpreter exit.
+"""
+import asyncio
+import atexit
+import logging
+
+from django.conf import settings
+from django.db import transaction
+
+from . import conversations, historycache
+from .dbexecutor import db_call
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+SYNC = "sync"
+BATCHED = "batched"
+
+
+def durability():
+    return getattr(settings, "CHAT_MESSAGE_DURABILITY", SYNC)
+
+
+class WriteBehindQueue:
+    def __init__(self):
+        self.pending = []
+        self.timer = None
+        self.tasks = set()
+
+    @property
+    def batch_size(self):
+        return getattr(settings, "CHAT_WRITE_BEHIND_BATCH_SIZE", 100)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, "CHAT_WRITE_BEHIND_FLUSH_INTERVAL", 0.25)
+
+    def add(self, message):
+        """Queue an unsaved Message; must be called from the event loop."""
+        self.pending.append(message)
+        if len(self.pending) >= self.batch_size:
+            self.spawn_flush()
+        elif self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(self.flush_interval, self.spawn_flush)
+
+    def spawn_flush(self):
+        task = asyncio.get_running_loop().create_task(self.write_pending())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def take(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        return batch
+
+    async def write_pending(self):
+        # Batches are swapped out atomically on the event loop, so no lock is needed
+        batch = self.take()
+        if batch:
+            await db_call(self.write)(batch)
+
+    async def flush(self):
+        """Write everything pending and wait for background batches in flight."""
+        await self.write_pending()
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+
+    def flush_sync(self):
+        """Shutdown hook: there is no event loop left, so write directly."""
+        batch = self.take()
+        if batch:
+            self.write(batch)
+
+    def write(self, batch):
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(batch, batch_size=self.batch_size)
+                conversations.record_messages(batch)
+        except Exception:
+            logger.exception(
+                "Dropped %d chat messages while flushing the write-behind queue",
+                len(batch),
+            )
+        else:
+            historycache.append(batch)
+
+
+write_behind = WriteBehindQueue()
+atexit.register(write_behind.flush_sync)
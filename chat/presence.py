@@ -0,0 +1,172 @@
+"""
+Online/offline presence for chat users.
+
+Every websocket a user has open counts as one connection. Counts live in
+the Django cache under "chat:presence:<user id>" so several workers agree
+when a cache shared between them is configured; a user is online while
+their count is positive.
+
+Each process also remembers when its own sockets last sent a frame. A
+periodic sweep treats sockets silent for longer than CHAT_PRESENCE_TTL as
+dead: they are closed and uncounted. The cache keys carry the same TTL
+and are refreshed by heartbeats, so counts left behind by a crashed
+worker expire on their own.
+
+Changes are coalesced for CHAT_PRESENCE_COALESCE seconds - a user who
+drops and reconnects inside that window produces no events. When the
+window ends, the shared count decides whether the user is online, and
+the state last announced is kept in the cache as well
+("chat:presence:announced:<user id>"), so whichever worker sees the
+last socket close announces the user offline, exactly once. Events are
+only sent to the per-user groups of people who have the user among
+their CHAT_PRESENCE_FANOUT_LIMIT most recent conversations.
+"""
+import asyncio
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+
+from .dbexecutor import db_call
+from .models import Conversation
+
+
+def user_group(user_id):
+    """Group every socket of one user joins, for notifications addressed to them."""
+    return f"user_{user_id}"
+
+
+def setting(name, default):
+    return getattr(settings, f"CHAT_PRESENCE_{name}", default)
+
+
+def cache_key(user_id):
+    return f"chat:presence:{user_id}"
+
+
+def announced_key(user_id):
+    return f"chat:presence:announced:{user_id}"
+
+
+def contacts_of(user_id):
+    """Owners of the most recent conversations that have `user_id` as the other side."""
+    return list(
+        Conversation.objects.filter(other_user_id=user_id)
+        .order_by("-last_time_stamp")
+        .values_list("owner_id", flat=True)[:setting("FANOUT_LIMIT", 500)]
+    )
+
+
+class PresenceTracker:
+    def __init__(self):
+        self.sockets = {}  # channel_name -> [user_id, username, last_seen, last_touch]
+        self.pending = {}  # user_id -> username, counts changed since the last flush
+        self.flush_timer = None
+        self.flush_loop = None
+        self.sweeper = None
+        self.tasks = set()
+
+    async def is_online(self, user_id):
+        return (await cache.aget(cache_key(user_id), 0)) > 0
+
+    async def connect(self, user, channel_name):
+        now = time.monotonic()
+        self.sockets[channel_name] = [user.id, user.username, now, now]
+        self.ensure_sweeper()
+        key = cache_key(user.id)
+        await cache.aadd(key, 0, timeout=setting("TTL", 60))
+        try:
+            count = await cache.aincr(key)
+        except ValueError:  # expired between add and incr
+            count = 1
+            await cache.aset(key, count, timeout=setting("TTL", 60))
+        if count == 1:
+            self.changed(user.id, user.username)
+
+    async def disconnect(self, channel_name):
+        entry = self.sockets.pop(channel_name, None)
+        if entry is None:
+            return
+        user_id, username = entry[:2]
+        key = cache_key(user_id)
+        try:
+            remaining = await cache.adecr(key)
+        except ValueError:  # key already expired
+            remaining = 0
+        if remaining <= 0:
+            await cache.adelete(key)
+            self.changed(user_id, username)
+
+    async def heartbeat(self, channel_name):
+        entry = self.sockets.get(channel_name)
+        if entry is None:
+            return
+        now = time.monotonic()
+        entry[2] = now
+        ttl = setting("TTL", 60)
+        if now - entry[3] > ttl / 3:
+            entry[3] = now
+            await cache.atouch(cache_key(entry[0]), ttl)
+
+    def changed(self, user_id, username):
+        self.pending[user_id] = username
+        loop = asyncio.get_running_loop()
+        if self.flush_timer is None or self.flush_loop is not loop:
+            self.flush_loop = loop
+            delay = setting("COALESCE", 1.0)
+            self.flush_timer = loop.call_later(delay, self.spawn(self.flush))
+
+    def spawn(self, coroutine_function):
+        def start():
+            task = asyncio.get_running_loop().create_task(coroutine_function())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return start
+
+    async def flush(self):
+        """Announce users whose shared count disagrees with what was last announced."""
+        self.flush_timer = None
+        pending, self.pending = self.pending, {}
+        layer = get_channel_layer()
+        for user_id, username in pending.items():
+            online = await self.is_online(user_id)
+            # add() and delete() report whether they changed anything, so of
+            # several workers flushing the same change only one announces it
+            if online:
+                announce = await cache.aadd(announced_key(user_id), True, timeout=None)
+            else:
+                announce = await cache.adelete(announced_key(user_id))
+            if not announce:
+                continue
+            event = {
+                "type": "presence",
+                "user": username,
+                "user_id": user_id,
+                "online": online,
+            }
+            for owner_id in await db_call(contacts_of)(user_id):
+                await layer.group_send(user_group(owner_id), event)
+
+    def ensure_sweeper(self):
+        loop = asyncio.get_running_loop()
+        sweeper = self.sweeper
+        if sweeper is None or sweeper.done() or sweeper.get_loop() is not loop:
+            self.sweeper = loop.create_task(self.sweep_forever())
+
+    async def sweep_forever(self):
+        while self.sockets:
+            await asyncio.sleep(setting("SWEEP_INTERVAL", 15))
+            await self.sweep()
+
+    async def sweep(self):
+        """Close and uncount local sockets that missed their heartbeats."""
+        deadline = time.monotonic() - setting("TTL", 60)
+        layer = get_channel_layer()
+        expired = [c for c, entry in self.sockets.items() if entry[2] < deadline]
+        for channel_name in expired:
+            await layer.send(channel_name, {"type": "presence.expired"})
+            await self.disconnect(channel_name)
+
+
+tracker = PresenceTracker()
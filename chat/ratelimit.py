@@ -0,0 +1,180 @@
+"""
+Token-bucket rate limiting for incoming websocket frames.
+
+Every frame except pings takes a token from two buckets before the
+consumer does anything with it: one per connection and one per user,
+shared by all of that user's sockets. Rates are tokens per second and
+bursts are bucket sizes:
+
+    CHAT_RATE_LIMIT_RATE / CHAT_RATE_LIMIT_BURST            per connection
+    CHAT_RATE_LIMIT_USER_RATE / CHAT_RATE_LIMIT_USER_BURST  per user
+
+A rate of 0 turns that bucket off. Control frames (history, resume,
+read, subscribe, unsubscribe) only fetch or acknowledge messages, and a
+client sends many of them catching up after a long disconnect. They draw
+on a per-connection bucket of their own instead, so they neither use up
+nor get starved by the chat message budget:
+
+    CHAT_RATE_LIMIT_CONTROL_RATE / CHAT_RATE_LIMIT_CONTROL_BURST
+
+With CHAT_RATE_LIMIT_MODE = "reject" an over-limit frame is dropped and
+the client told when to retry; with "delay" the frame is held until a
+token is available, as long as that is no more than
+CHAT_RATE_LIMIT_MAX_DELAY seconds away, and rejected otherwise.
+
+User buckets live in this process unless CHAT_RATE_LIMIT_BACKEND is
+"cache", which counts each user's frames per one-second window in the
+Django cache instead. That is coarser than a bucket, but with a cache
+shared between workers it holds across all of them.
+
+Outcomes are counted in `metrics`.
+"""
+import asyncio
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+
+metrics = Counter()
+
+REJECT = "reject"
+DELAY = "delay"
+
+CONTROL_FRAMES = frozenset({"history", "resume", "read", "subscribe", "unsubscribe"})
+
+# Idle user buckets are dropped once there are more than this many
+MAX_USER_BUCKETS = 10_000
+
+
+def setting(name, default):
+    return getattr(settings, f"CHAT_RATE_LIMIT_{name}", default)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now=None):
+        """Seconds until a token is available; 0 if one is available now."""
+        self.refill(time.monotonic() if now is None else now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class UserBuckets:
+    """One bucket per user id, shared by every socket of that user in this process."""
+
+    def __init__(self):
+        self.buckets = {}
+
+    def get(self, user_id, rate, burst):
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            if len(self.buckets) >= MAX_USER_BUCKETS:
+                self.prune()
+            bucket = self.buckets[user_id] = TokenBucket(rate, burst)
+        return bucket
+
+    def prune(self):
+        # A full bucket behaves exactly like a new one, so it can be forgotten
+        now = time.monotonic()
+        for user_id in [u for u, bucket in self.buckets.items() if bucket.is_full(now)]:
+            del self.buckets[user_id]
+
+
+user_buckets = UserBuckets()
+
+
+async def shared_wait_time(user_id, rate):
+    """Fixed one-second window in the shared cache: `rate` frames per user a second."""
+    now = time.time()
+    key = f"chat:rate:{user_id}:{int(now)}"
+    await cache.aadd(key, 0, timeout=2)
+    try:
+        count = await cache.aincr(key)
+    except ValueError:  # expired between add and incr
+        count = 1
+    return 0.0 if count <= rate else 1 - (now % 1)
+
+
+class Limiter:
+    """The buckets for one connection."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        rate = setting("RATE", 5)
+        self.connection = TokenBucket(rate, setting("BURST", 10)) if rate > 0 else None
+        control_rate = setting("CONTROL_RATE", 20)
+        self.control = None
+        if control_rate > 0:
+            self.control = TokenBucket(control_rate, setting("CONTROL_BURST", 100))
+
+    async def wait_time(self, control=False):
+        """
+        Seconds until this connection may send another frame, taking the
+        tokens if it may send now. Returns ("connection" | "user" |
+        "control", seconds) for the bucket that is holding it back, or
+        (None, 0).
+        """
+        if control:
+            if self.control is None:
+                return None, 0.0
+            wait = self.control.wait_time()
+            if wait:
+                return "control", wait
+            self.control.take()
+            return None, 0.0
+
+        if self.connection is not None:
+            wait = self.connection.wait_time()
+            if wait:
+                return "connection", wait
+
+        user_bucket = None
+        user_rate = setting("USER_RATE", 10)
+        if user_rate > 0:
+            if setting("BACKEND", "local") == "cache":
+                wait = await shared_wait_time(self.user_id, user_rate)
+            else:
+                user_burst = setting("USER_BURST", 20)
+                user_bucket = user_buckets.get(self.user_id, user_rate, user_burst)
+                wait = user_bucket.wait_time()
+            if wait:
+                return "user", wait
+
+        if self.connection is not None:
+            self.connection.take()
+        if user_bucket is not None:
+            user_bucket.take()
+        return None, 0.0
+
+    async def admit(self, control=False):
+        """
+        (True, 0) if the frame may go ahead, after holding it back in
+        "delay" mode; (False, retry_after) if it must be dropped. `control`
+        frames are counted against the control bucket only.
+        """
+        scope, wait = await self.wait_time(control)
+        if not wait:
+            metrics["allowed"] += 1
+            return True, 0.0
+        if setting("MODE", REJECT) == DELAY and wait <= setting("MAX_DELAY", 1.0):
+            metrics["delayed"] += 1
+            await asyncio.sleep(wait)
+            return await self.admit(control)
+        metrics[f"throttled_{scope}"] += 1
+        return False, wait
@@ -0,0 +1,190 @@
+"""
+One user's side of a conversation, shared by the websocket consumers.
+
+The peer (or group) and the room are resolved once, when a socket opens
+a conversation; every later query for that conversation reuses them.
+PrivateRoom and GroupRoom expose the same interface to the consumers.
+"""
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from . import conversations, groups, history, historycache
+from .models import ChatRoom, Message
+
+User = get_user_model()
+
+
+def room_name(user1, user2):
+    """
+    Deterministic name so both users join the same room. Built from ids:
+    usernames may contain "_", so joined usernames can name two pairs.
+    """
+    low, high = sorted([user1.id, user2.id])
+    return f"{low}:{high}"
+
+
+def get_or_create_room(user1, user2):
+    room, _ = ChatRoom.objects.get_or_create(name=room_name(user1, user2))
+    return room
+
+
+class PrivateRoom:
+    def __init__(self, user, other_user, room):
+        self.user = user
+        self.other_user = other_user
+        self.recipient = other_user
+        self.room = room
+        self.group_name = f"private_chat_{room.id}"
+
+    @property
+    def id(self):
+        return self.room.id
+
+    @property
+    def users(self):
+        """{user id: username} for everyone in the room, so compact frames send ids."""
+        return {
+            self.user.id: self.user.username,
+            self.other_user.id: self.other_user.username,
+        }
+
+    async def is_member(self):
+        return True
+
+    @classmethod
+    def resolve(cls, user, other_username):
+        """Look up the peer and the shared room, or None if the peer doesn't exist."""
+        try:
+            other_user = User.objects.get(username=other_username)
+        except User.DoesNotExist:
+            return None
+        return cls(user, other_user, get_or_create_room(user, other_user))
+
+    @classmethod
+    async def aresolve(cls, user, other_username):
+        """resolve() through the async ORM."""
+        try:
+            other_user = await User.objects.aget(username=other_username)
+        except User.DoesNotExist:
+            return None
+        name = room_name(user, other_user)
+        room, _ = await ChatRoom.objects.aget_or_create(name=name)
+        return cls(user, other_user, room)
+
+    def history_page(self, before=None, limit=None):
+        """Load one page of chat history for this room, newest page first."""
+        if before is None:
+            return historycache.first_page(self.room, limit)
+        messages, cursor = history.fetch_page(self.room, before=before, limit=limit)
+        return [history.entry(m) for m in messages], cursor
+
+    async def ahistory_page(self, before=None, limit=None):
+        if before is None:
+            return await historycache.afirst_page(self.room, limit)
+        messages, cursor = await history.afetch_page(
+            self.room, before=before, limit=limit
+        )
+        return [history.entry(m) for m in messages], cursor
+
+    def messages_after(self, after, limit=None):
+        """Messages newer than id `after`, for a client resuming the conversation."""
+        messages, more = history.fetch_after(self.room, after, limit=limit)
+        return [history.entry(m) for m in messages], more
+
+    async def amessages_after(self, after, limit=None):
+        messages, more = await history.afetch_after(self.room, after, limit=limit)
+        return [history.entry(m) for m in messages], more
+
+    def new_message(self, content):
+        return Message(
+            sender=self.user,
+            recipient=self.other_user,
+            conversation=self.room,
+            message=content,
+        )
+
+    def create_message(self, content):
+        """Insert a message and bump both participants' summaries."""
+        with transaction.atomic():
+            message = self.new_message(content)
+            message.save(force_insert=True)
+            conversations.record_messages([message])
+        historycache.append([message])
+        return message
+
+    async def acreate_message(self, content):
+        """
+        create_message through the async ORM. It has no transactions, so the
+        summaries are updated after the INSERT commits rather than with it;
+        conversations.rebuild() repairs them if a worker dies in between.
+        """
+        message = self.new_message(content)
+        await message.asave(force_insert=True)
+        await conversations.arecord_messages([message])
+        await historycache.aappend([message])
+        return message
+
+    def mark_read_up_to(self, up_to):
+        """One bulk UPDATE over the (recipient, is_read) index, then the counter."""
+        with transaction.atomic():
+            unread = Message.objects.filter(
+                conversation=self.room, recipient=self.user, is_read=False
+            )
+            marked = unread.filter(id__lte=up_to).update(is_read=True)
+            if marked:
+                conversations.mark_read(self.user, self.room, marked)
+        return marked
+
+
+class GroupRoom:
+    recipient = None  # group messages are addressed to the room, not a person
+
+    def __init__(self, user, room):
+        self.user = user
+        self.room = room
+        self.group_name = groups.group_name(room.id)
+        self.users = {user.id: user.username}
+
+    @property
+    def id(self):
+        return self.room.id
+
+    async def is_member(self):
+        """Checked before every post, against the cached member set."""
+        return self.user.id in await groups.amember_ids(self.room.id)
+
+    @classmethod
+    def resolve(cls, user, room_id):
+        """The group room `room_id` if `user` is one of its members, else None."""
+        room = ChatRoom.objects.filter(id=room_id, is_group=True).first()
+        if room is None or user.id not in groups.member_ids(room.id):
+            return None
+        return cls(user, room)
+
+    def history_page(self, before=None, limit=None):
+        """Load a page of the room's history; `users` learns its senders' names."""
+        if before is None:
+            entries, cursor = historycache.first_page(self.room, limit)
+        else:
+            messages, cursor = history.fetch_page(self.room, before=before, limit=limit)
+            entries = [history.entry(m) for m in messages]
+        self.users.update((entry["sender_id"], entry["sender"]) for entry in entries)
+        return entries, cursor
+
+    def messages_after(self, after, limit=None):
+        messages, more = history.fetch_after(self.room, after, limit=limit)
+        self.users.update((m.sender_id, m.sender.username) for m in messages)
+        return [history.entry(m) for m in messages], more
+
+    def new_message(self, content):
+        return Message(sender=self.user, conversation=self.room, message=content)
+
+    def create_message(self, content):
+        message = self.new_message(content)
+        message.save(force_insert=True)
+        historycache.append([message])
+        return message
+
+    def mark_read_up_to(self, _up_to):
+        """Read state isn't tracked per member in group rooms."""
+        return 0
@@ -3,5 +3,9 @@ from . import consumers
 
 websocket_urlpatterns = [
     # re_path(r"ws/chat/(?P<room_name>\w+)/$", consumers.ChatConsumer.as_asgi()),
-    re_path(r"ws/private/(?P<username>\w+)/$", consumers.PrivateChatConsumer.as_asgi()),
+    re_path(r"ws/chat/$", consumers.ChatConsumer.as_asgi()),
+    re_path(r"ws/room/(?P<room_id>\d+)/$", consumers.GroupChatConsumer.as_asgi()),
+    re_path(
+        r"ws/private/(?P<username>\w+)/$", consumers.private_chat_consumer().as_asgi()
+    ),
 ]
@@ -0,0 +1,137 @@
+"""
+Keyword search over the messages of every room a user takes part in.
+
+The inverted index depends on the database:
+
+* PostgreSQL - a GIN index on to_tsvector('english', message), queried
+  with plainto_tsquery and ranked with ts_rank.
+* SQLite - an external-content FTS5 table, chat_message_fts, kept in step
+  with chat_message by triggers, queried with MATCH and ranked with bm25.
+* anything else - an unranked icontains scan, so the endpoint still works.
+
+Both indexes are created by migration chat.0006 and are updated by the
+database as rows are inserted, including write-behind bulk_create batches.
+Results are ordered by relevance, then newest first, and paginated with
+an opaque (score, id) cursor.
+"""
+import base64
+import binascii
+import json
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+
+from .history import InvalidCursor
+from .models import ChatRoom, Conversation, Message
+
+SEARCH_CONFIG = "english"
+FTS_TABLE = "chat_message_fts"
+
+
+def encode_cursor(score, pk):
+    return base64.urlsafe_b64encode(json.dumps([score, pk]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        score, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(score), int(pk)
+    except (binascii.Error, UnicodeError, ValueError, TypeError, AttributeError):
+        raise InvalidCursor(cursor) from None
+
+
+def user_rooms(user):
+    """Ids of `user`'s private rooms (from their summaries) and group rooms."""
+    private = Conversation.objects.filter(owner=user).values("room")
+    group = ChatRoom.participants.through.objects.filter(
+        user=user, chatroom__is_group=True
+    )
+    return private.union(group.values("chatroom"))
+
+
+def search_messages(user, text, after=None, limit=None):
+    """
+    Return (messages, cursor): messages from `user`'s rooms matching `text`,
+    best match first, each annotated with `score` (higher is better).
+    """
+    limit = limit or getattr(settings, "CHAT_SEARCH_PAGE_SIZE", 20)
+    text = text.strip()
+    if not text:
+        return [], None
+    after = decode_cursor(after) if after else None
+    rooms = user_rooms(user)
+
+    if connection.vendor == "postgresql":
+        rows = postgres_search(rooms, text, after, limit + 1)
+    elif connection.vendor == "sqlite":
+        rows = sqlite_search(rooms, text, after, limit + 1)
+    else:
+        rows = fallback_search(rooms, text, after, limit + 1)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    cursor = encode_cursor(rows[-1].score, rows[-1].id) if has_more else None
+    return rows, cursor
+
+
+def postgres_search(rooms, text, after, limit):
+    from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+
+    # Must match the indexed expression in chat.0006 for the GIN index to be used
+    vector = SearchVector("message", config=SEARCH_CONFIG)
+    query = SearchQuery(text, config=SEARCH_CONFIG)
+    qs = (
+        Message.objects.annotate(search=vector, score=SearchRank(vector, query))
+        .filter(search=query, conversation__in=rooms)
+    )
+    if after:
+        score, pk = after
+        qs = qs.filter(Q(score__lt=score) | Q(score=score, id__lt=pk))
+    return list(qs.select_related("sender").order_by("-score", "-id")[:limit])
+
+
+def fts_query(text):
+    """Quote every term so user input can't use (or break) FTS5 query syntax."""
+    return " ".join('"{}"'.format(term.replace('"', '""')) for term in text.split())
+
+
+def sqlite_search(rooms, text, after, limit):
+    rooms_sql, rooms_params = rooms.query.sql_with_params()
+    # bm25() is lower-is-better; negate it so score means the same on every backend
+    sql = f"""
+        SELECT m.id, -bm25({FTS_TABLE}) AS score
+        FROM {FTS_TABLE} JOIN chat_message m ON m.id = {FTS_TABLE}.rowid
+        WHERE {FTS_TABLE} MATCH %s AND m.conversation_id IN ({rooms_sql})
+    """
+    params = [fts_query(text), *rooms_params]
+    if after:
+        score, pk = after
+        score_sql = f"-bm25({FTS_TABLE})"
+        sql += f" AND ({score_sql} < %s OR ({score_sql} = %s AND m.id < %s))"
+        params += [score, score, pk]
+    sql += " ORDER BY score DESC, m.id DESC LIMIT %s"
+    params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        scores = dict(cursor.fetchall())
+    messages = Message.objects.select_related("sender").in_bulk(list(scores))
+    rows = []
+    for pk, score in scores.items():
+        message = messages[pk]
+        message.score = score
+        rows.append(message)
+    return rows
+
+
+def fallback_search(rooms, text, after, limit):
+    qs = Message.objects.filter(conversation__in=rooms)
+    for term in text.split():
+        qs = qs.filter(message__icontains=term)
+    if after:
+        qs = qs.filter(id__lt=after[1])
+    rows = list(qs.select_related("sender").order_by("-id")[:limit])
+    for message in rows:
+        message.score = 0.0
+    return rows
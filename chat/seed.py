@@ -0,0 +1,78 @@
+"""
+Synthetic data generators used by the seed_chat command and the benchmarks.
+
+Everything is inserted with bulk_create in batches so seeding millions of
+messages stays memory-flat.
+"""
+import random
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from . import conversations
+from .models import ChatRoom, Message
+from .rooms import room_name
+
+User = get_user_model()
+
+
+def seed_users(count, prefix="user", batch_size=5000):
+    """Create `count` users named <prefix>0..N; passwords are unusable."""
+    existing = User.objects.filter(username__startswith=prefix).count()
+    for start in range(existing, count, batch_size):
+        User.objects.bulk_create(
+            User(username=f"{prefix}{i}", password="!")
+            for i in range(start, min(start + batch_size, count))
+        )
+    return list(User.objects.filter(username__startswith=prefix).order_by("id")[:count])
+
+
+def seed_rooms(users, count, rng=None):
+    """Create up to `count` private rooms between random pairs of `users`."""
+    rng = rng or random.Random(0)
+    pairs = {}
+    attempts = 0
+    while len(pairs) < count and attempts < count * 10:
+        attempts += 1
+        a, b = rng.sample(users, 2)
+        pairs.setdefault(room_name(a, b), (a, b))
+    ChatRoom.objects.bulk_create(
+        [ChatRoom(name=name) for name in pairs], ignore_conflicts=True, batch_size=5000
+    )
+    rooms = ChatRoom.objects.in_bulk(list(pairs), field_name="name")
+    return [(rooms[name], a, b) for name, (a, b) in pairs.items()]
+
+
+def seed_messages(
+    rooms, count, batch_size=5000, rng=None, hot_room_share=0.0, span_days=365
+):
+    """
+    Spread `count` messages over `rooms` (as returned by seed_rooms) with
+    increasing timestamps over the last `span_days`. `hot_room_share` of the
+    messages go to the first room so one conversation can be made very long.
+    """
+    rng = rng or random.Random(0)
+    start = timezone.now() - timedelta(days=span_days)
+    step = timedelta(days=span_days) / max(count, 1)
+    batch = []
+    for i in range(count):
+        if hot_room_share and rng.random() < hot_room_share:
+            room, a, b = rooms[0]
+        else:
+            room, a, b = rng.choice(rooms)
+        sender, recipient = (a, b) if rng.random() < 0.5 else (b, a)
+        batch.append(Message(
+            sender=sender,
+            recipient=recipient,
+            conversation=room,
+            message=f"message {i}",
+            time_stamp=start + step * i,
+            is_read=rng.random() < 0.9,
+        ))
+        if len(batch) >= batch_size:
+            Message.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        Message.objects.bulk_create(batch)
+    conversations.rebuild()
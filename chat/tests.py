@@ -1,3 +1,1763 @@
-from django.test import TestCase
+import asyncio
+import importlib.util
+import json
+import sys
+import threading
+import time
+import warnings
+from collections import Counter
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model, user_logged_out
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.db import close_old_connections, connection, connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from django_project.channel_layers import channel_layers_from_env
+from django_project.database import databases_from_env
+from django_project.history_cache import history_cache_from_env
+from django_project.sessions import caches_from_env, session_engine_from_env
+
+from . import (
+    auth,
+    backpressure,
+    benchmarks,
+    conversations,
+    dbexecutor,
+    groups,
+    history,
+    historycache,
+    loadtest,
+    presence,
+    ratelimit,
+    rooms,
+    search,
+    wire,
+)
+from .consumers import (
+    AsyncORMPrivateChatConsumer,
+    ChatConsumer,
+    GroupChatConsumer,
+    PrivateChatConsumer,
+    private_chat_consumer,
+)
+from .models import ChatRoom, Conversation, Message
+
+User = get_user_model()
+
+
+class ChatTestCase(TestCase):
+    """
+    Rolled-back rows leave the in-process history cache behind; start every test
+    without it.
+    """
+
+    def setUp(self):
+        super().setUp()
+        historycache.local_rooms.clear()
+
+
+def make_room(*users):
+    return rooms.get_or_create_room(*users)
+
+
+async def open_socket(
+    user, other_username, subprotocols=None, application=None, query=""
+):
+    communicator = WebsocketCommunicator(
+        application or PrivateChatConsumer.as_asgi(),
+        f"/ws/private/{other_username}/{query}",
+        subprotocols=subprotocols,
+    )
+    communicator.scope["user"] = user
+    communicator.scope["url_route"] = {"kwargs": {"username": other_username}}
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+
+async def open_multiplexed_socket(user):
+    communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/")
+    communicator.scope["user"] = user
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+
+class HistoryPaginationTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob", password="pw")
+        cls.room = make_room(cls.alice, cls.bob)
+        for i in range(7):
+            Message.objects.create(
+                sender=cls.alice,
+                recipient=cls.bob,
+                conversation=cls.room,
+                message=f"m{i}",
+            )
+
+    def test_pages_walk_back_without_gaps(self):
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = history.fetch_page(self.room, before=cursor, limit=3)
+            seen = [m.message for m in page] + seen
+            if cursor is None:
+                break
+        self.assertEqual(seen, [f"m{i}" for i in range(7)])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(history.InvalidCursor):
+            history.fetch_page(self.room, before="not-a-cursor")
+
+    def test_export_streams_whole_history_in_one_query(self):
+        with self.assertNumQueries(1):
+            chunks = list(history.stream_json(self.room, chunk_size=3))
+        self.assertGreater(len(chunks), 3)
+        frame = json.loads("".join(chunks))
+        self.assertEqual((frame["type"], frame["room"]), ("history", self.room.id))
+        self.assertEqual(
+            [m["content"] for m in frame["messages"]], [f"m{i}" for i in range(7)]
+        )
+        self.assertEqual(
+            frame["messages"][0],
+            wire.JSON.legacy(history.entry(self.room.message_set.order_by("id")[0])),
+        )
+
+        carol = User.objects.create_user("carol", password="pw")
+        self.client.force_login(carol)
+        self.assertEqual(
+            self.client.get(reverse("export_history", args=[self.room.id])).status_code,
+            403,
+        )
+        self.client.force_login(self.bob)
+        response = self.client.get(reverse("export_history", args=[self.room.id]))
+        self.assertTrue(response.streaming)
+        self.assertEqual(
+            len(json.loads(b"".join(response.streaming_content))["messages"]), 7
+        )
+
+    async def test_export_streams_asynchronously_under_asgi(self):
+        await self.async_client.aforce_login(self.bob)
+        with warnings.catch_warnings():
+            # Django warns when it has to buffer a sync iterator for ASGI
+            warnings.filterwarnings(
+                "error", message="StreamingHttpResponse must consume"
+            )
+            response = await self.async_client.get(
+                reverse("export_history", args=[self.room.id])
+            )
+            body = b"".join([chunk async for chunk in response.streaming_content])
+        self.assertTrue(response.is_async)
+        self.assertEqual(
+            [m["content"] for m in json.loads(body)["messages"]],
+            [f"m{i}" for i in range(7)],
+        )
+
+    def test_export_checks_participants_not_the_room_name(self):
+        a_b, c = User.objects.create_user("a_b"), User.objects.create_user("c")
+        room = make_room(a_b, c)
+        Message.objects.create(
+            sender=a_b, recipient=c, conversation=room, message="secret"
+        )
+        self.client.force_login(User.objects.create_user("a"))
+        self.assertEqual(
+            self.client.get(reverse("export_history", args=[room.id])).status_code, 403
+        )
+        self.client.force_login(c)
+        self.assertEqual(
+            self.client.get(reverse("export_history", args=[room.id])).status_code, 200
+        )
+
+    async def test_usernames_with_underscores_get_their_own_rooms(self):
+        create_user = sync_to_async(User.objects.create_user)
+        ca, cb_cc, ca_cb, cc = [
+            await create_user(name) for name in ("ca", "cb_cc", "ca_cb", "cc")
+        ]
+        first = await sync_to_async(rooms.PrivateRoom.resolve)(ca, "cb_cc")
+        second = await rooms.PrivateRoom.aresolve(ca_cb, "cc")
+        self.assertNotEqual(first.room.id, second.room.id)
+        self.assertNotEqual(first.group_name, second.group_name)
+        self.assertEqual(
+            (await rooms.PrivateRoom.aresolve(cc, "ca_cb")).room.id, second.room.id
+        )
+        self.assertEqual(
+            (await rooms.PrivateRoom.aresolve(cb_cc, "ca")).room.id, first.room.id
+        )
+
+    def test_chat_page_opens_the_pair_room(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse("chat_room", args=["bob"]))
+        self.assertEqual(
+            (response.status_code, response.context["room"]), (200, self.room)
+        )
+        self.assertEqual(
+            self.client.get(reverse("chat_room", args=["alice"])).status_code, 400
+        )
+
+    async def test_anonymous_socket_is_refused(self):
+        for consumer in (PrivateChatConsumer, AsyncORMPrivateChatConsumer):
+            communicator = WebsocketCommunicator(consumer.as_asgi(), "/ws/private/bob/")
+            communicator.scope["user"] = AnonymousUser()
+            communicator.scope["url_route"] = {"kwargs": {"username": "bob"}}
+            connected, _ = await communicator.connect()
+            self.assertFalse(connected)
+        self.assertEqual(await ChatRoom.objects.acount(), 1)
+
+    @override_settings(CHAT_HISTORY_PAGE_SIZE=5)
+    async def test_connect_sends_newest_page_and_serves_older(self):
+        communicator = await open_socket(self.alice, "bob")
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["type"], "history")
+        self.assertEqual(
+            [m["content"] for m in frame["messages"]], ["m2", "m3", "m4", "m5", "m6"]
+        )
+
+        await communicator.send_json_to({"type": "history", "cursor": frame["cursor"]})
+        older = await communicator.receive_json_from()
+        self.assertEqual(older["type"], "history_page")
+        self.assertEqual([m["content"] for m in older["messages"]], ["m0", "m1"])
+        self.assertIsNone(older["cursor"])
+        await communicator.disconnect()
+
+
+class ResumeTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob", password="pw")
+        cls.room = make_room(cls.alice, cls.bob)
+        cls.messages = [
+            Message.objects.create(
+                sender=cls.bob,
+                recipient=cls.alice,
+                conversation=cls.room,
+                message=f"m{i}",
+            )
+            for i in range(7)
+        ]
+
+    def test_fetch_after_is_one_range_query(self):
+        with self.assertNumQueries(1):
+            page, more = history.fetch_after(self.room, self.messages[2].id, limit=3)
+            self.assertEqual([m.sender.username for m in page], ["bob"] * 3)
+        self.assertEqual([m.message for m in page], ["m3", "m4", "m5"])
+        self.assertTrue(more)
+        page, more = history.fetch_after(self.room, page[-1].id, limit=3)
+        self.assertEqual(([m.message for m in page], more), (["m6"], False))
+        with self.assertRaises(history.InvalidCursor):
+            history.fetch_after(self.room, "latest")
+
+    @override_settings(CHAT_HISTORY_PAGE_SIZE=2)
+    async def test_reconnect_gets_only_missed_messages(self):
+        alice = await open_socket(
+            self.alice, "bob", query=f"?after={self.messages[3].id}"
+        )
+        frame = await alice.receive_json_from()
+        self.assertEqual(frame["type"], "resume")
+        self.assertEqual([m["content"] for m in frame["messages"]], ["m4", "m5"])
+        self.assertTrue(frame["more"])
+
+        await alice.send_json_to(
+            {"type": "resume", "after": frame["messages"][-1]["id"]}
+        )
+        frame = await alice.receive_json_from()
+        self.assertEqual(
+            ([m["content"] for m in frame["messages"]], frame["more"]), (["m6"], False)
+        )
+
+        await alice.send_json_to({"type": "resume", "after": "soon"})
+        self.assertEqual(
+            (await alice.receive_json_from())["error"], "invalid resume point"
+        )
+        await alice.disconnect()
+
+    async def test_multiplexed_subscribe_resumes(self):
+        alice = await open_multiplexed_socket(self.alice)
+        await alice.send_json_to(
+            {"type": "subscribe", "peer": "bob", "after": self.messages[5].id}
+        )
+        frame = await alice.receive_json_from()
+        self.assertEqual(
+            (frame["type"], frame["room"], frame["peer"]),
+            ("resume", self.room.id, "bob"),
+        )
+        self.assertEqual([m["content"] for m in frame["messages"]], ["m6"])
+        self.assertFalse(frame["more"])
+        await alice.disconnect()
+
+
+class HistoryCacheTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob", password="pw")
+        cls.carol = User.objects.create_user("carol", password="pw")
+        cls.room = make_room(cls.alice, cls.bob)
+        for i in range(7):
+            Message.objects.create(
+                sender=cls.alice,
+                recipient=cls.bob,
+                conversation=cls.room,
+                message=f"m{i}",
+            )
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(historycache, "metrics", Counter())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(CHAT_HISTORY_CACHE_SIZE=5)
+    def test_first_page_is_served_from_memory_and_kept_current(self):
+        expected, cursor = history.fetch_page(self.room, limit=3)
+        with self.assertNumQueries(1):
+            page, first_cursor = historycache.first_page(self.room, limit=3)
+        self.assertEqual([e["content"] for e in page], [m.message for m in expected])
+        self.assertEqual(first_cursor, cursor)
+
+        room = rooms.PrivateRoom(self.bob, self.alice, self.room)
+        room.create_message("fresh")
+        with self.assertNumQueries(0):
+            page, cursor = room.history_page(limit=3)
+        self.assertEqual([e["content"] for e in page], ["m5", "m6", "fresh"])
+        self.assertEqual(
+            [m.message for m in history.fetch_page(self.room, before=cursor)[0]][-1],
+            "m4",
+        )
+        self.assertEqual(
+            (historycache.metrics["misses"], historycache.metrics["hits"]), (1, 1)
+        )
+
+        # Pages bigger than the cache go to the database
+        with self.assertNumQueries(1):
+            self.assertEqual(len(historycache.first_page(self.room, limit=10)[0]), 8)
+
+    @override_settings(CHAT_HISTORY_CACHE_ROOMS=1)
+    def test_least_recently_opened_room_is_evicted(self):
+        other = make_room(self.alice, self.carol)
+        historycache.first_page(self.room)
+        historycache.first_page(other)
+        self.assertEqual(list(historycache.local_rooms.rooms), [other.id])
+        self.assertEqual(historycache.metrics["evicted"], 1)
+
+    @override_settings(CHAT_HISTORY_CACHE_BACKEND="cache")
+    def test_shared_backend_drops_room_on_save(self):
+        cache.clear()
+        historycache.first_page(self.room)
+        with self.assertNumQueries(0):
+            historycache.first_page(self.room)
+        rooms.PrivateRoom(self.alice, self.bob, self.room).create_message("new")
+        page, _ = historycache.first_page(self.room)
+        self.assertEqual(page[-1]["content"], "new")
+        self.assertEqual(historycache.metrics["misses"], 2)
+
+    def test_message_saved_while_loading_is_not_lost(self):
+        fetch_page = history.fetch_page
+        room = rooms.PrivateRoom(self.alice, self.bob, self.room)
+
+        for backend in ("local", "cache"):
+
+            def saving_meanwhile(*args, backend=backend, **kwargs):
+                page = fetch_page(*args, **kwargs)
+                room.create_message(f"meanwhile {backend}")
+                return page
+
+            with (
+                self.subTest(backend=backend),
+                override_settings(CHAT_HISTORY_CACHE_BACKEND=backend),
+            ):
+                cache.clear()
+                historycache.local_rooms.clear()
+                with mock.patch.object(history, "fetch_page", saving_meanwhile):
+                    historycache.first_page(self.room)
+                page, _ = historycache.first_page(self.room)
+                self.assertEqual(page[-1]["content"], f"meanwhile {backend}")
+                room.create_message(f"after {backend}")
+                page, _ = historycache.first_page(self.room)
+                self.assertEqual(page[-1]["content"], f"after {backend}")
+        self.assertEqual(historycache.metrics["stale"], 1)
+
+
+class MessageQueryCountTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob", password="pw")
+
+    async def test_each_message_is_a_single_insert(self):
+        communicator = await open_socket(self.alice, "bob")
+        await communicator.receive_json_from()  # history
+
+        queries = CaptureQueriesContext(connection)
+        await sync_to_async(queries.__enter__)()
+        for text in ("one", "two", "three"):
+            await communicator.send_json_to({"message": text})
+            await communicator.receive_json_from()
+        await sync_to_async(queries.__exit__)(None, None, None)
+
+        # connection is thread-local: read the log from the thread that ran the queries
+        statements = await sync_to_async(
+            lambda: [
+                q["sql"].split()[0]
+                for q in queries.captured_queries
+                if "SAVEPOINT" not in q["sql"]
+            ]
+        )()
+        # the message INSERT plus one UPDATE of both participants' summaries;
+        # the very first message also creates the summaries
+        self.assertEqual(statements[:3], ["INSERT", "UPDATE", "SELECT"], statements)
+        self.assertEqual(statements[4:], ["INSERT", "UPDATE"] * 2, statements)
+        await communicator.disconnect()
+
+    async def test_unknown_peer_is_rejected(self):
+        communicator = WebsocketCommunicator(
+            PrivateChatConsumer.as_asgi(), "/ws/private/nobody/"
+        )
+        communicator.scope["user"] = self.alice
+        communicator.scope["url_route"] = {"kwargs": {"username": "nobody"}}
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+
+class ConversationSummaryTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob", password="pw")
+        cls.carol = User.objects.create_user("carol", password="pw")
+
+    def send(self, sender, recipient, text):
+        message = Message.objects.create(
+            sender=sender,
+            recipient=recipient,
+            conversation=make_room(sender, recipient),
+            message=text,
+        )
+        conversations.record_messages([message])
+        return message
+
+    def test_summaries_track_last_message_and_unread(self):
+        self.send(self.alice, self.bob, "hi")
+        last = self.send(self.bob, self.alice, "hey")
+        self.send(self.alice, self.carol, "yo")
+
+        bob_view = Conversation.objects.get(owner=self.bob, other_user=self.alice)
+        self.assertEqual((bob_view.last_message, bob_view.unread_count), (last, 1))
+        alice_view = Conversation.objects.get(owner=self.alice, other_user=self.bob)
+        self.assertEqual(alice_view.unread_count, 1)
+
+        rows, _ = conversations.recent_for(self.alice)
+        self.assertEqual([c.other_user for c in rows], [self.carol, self.bob])
+
+    def test_rebuild_matches_incremental(self):
+        for i in range(3):
+            self.send(self.alice, self.bob, f"m{i}")
+        self.send(self.carol, self.alice, "late")
+        fields = ("owner", "other_user", "room", "last_message", "unread_count")
+        before = sorted(Conversation.objects.values_list(*fields))
+        conversations.rebuild()
+        self.assertEqual(sorted(Conversation.objects.values_list(*fields)), before)
+
+    @override_settings(CHAT_RECENT_CHATS_PAGE_SIZE=2)
+    def test_recent_chats_page_is_one_query(self):
+        for other in (self.bob, self.carol):
+            self.send(other, self.alice, "hello")
+        dave = User.objects.create_user("dave", password="pw")
+        self.send(dave, self.alice, "hello")
+        self.client.force_login(self.alice)
+
+        with self.assertNumQueries(3):  # session, user, conversations
+            first = self.client.get("/home/")
+        self.assertEqual(
+            [c.other_user for c in first.context["chats"]], [dave, self.carol]
+        )
+        second = self.client.get("/home/", {"before": first.context["next_cursor"]})
+        self.assertEqual([c.other_user for c in second.context["chats"]], [self.bob])
+        self.assertIsNone(second.context["next_cursor"])
+
+
+class ReadReceiptTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob", password="pw")
+
+    async def test_read_up_to_marks_in_bulk_and_notifies_sender(self):
+        alice = await open_socket(self.alice, "bob")
+        await alice.receive_json_from()  # history
+        ids = []
+        for text in ("one", "two", "three"):
+            await alice.send_json_to({"message": text})
+            ids.append((await alice.receive_json_from())["id"])
+
+        bob = await open_socket(self.bob, "alice")
+        history_frame = await bob.receive_json_from()
+        self.assertEqual([m["id"] for m in history_frame["messages"]], ids)
+
+        queries = CaptureQueriesContext(connection)
+        await sync_to_async(queries.__enter__)()
+        await bob.send_json_to({"type": "read", "up_to": ids[1]})
+        receipt = await alice.receive_json_from()
+        await sync_to_async(queries.__exit__)(None, None, None)
+
+        self.assertEqual(receipt, {"type": "read", "reader": "bob", "up_to": ids[1]})
+        self.assertTrue(await bob.receive_nothing())
+        statements = await sync_to_async(
+            lambda: [
+                q["sql"].split()[0]
+                for q in queries.captured_queries
+                if "SAVEPOINT" not in q["sql"]
+            ]
+        )()
+        self.assertEqual(statements, ["UPDATE", "UPDATE"])
+
+        unread = await sync_to_async(conversations.unread_counts)(self.bob)
+        self.assertEqual(unread, {self.alice.id: 1})
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+@override_settings(CHAT_DIRECTORY_PAGE_SIZE=2)
+class UserDirectoryTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.me = User.objects.create_user("me", password="pw")
+        for name in ("ann", "anna", "annie", "bob", "anton"):
+            User.objects.create_user(name, password="pw")
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.me)
+
+    def test_prefix_search_pages_by_username(self):
+        first = self.client.get("/users/search/", {"q": "ann"}).json()
+        self.assertEqual([u["username"] for u in first["users"]], ["ann", "anna"])
+        second = self.client.get(
+            "/users/search/", {"q": "ann", "after": first["next"]}
+        ).json()
+        self.assertEqual([u["username"] for u in second["users"]], ["annie"])
+        self.assertIsNone(second["next"])
+        self.assertEqual(set(second["users"][0]), {"id", "username", "last_login"})
+
+    def test_html_page_excludes_me_and_is_constant_queries(self):
+        with self.assertNumQueries(4):  # session, user, page, unread counts
+            response = self.client.get("/users/")
+        self.assertEqual(
+            [u["username"] for u in response.context["users"]], ["ann", "anna"]
+        )
+        response = self.client.get("/users/", {"after": "anton"})
+        self.assertEqual([u["username"] for u in response.context["users"]], ["bob"])
+
+
+@override_settings(CHAT_SEARCH_PAGE_SIZE=2)
+class MessageSearchTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob", password="pw")
+        cls.carol = User.objects.create_user("carol", password="pw")
+        texts = [
+            (cls.alice, cls.bob, "pizza tonight?"),
+            (cls.bob, cls.alice, "pizza pizza pizza, always pizza"),
+            (cls.alice, cls.bob, "what about the meeting"),
+            (cls.carol, cls.alice, "pizza with carol"),
+            (cls.bob, cls.carol, "secret pizza without alice"),
+        ]
+        for sender, recipient, text in texts:
+            message = Message.objects.create(
+                sender=sender,
+                recipient=recipient,
+                conversation=make_room(sender, recipient),
+                message=text,
+            )
+            conversations.record_messages([message])
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.alice)
+
+    def test_group_rooms_are_searched(self):
+        team = groups.create(self.bob, "Team", [self.alice])
+        Message.objects.create(
+            sender=self.bob, conversation=team, message="pizza for the team"
+        )
+        outsiders = groups.create(self.bob, "Others", [self.carol])
+        Message.objects.create(
+            sender=self.bob, conversation=outsiders, message="pizza for the others"
+        )
+        found = [
+            m.message for m in search.search_messages(self.alice, "pizza", limit=10)[0]
+        ]
+        self.assertIn("pizza for the team", found)
+        self.assertNotIn("pizza for the others", found)
+
+    def test_ranked_pages_over_own_rooms_only(self):
+        first = self.client.get("/search/", {"q": "pizza"}).json()
+        self.assertEqual(
+            first["results"][0]["content"], "pizza pizza pizza, always pizza"
+        )
+        second = self.client.get(
+            "/search/", {"q": "pizza", "after": first["next"]}
+        ).json()
+        self.assertIsNone(second["next"])
+        found = [r["content"] for r in first["results"] + second["results"]]
+        self.assertEqual(len(found), 3)
+        self.assertNotIn("secret pizza without alice", found)
+
+    def test_stemming_and_new_messages_are_indexed(self):
+        Message.objects.bulk_create(
+            [
+                Message(
+                    sender=self.bob,
+                    recipient=self.alice,
+                    conversation=make_room(self.alice, self.bob),
+                    message="meetings moved",
+                )
+            ]
+        )
+        results = self.client.get("/search/", {"q": "meeting"}).json()["results"]
+        self.assertEqual(
+            {r["content"] for r in results},
+            {"what about the meeting", "meetings moved"},
+        )
+
+    def test_query_syntax_is_treated_as_text(self):
+        response = self.client.get("/search/", {"q": 'pizza" OR NEAR('})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["results"], [])
+
+
+@override_settings(CHAT_PRESENCE_COALESCE=0)
+class PresenceTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob", password="pw")
+        cls.carol = User.objects.create_user("carol", password="pw")
+        message = Message.objects.create(
+            sender=cls.alice,
+            recipient=cls.bob,
+            conversation=make_room(cls.alice, cls.bob),
+            message="hi",
+        )
+        conversations.record_messages([message])
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        patcher = mock.patch.object(presence, "tracker", presence.PresenceTracker())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def socket(self, user, other_username):
+        communicator = await open_socket(user, other_username)
+        return communicator, await communicator.receive_json_from()
+
+    async def test_refcounted_and_only_sent_to_contacts(self):
+        bob, _ = await self.socket(self.bob, "alice")
+        carol, _ = await self.socket(self.carol, "bob")
+
+        first, history_frame = await self.socket(self.alice, "bob")
+        self.assertTrue(history_frame["peer_online"])
+        self.assertEqual(
+            await bob.receive_json_from(),
+            {"type": "presence", "user": "alice", "online": True},
+        )
+        second, _ = await self.socket(self.alice, "carol")
+
+        await first.disconnect()
+        self.assertTrue(await bob.receive_nothing(timeout=0.2))
+        await second.disconnect()
+        self.assertEqual(
+            await bob.receive_json_from(),
+            {"type": "presence", "user": "alice", "online": False},
+        )
+        self.assertTrue(await carol.receive_nothing(timeout=0.2))
+        await bob.disconnect()
+        await carol.disconnect()
+
+    @override_settings(CHAT_PRESENCE_COALESCE=0.2)
+    async def test_flapping_is_coalesced(self):
+        bob, _ = await self.socket(self.bob, "alice")
+        for _ in range(3):
+            alice, _ = await self.socket(self.alice, "bob")
+            await alice.disconnect()
+        alice, _ = await self.socket(self.alice, "bob")
+
+        self.assertEqual((await bob.receive_json_from())["online"], True)
+        self.assertTrue(await bob.receive_nothing(timeout=0.4))
+        await alice.disconnect()
+        await bob.disconnect()
+
+    @override_settings(CHAT_PRESENCE_COALESCE=0)
+    async def test_workers_sharing_a_cache_announce_each_change_once(self):
+        first, second = presence.PresenceTracker(), presence.PresenceTracker()
+        layer = get_channel_layer()
+        with mock.patch.object(layer, "group_send") as group_send:
+            await first.connect(self.alice, "first")
+            await asyncio.sleep(0.05)
+            await second.connect(self.alice, "second")
+            await asyncio.sleep(0.05)
+            await first.disconnect("first")
+            await asyncio.sleep(0.05)
+            # The last socket closes on the worker that never announced alice online
+            await second.disconnect("second")
+            await asyncio.sleep(0.05)
+        events = [call.args[1]["online"] for call in group_send.call_args_list]
+        self.assertEqual(events, [True, False])
+
+    async def test_silent_socket_expires(self):
+        alice, _ = await self.socket(self.alice, "bob")
+        self.assertTrue(await presence.tracker.is_online(self.alice.id))
+
+        with self.settings(CHAT_PRESENCE_TTL=0):
+            await presence.tracker.sweep()
+        self.assertEqual((await alice.receive_output())["type"], "websocket.close")
+        self.assertFalse(await presence.tracker.is_online(self.alice.id))
+        await alice.disconnect()
+
+
+class MultiplexedSocketTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob", password="pw")
+        cls.carol = User.objects.create_user("carol", password="pw")
+        Message.objects.create(
+            sender=cls.bob,
+            recipient=cls.alice,
+            conversation=make_room(cls.alice, cls.bob),
+            message="old",
+        )
+
+    async def test_one_socket_serves_several_conversations(self):
+        alice = await open_multiplexed_socket(self.alice)
+        await alice.send_json_to({"type": "subscribe", "peer": "bob"})
+        bob_history = await alice.receive_json_from()
+        await alice.send_json_to({"type": "subscribe", "peer": "carol"})
+        carol_history = await alice.receive_json_from()
+        self.assertEqual(bob_history["type"], "history")
+        self.assertEqual([m["content"] for m in bob_history["messages"]], ["old"])
+        self.assertEqual(carol_history["messages"], [])
+        self.assertNotEqual(bob_history["room"], carol_history["room"])
+
+        # Peers on the per-peer route land in the right conversation
+        bob = await open_socket(self.bob, "alice")
+        await bob.receive_json_from()
+        await bob.send_json_to({"message": "hi alice"})
+        await bob.receive_json_from()  # own echo
+        frame = await alice.receive_json_from()
+        self.assertEqual(frame["type"], "message")
+        self.assertEqual(
+            (frame["room"], frame["message"]), (bob_history["room"], "hi alice")
+        )
+
+        await alice.send_json_to(
+            {"type": "message", "room": bob_history["room"], "message": "hi bob"}
+        )
+        self.assertEqual((await bob.receive_json_from())["message"], "hi bob")
+        self.assertEqual((await alice.receive_json_from())["sender"], "alice")
+
+        await bob.disconnect()
+        await alice.disconnect()
+
+    async def test_closed_conversations_arrive_as_notifications(self):
+        alice = await open_multiplexed_socket(self.alice)
+        carol = await open_socket(self.carol, "alice")
+        await carol.receive_json_from()
+
+        await carol.send_json_to({"message": "ping me"})
+        frame = await alice.receive_json_from()
+        self.assertEqual(
+            (frame["type"], frame["sender"], frame["message"]),
+            ("notify", "carol", "ping me"),
+        )
+
+        await alice.send_json_to({"type": "subscribe", "peer": "carol"})
+        room = (await alice.receive_json_from())["room"]
+        await alice.send_json_to({"type": "unsubscribe", "room": room})
+        await carol.send_json_to({"message": "again"})
+        self.assertEqual((await alice.receive_json_from())["type"], "notify")
+        self.assertTrue(await alice.receive_nothing(timeout=0.1))
+
+        await carol.disconnect()
+        await alice.disconnect()
+
+    async def test_rejects_unknown_rooms_and_anonymous_users(self):
+        alice = await open_multiplexed_socket(self.alice)
+        await alice.send_json_to({"type": "subscribe", "peer": "nobody"})
+        self.assertEqual((await alice.receive_json_from())["error"], "unknown user")
+        await alice.send_json_to({"type": "message", "room": 12345, "message": "hi"})
+        self.assertEqual((await alice.receive_json_from())["error"], "not subscribed")
+        await alice.disconnect()
+
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/")
+        communicator.scope["user"] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+
+@skipUnless(wire.MSGPACK, "msgpack is not installed")
+class WireEncodingTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob", password="pw")
+        Message.objects.create(
+            sender=cls.bob,
+            recipient=cls.alice,
+            conversation=make_room(cls.alice, cls.bob),
+            message="old",
+        )
+
+    async def test_json_clients_get_the_original_frames(self):
+        alice = await open_socket(self.alice, "bob")
+        history_frame = await alice.receive_json_from()
+        self.assertEqual(
+            set(history_frame), {"type", "messages", "cursor", "peer_online"}
+        )
+        self.assertEqual(
+            set(history_frame["messages"][0]), {"id", "sender", "content", "timestamp"}
+        )
+
+        await alice.send_json_to({"message": "hi"})
+        frame = await alice.receive_json_from()
+        self.assertEqual(
+            set(frame), {"type", "room", "id", "sender", "message", "timestamp"}
+        )
+        self.assertRegex(frame["timestamp"], r"^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d$")
+        await alice.disconnect()
+
+    async def test_msgpack_clients_get_compact_frames(self):
+        alice = await open_socket(
+            self.alice, "bob", subprotocols=[wire.MSGPACK_SUBPROTOCOL]
+        )
+        history_frame = wire.msgpack.unpackb(
+            await alice.receive_from(), strict_map_key=False
+        )
+        self.assertEqual(history_frame["t"], "history")
+        self.assertEqual(
+            history_frame["n"], {self.alice.id: "alice", self.bob.id: "bob"}
+        )
+        (old,) = history_frame["m"]
+        self.assertEqual((old["u"], old["b"]), (self.bob.id, "old"))
+        self.assertIsInstance(old["s"], int)
+
+        # A JSON client in the same room still gets its own format
+        bob = await open_socket(self.bob, "alice")
+        await bob.receive_json_from()
+        await alice.send_to(bytes_data=wire.msgpack.packb({"b": "hi"}))
+        frame = wire.msgpack.unpackb(await alice.receive_from())
+        self.assertEqual((frame["u"], frame["b"]), (self.alice.id, "hi"))
+        self.assertNotIn("sender", frame)
+        self.assertEqual((await bob.receive_json_from())["sender"], "alice")
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_broadcasts_are_encoded_once(self):
+        sockets = [
+            await open_socket(self.alice, "bob"),
+            await open_socket(self.bob, "alice"),
+        ]
+        sockets.append(await open_socket(self.bob, "alice"))
+        for communicator in sockets:
+            await communicator.receive_json_from()
+
+        with mock.patch.object(wire.JSON, "encode", wraps=wire.JSON.encode) as encode:
+            await sockets[0].send_json_to({"message": "once"})
+            frames = [await communicator.receive_from() for communicator in sockets]
+        self.assertEqual(encode.call_count, 1)
+        self.assertEqual(len(set(frames)), 1)
+        for communicator in sockets:
+            await communicator.disconnect()
+
+    def test_compact_frames_are_smaller(self):
+        frame = {
+            "type": "history",
+            "cursor": None,
+            "users": {1: "alice", 2: "bob"},
+            "messages": [
+                {
+                    "id": i,
+                    "sender": "alice",
+                    "sender_id": 1,
+                    "content": "hello there",
+                    "timestamp": 1700000000 + i,
+                }
+                for i in range(50)
+            ],
+        }
+        text = wire.JSON.encode(frame)["text_data"].encode()
+        binary = wire.MSGPACK.encode(frame)["bytes_data"]
+        self.assertLess(len(binary), len(text) / 2)
+
+
+@override_settings(CHAT_GROUP_BATCH_WINDOW=0.05)
+class GroupRoomTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob_b", password="pw")
+        cls.carol = User.objects.create_user("carol", password="pw")
+        cls.room = groups.create(cls.alice, "Team", [cls.bob])
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    async def group_socket(self, user, room_id=None):
+        room_id = room_id or self.room.id
+        communicator = WebsocketCommunicator(
+            GroupChatConsumer.as_asgi(), f"/ws/room/{room_id}/"
+        )
+        communicator.scope["user"] = user
+        communicator.scope["url_route"] = {"kwargs": {"room_id": str(room_id)}}
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_members_receive_messages_in_batches(self):
+        alice, _ = await self.group_socket(self.alice)
+        bob, _ = await self.group_socket(self.bob)
+        history_frame = await bob.receive_json_from()
+        self.assertEqual(
+            (history_frame["room"], history_frame["title"]), (self.room.id, "Team")
+        )
+        await alice.receive_json_from()
+
+        layer = get_channel_layer()
+        with mock.patch.object(
+            layer, "group_send", wraps=layer.group_send
+        ) as group_send:
+            for text in ("one", "two", "three"):
+                await alice.send_json_to({"message": text})
+            received = [await bob.receive_json_from() for _ in range(3)]
+        self.assertEqual([f["message"] for f in received], ["one", "two", "three"])
+        self.assertEqual({f["sender"] for f in received}, {"alice"})
+        self.assertEqual(group_send.call_count, 1)
+        self.assertEqual(
+            await Message.objects.filter(conversation_id=self.room.id).acount(), 3
+        )
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_non_members_are_refused(self):
+        _, connected = await self.group_socket(self.carol)
+        self.assertFalse(connected)
+        _, connected = await self.group_socket(
+            self.alice,
+            room_id=(await sync_to_async(make_room)(self.alice, self.carol)).id,
+        )
+        self.assertFalse(connected)
+
+        carol = await open_multiplexed_socket(self.carol)
+        await carol.send_json_to({"type": "subscribe", "room": self.room.id})
+        self.assertEqual((await carol.receive_json_from())["error"], "not a member")
+        await carol.disconnect()
+
+    async def test_multiplexed_socket_and_leaving(self):
+        alice = await open_multiplexed_socket(self.alice)
+        await alice.send_json_to({"type": "subscribe", "room": self.room.id})
+        self.assertEqual((await alice.receive_json_from())["title"], "Team")
+        bob, _ = await self.group_socket(self.bob)
+        await bob.receive_json_from()
+
+        await bob.send_json_to({"message": "hello team"})
+        frame = await alice.receive_json_from()
+        self.assertEqual(
+            (frame["type"], frame["room"], frame["sender"]),
+            ("message", self.room.id, "bob_b"),
+        )
+        await bob.receive_json_from()  # own echo
+
+        # What groups.leave broadcasts once its transaction commits
+        await get_channel_layer().group_send(
+            groups.group_name(self.room.id),
+            {
+                "type": "room_members",
+                "room": self.room.id,
+                "user": "bob_b",
+                "user_id": self.bob.id,
+                "joined": False,
+            },
+        )
+        self.assertEqual((await bob.receive_output())["type"], "websocket.close")
+        self.assertEqual((await alice.receive_json_from())["type"], "members")
+        await alice.disconnect()
+
+    def test_membership_is_cached_and_invalidated_on_join_and_leave(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                groups.member_ids(self.room.id), {self.alice.id, self.bob.id}
+            )
+            groups.member_ids(self.room.id)
+
+        self.client.force_login(self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("join_group", args=[self.room.id]), {"username": "carol"}
+            )
+            self.assertEqual(response.status_code, 200)
+        self.assertIn(self.carol.id, groups.member_ids(self.room.id))
+        self.client.force_login(self.carol)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("leave_group", args=[self.room.id]))
+        self.assertNotIn(self.carol.id, groups.member_ids(self.room.id))
+
+    def test_only_members_can_add_people(self):
+        self.client.force_login(self.carol)
+        for username in ("carol", "alice"):
+            response = self.client.post(
+                reverse("join_group", args=[self.room.id]), {"username": username}
+            )
+            self.assertEqual(response.status_code, 403)
+        self.assertNotIn(self.carol.id, groups.member_ids(self.room.id))
+
+    def test_create_group(self):
+        self.client.force_login(self.carol)
+        response = self.client.post(
+            reverse("create_group"), {"title": "Book club", "members": ["alice"]}
+        )
+        self.assertEqual(response.status_code, 201)
+        room = ChatRoom.objects.get(id=response.json()["room"])
+        self.assertTrue(room.is_group)
+        self.assertEqual(groups.member_ids(room.id), {self.carol.id, self.alice.id})
+        response = self.client.post(
+            reverse("create_group"), {"title": "x", "members": ["nobody"]}
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CHAT_RATE_LIMIT_RATE=0, CHAT_RATE_LIMIT_USER_RATE=0)
+class RateLimitTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob", password="pw")
+
+    def setUp(self):
+        super().setUp()
+        for name, value in (
+            ("user_buckets", ratelimit.UserBuckets()),
+            ("metrics", Counter()),
+        ):
+            patcher = mock.patch.object(ratelimit, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        cache.clear()
+
+    async def send_all(self, communicator, count):
+        replies = []
+        for i in range(count):
+            await communicator.send_json_to({"message": f"m{i}"})
+            replies.append(await communicator.receive_json_from())
+        return replies
+
+    @override_settings(CHAT_RATE_LIMIT_RATE=0.001, CHAT_RATE_LIMIT_BURST=2)
+    async def test_connection_bucket_rejects_before_saving(self):
+        alice = await open_socket(self.alice, "bob")
+        await alice.receive_json_from()
+        replies = await self.send_all(alice, 3)
+        self.assertEqual(
+            [r.get("type") for r in replies], ["message", "message", "error"]
+        )
+        self.assertEqual(replies[2]["error"], "rate limited")
+        self.assertGreater(replies[2]["retry_after"], 0)
+        self.assertEqual(await Message.objects.acount(), 2)
+        self.assertEqual(ratelimit.metrics["throttled_connection"], 1)
+
+        # Pings are never throttled
+        await alice.send_json_to({"type": "ping"})
+        self.assertEqual(await alice.receive_json_from(), {"type": "pong"})
+        await alice.disconnect()
+
+    @override_settings(
+        CHAT_RATE_LIMIT_RATE=0.001,
+        CHAT_RATE_LIMIT_BURST=1,
+        CHAT_RATE_LIMIT_CONTROL_RATE=0.001,
+        CHAT_RATE_LIMIT_CONTROL_BURST=2,
+    )
+    async def test_control_frames_have_their_own_bucket(self):
+        alice = await open_socket(self.alice, "bob")
+        await alice.receive_json_from()
+        replies = await self.send_all(alice, 2)
+        self.assertEqual(replies[1]["rejected"], {"message": "m1"})
+
+        # Catching up still works with the message budget spent, up to its own limit
+        for _ in range(2):
+            await alice.send_json_to({"type": "resume", "after": 0})
+            self.assertEqual((await alice.receive_json_from())["type"], "resume")
+        await alice.send_json_to({"type": "resume", "after": 0})
+        reply = await alice.receive_json_from()
+        self.assertEqual(
+            (reply["error"], reply["rejected"]["type"]), ("rate limited", "resume")
+        )
+        self.assertEqual(ratelimit.metrics["throttled_control"], 1)
+        await alice.disconnect()
+
+    @override_settings(CHAT_RATE_LIMIT_USER_RATE=0.001, CHAT_RATE_LIMIT_USER_BURST=2)
+    async def test_user_bucket_is_shared_by_all_sockets(self):
+        first, second = (
+            await open_socket(self.alice, "bob"),
+            await open_socket(self.alice, "bob"),
+        )
+        await first.receive_json_from()
+        await second.receive_json_from()
+
+        await first.send_json_to({"message": "one"})
+        await second.send_json_to({"message": "two"})
+        for _ in range(2):
+            await first.receive_json_from()
+            await second.receive_json_from()
+        await second.send_json_to({"message": "three"})
+        self.assertEqual((await second.receive_json_from())["error"], "rate limited")
+        self.assertEqual(ratelimit.metrics["throttled_user"], 1)
+
+        # Other users have their own bucket
+        bob = await open_socket(self.bob, "alice")
+        await bob.receive_json_from()
+        self.assertEqual((await self.send_all(bob, 1))[0]["type"], "message")
+        for communicator in (first, second, bob):
+            await communicator.disconnect()
+
+    @override_settings(
+        CHAT_RATE_LIMIT_RATE=20, CHAT_RATE_LIMIT_BURST=1, CHAT_RATE_LIMIT_MODE="delay"
+    )
+    async def test_delay_mode_holds_frames_back(self):
+        alice = await open_socket(self.alice, "bob")
+        await alice.receive_json_from()
+        started = time.monotonic()
+        replies = await self.send_all(alice, 3)
+        self.assertEqual({r["type"] for r in replies}, {"message"})
+        self.assertGreaterEqual(time.monotonic() - started, 0.08)
+        self.assertEqual(ratelimit.metrics["delayed"], 2)
+        await alice.disconnect()
+
+    @override_settings(CHAT_RATE_LIMIT_USER_RATE=2, CHAT_RATE_LIMIT_BACKEND="cache")
+    async def test_cache_backend_counts_per_second(self):
+        limiter = ratelimit.Limiter(self.alice.id)
+        with mock.patch.object(ratelimit.time, "time", return_value=1000.25):
+            waits = [(await limiter.wait_time())[1] for _ in range(3)]
+        self.assertEqual(waits, [0, 0, 0.75])
+
+
+@override_settings(
+    CHAT_RATE_LIMIT_RATE=0, CHAT_RATE_LIMIT_USER_RATE=0, CHAT_OUTBOUND_QUEUE_LIMIT=5
+)
+class BackpressureTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob", password="pw")
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(backpressure, "metrics", Counter())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def flood_with_slow_reader(self, count=30):
+        """
+        alice sends `count` messages; returns (alice, bob, seconds alice took to
+        get all echoes).
+        """
+        bob = await open_socket(
+            self.bob,
+            "alice",
+            application=benchmarks.slow_reader(PrivateChatConsumer.as_asgi(), 0.2),
+        )
+        await bob.receive_json_from()
+        alice = await open_socket(self.alice, "bob")
+        await alice.receive_json_from()
+
+        started = time.monotonic()
+        for i in range(count):
+            await alice.send_json_to({"message": f"m{i}"})
+        for _ in range(count):
+            await alice.receive_json_from()
+        return alice, bob, time.monotonic() - started
+
+    async def drain(self, communicator):
+        frames = []
+        while not await communicator.receive_nothing(timeout=0.5):
+            frames.append(await communicator.receive_json_from())
+        return frames
+
+    @override_settings(CHAT_OUTBOUND_QUEUE_POLICY="drop_oldest")
+    async def test_slow_reader_is_bounded_and_fast_reader_unaffected(self):
+        alice, bob, elapsed = await self.flood_with_slow_reader()
+        # Written in lockstep with bob this would take 30 * 0.2s
+        self.assertLess(elapsed, 3)
+        self.assertLessEqual(backpressure.metrics["peak_depth"], 5)
+        self.assertGreaterEqual(backpressure.metrics["dropped"], 20)
+
+        frames = await self.drain(bob)
+        self.assertLessEqual(len(frames), 7)
+        self.assertEqual(frames[-1]["message"], "m29")
+        await alice.disconnect()
+        await bob.disconnect()
+
+    @override_settings(CHAT_OUTBOUND_QUEUE_POLICY="coalesce")
+    async def test_coalesce_replaces_backlog_with_resync(self):
+        alice, bob, _ = await self.flood_with_slow_reader()
+        frames = await self.drain(bob)
+        resyncs = [f for f in frames if f.get("type") == "resync"]
+        self.assertTrue(resyncs)
+        self.assertEqual(
+            resyncs[0]["rooms"],
+            [await sync_to_async(lambda: make_room(self.alice, self.bob).id)()],
+        )
+        self.assertLessEqual(len(frames), 7)
+        await alice.disconnect()
+        await bob.disconnect()
+
+    @override_settings(CHAT_OUTBOUND_QUEUE_POLICY="disconnect")
+    async def test_disconnect_policy_closes_slow_socket(self):
+        alice, bob, elapsed = await self.flood_with_slow_reader()
+        self.assertLess(elapsed, 3)
+        output = await bob.receive_output(timeout=5)
+        while output["type"] != "websocket.close":
+            output = await bob.receive_output(timeout=5)
+        self.assertEqual(output["code"], backpressure.SLOW_CONSUMER)
+        self.assertEqual(backpressure.metrics["disconnected"], 1)
+        await alice.disconnect()
+
+
+@override_settings(
+    CHAT_MESSAGE_DURABILITY="batched",
+    CHAT_WRITE_BEHIND_BATCH_SIZE=2,
+    CHAT_WRITE_BEHIND_FLUSH_INTERVAL=60,
+)
+class WriteBehindTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob", password="pw")
+
+    async def test_broadcast_before_write_and_flush_on_disconnect(self):
+        count = sync_to_async(lambda: Message.objects.count())
+        communicator = await open_socket(self.alice, "bob")
+        await communicator.receive_json_from()  # history
+
+        await communicator.send_json_to({"message": "one"})
+        self.assertEqual((await communicator.receive_json_from())["message"], "one")
+        self.assertEqual(await count(), 0)
+
+        for text in ("two", "three"):
+            await communicator.send_json_to({"message": text})
+            await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        saved = await sync_to_async(
+            lambda: list(
+                Message.objects.order_by("time_stamp").values_list("message", flat=True)
+            )
+        )()
+        self.assertEqual(saved, ["one", "two", "three"])
+
+
+class ChannelLayerSettingsTests(SimpleTestCase):
+    def test_memory_is_default(self):
+        self.assertEqual(
+            channel_layers_from_env({})["default"]["BACKEND"],
+            "channels.layers.InMemoryChannelLayer",
+        )
+
+    def test_redis_hosts_are_sharded_in_order(self):
+        config = channel_layers_from_env(
+            {
+                "CHANNEL_LAYER": "redis",
+                "CHANNEL_REDIS_URLS": "redis://a:6379, redis://b:6379",
+            }
+        )["default"]
+        self.assertEqual(config["BACKEND"], "channels_redis.core.RedisChannelLayer")
+        self.assertEqual(
+            config["CONFIG"]["hosts"], ["redis://a:6379", "redis://b:6379"]
+        )
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            channel_layers_from_env({"CHANNEL_LAYER": "carrier-pigeon"})
+
+
+class DatabaseSettingsTests(SimpleTestCase):
+    def test_connections_close_by_default(self):
+        config = databases_from_env({"DATABASE_URL": "postgres://u:p@db/chat"})[
+            "default"
+        ]
+        self.assertEqual(
+            (config["CONN_MAX_AGE"], config["CONN_HEALTH_CHECKS"]), (0, False)
+        )
+        self.assertNotIn("pool", config.get("OPTIONS", {}))
+        self.assertEqual(databases_from_env({}), {"default": {}})
+
+    def test_persistent_connections_are_health_checked(self):
+        config = databases_from_env(
+            {"DATABASE_URL": "postgres://u:p@db/chat", "DB_CONN_MAX_AGE": "600"}
+        )["default"]
+        self.assertEqual(
+            (config["CONN_MAX_AGE"], config["CONN_HEALTH_CHECKS"]), (600, True)
+        )
+        config = databases_from_env(
+            {
+                "DATABASE_URL": "postgres://u:p@db/chat",
+                "DB_CONN_MAX_AGE": "none",
+                "DB_CONN_HEALTH_CHECKS": "0",
+            }
+        )["default"]
+        self.assertEqual(
+            (config["CONN_MAX_AGE"], config["CONN_HEALTH_CHECKS"]), (None, False)
+        )
+
+    def test_pool_on_postgres_only(self):
+        config = databases_from_env(
+            {
+                "DATABASE_URL": "postgres://u:p@db/chat",
+                "DB_CONN_MAX_AGE": "60",
+                "DB_POOL": "1",
+                "DB_POOL_MAX_SIZE": "20",
+            }
+        )["default"]
+        self.assertEqual(config["CONN_MAX_AGE"], 0)
+        self.assertEqual(
+            config["OPTIONS"]["pool"], {"min_size": 2, "max_size": 20, "timeout": 10.0}
+        )
+        with self.assertRaises(ValueError):
+            databases_from_env(
+                {"DATABASE_URL": "sqlite:////tmp/chat.sqlite3", "DB_POOL": "1"}
+            )
+
+    def test_pool_needs_django_5_1(self):
+        with (
+            mock.patch("django.VERSION", (5, 0, 2, "final", 0)),
+            self.assertRaises(ValueError),
+        ):
+            databases_from_env(
+                {"DATABASE_URL": "postgres://u:p@db/chat", "DB_POOL": "1"}
+            )
+
+    def test_sqlite_writers_lock_when_their_transaction_begins(self):
+        config = databases_from_env({"DATABASE_URL": "sqlite:////tmp/chat.sqlite3"})[
+            "default"
+        ]
+        self.assertEqual(config["OPTIONS"]["transaction_mode"], "IMMEDIATE")
+        with mock.patch("django.VERSION", (5, 0, 2, "final", 0)):
+            config = databases_from_env(
+                {"DATABASE_URL": "sqlite:////tmp/chat.sqlite3"}
+            )["default"]
+        self.assertNotIn("transaction_mode", config.get("OPTIONS", {}))
+
+
+class ConnectionReuseTests(TransactionTestCase):
+    """
+    The consumer's DB calls close their connection afterwards unless CONN_MAX_AGE
+    keeps it.
+    """
+
+    def setUp(self):
+        historycache.local_rooms.clear()
+        self.alice = User.objects.create_user("alice", password="pw")
+        User.objects.create_user("bob", password="pw")
+
+    def closes_while_chatting(self, max_age, count=5):
+        # The consumer's sync calls run on this thread, so this is the connection
+        # they use
+        wrapper = connections["default"]
+        settings_patch = mock.patch.dict(
+            wrapper.settings_dict, {"CONN_MAX_AGE": max_age}
+        )
+        settings_patch.start()
+        self.addCleanup(settings_patch.stop)
+        # What connect() would have set had the connection been opened with these
+        # settings
+        wrapper.close_at = None if max_age is None else time.monotonic() + max_age
+
+        closes = []
+        close = type(wrapper).close
+
+        def counted_close(self):
+            closes.append(self.alias)
+            return close(self)
+
+        async def chat():
+            communicator = await open_socket(self.alice, "bob")
+            await communicator.receive_json_from()
+            # channels' test communicator stubs out close_old_connections; put the
+            # real one back
+            with (
+                mock.patch("channels.testing.application.no_op", close_old_connections),
+                mock.patch.object(type(wrapper), "close", counted_close),
+            ):
+                for i in range(count):
+                    await communicator.send_json_to({"message": f"m{i}"})
+                    await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        async_to_sync(chat)()
+        return len(closes)
+
+    def test_persistent_connection_is_reused_across_messages(self):
+        self.assertEqual(self.closes_while_chatting(60), 0)
+
+    def test_connection_is_closed_after_each_call_without_persistence(self):
+        self.assertGreaterEqual(self.closes_while_chatting(0), 5)
+
+
+class DatabaseExecutorTests(TransactionTestCase):
+    def setUp(self):
+        historycache.local_rooms.clear()
+        dbexecutor.metrics.clear()
+        self.addCleanup(dbexecutor.pool.shutdown)
+
+    async def test_calls_are_bounded_by_the_thread_count_and_their_waits_counted(self):
+        running, most = 0, 0
+
+        def slow_query():
+            nonlocal running, most
+            running += 1
+            most = max(most, running)
+            time.sleep(0.05)
+            running -= 1
+            return threading.current_thread().name
+
+        with override_settings(CHAT_DB_THREADS=2):
+            names = await asyncio.gather(
+                *(dbexecutor.db_call(slow_query)() for _ in range(6))
+            )
+        self.assertTrue(all(name.startswith("chat-db") for name in names))
+        self.assertEqual(most, 2)
+        self.assertEqual(dbexecutor.metrics["calls"], 6)
+        self.assertEqual(dbexecutor.metrics["queued"], 0)
+        # Two of the six can start straight away; the rest wait behind them
+        self.assertGreaterEqual(dbexecutor.metrics["peak_queued"], 4)
+        self.assertGreater(dbexecutor.metrics["max_wait_seconds"], 0.05)
+
+    async def test_consumer_saves_messages_through_the_pool(self):
+        alice = await sync_to_async(User.objects.create_user)("alice", password="pw")
+        await sync_to_async(User.objects.create_user)("bob", password="pw")
+        with override_settings(CHAT_DB_THREADS=2):
+            communicator = await open_socket(alice, "bob")
+            await communicator.receive_json_from()
+            await communicator.send_json_to({"message": "hi"})
+            self.assertEqual((await communicator.receive_json_from())["message"], "hi")
+            await communicator.disconnect()
+        self.assertEqual(await Message.objects.filter(message="hi").acount(), 1)
+        self.assertGreaterEqual(dbexecutor.metrics["calls"], 3)
+
+
+class AsyncORMConsumerTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+
+    async def test_history_and_saving_match_the_sync_consumer(self):
+        communicator = await open_socket(self.alice, "bob")
+        await communicator.receive_json_from()
+        for i in range(3):
+            await communicator.send_json_to({"message": f"m{i}"})
+            await communicator.receive_json_from()
+        await communicator.disconnect()
+        communicator = await open_socket(self.bob, "alice")
+        expected = await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        historycache.local_rooms.clear()
+        communicator = await open_socket(
+            self.bob, "alice", application=AsyncORMPrivateChatConsumer.as_asgi()
+        )
+        self.assertEqual(await communicator.receive_json_from(), expected)
+        await communicator.send_json_to({"message": "reply"})
+        echo = await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        saved = await Message.objects.aget(message="reply")
+        self.assertEqual(
+            (echo["id"], saved.sender_id, saved.recipient_id),
+            (saved.id, self.bob.id, self.alice.id),
+        )
+        summary = await Conversation.objects.aget(owner=self.alice)
+        self.assertEqual((summary.last_message_id, summary.unread_count), (saved.id, 1))
+
+    async def test_resume(self):
+        communicator = await open_socket(
+            self.alice, "bob", application=AsyncORMPrivateChatConsumer.as_asgi()
+        )
+        await communicator.receive_json_from()
+        for i in range(3):
+            await communicator.send_json_to({"message": f"m{i}"})
+            await communicator.receive_json_from()
+        await communicator.send_json_to(
+            {"type": "resume", "after": (await Message.objects.afirst()).id}
+        )
+        resume = await communicator.receive_json_from()
+        await communicator.disconnect()
+        self.assertEqual([m["content"] for m in resume["messages"]], ["m1", "m2"])
+
+    def test_setting_picks_the_consumer(self):
+        self.assertIs(private_chat_consumer(), PrivateChatConsumer)
+        with override_settings(CHAT_CONSUMER_ORM="async"):
+            self.assertIs(private_chat_consumer(), AsyncORMPrivateChatConsumer)
+
+
+class HistoryCacheSettingsTests(SimpleTestCase):
+    def test_defaults_follow_the_deployment(self):
+        self.assertEqual(history_cache_from_env({}), ("local", 100))
+        self.assertEqual(
+            history_cache_from_env({"CACHE_URL": "redis://cache:6379/1"}),
+            ("cache", 100),
+        )
+        # Several workers and nothing to share the cache through: off rather than stale
+        self.assertEqual(
+            history_cache_from_env({"CHANNEL_LAYER": "redis"}), ("local", 0)
+        )
+        env = {
+            "CHANNEL_LAYER": "redis",
+            "CHAT_HISTORY_CACHE_BACKEND": "local",
+            "CHAT_HISTORY_CACHE_SIZE": "50",
+        }
+        self.assertEqual(history_cache_from_env(env), ("local", 50))
+
+
+class SessionSettingsTests(SimpleTestCase):
+    def test_defaults_follow_cache_url(self):
+        self.assertEqual(
+            caches_from_env({})["default"]["BACKEND"],
+            "django.core.cache.backends.locmem.LocMemCache",
+        )
+        self.assertEqual(
+            session_engine_from_env({}), "django.contrib.sessions.backends.db"
+        )
+        env = {"CACHE_URL": "redis://cache:6379/1"}
+        self.assertEqual(
+            caches_from_env(env)["default"]["LOCATION"], "redis://cache:6379/1"
+        )
+        self.assertEqual(
+            session_engine_from_env(env), "django.contrib.sessions.backends.cached_db"
+        )
+        self.assertEqual(
+            session_engine_from_env({**env, "SESSION_BACKEND": "signed_cookies"}),
+            "django.contrib.sessions.backends.signed_cookies",
+        )
+
+    def test_unknown_values(self):
+        with self.assertRaises(ValueError):
+            session_engine_from_env({"SESSION_BACKEND": "filesystem"})
+        with self.assertRaises(ValueError):
+            caches_from_env({"CACHE_URL": "memcached://cache:11211"})
+
+
+@skipUnless(
+    importlib.util.find_spec("redis") and importlib.util.find_spec("fakeredis"),
+    "needs redis and fakeredis",
+)
+class SharedCacheSessionTests(ChatTestCase):
+    """cached_db sessions against a local Redis stand-in for the shared cache."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        urls, stop = benchmarks.start_fake_redis(1)
+        cls.addClassCleanup(stop)
+        cls.enterClassContext(
+            override_settings(
+                CACHES=caches_from_env({"CACHE_URL": urls[0]}),
+                SESSION_ENGINE=session_engine_from_env({"CACHE_URL": urls[0]}),
+            )
+        )
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+
+    def test_pages_read_sessions_from_the_cache(self):
+        self.client.force_login(self.alice)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(reverse("home")).status_code, 200)
+        self.assertFalse([q for q in queries if "django_session" in q["sql"]])
+
+        cookie = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.client.post(reverse("logout"))
+        other = self.client_class()
+        other.cookies[settings.SESSION_COOKIE_NAME] = cookie
+        self.assertEqual(other.get(reverse("home")).status_code, 302)
+
+
+@skipUnless(
+    importlib.util.find_spec("channels_redis")
+    and importlib.util.find_spec("fakeredis"),
+    "needs channels_redis and fakeredis",
+)
+class CrossWorkerDeliveryTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        urls, stop = benchmarks.start_fake_redis(2)
+        cls.addClassCleanup(stop)
+        cls.config = channel_layers_from_env(
+            {
+                "CHANNEL_LAYER": "redis",
+                "CHANNEL_REDIS_URLS": ",".join(urls),
+                "CHANNEL_LAYER_CAPACITY": "1000",
+            }
+        )["default"]
+
+    def test_group_send_reaches_every_worker(self):
+        report = benchmarks.cross_worker_fanout(self.config, workers=3, count=50)
+        self.assertEqual(report["received"], [50, 50, 50])
+        self.assertGreater(report["delivery_rate"], 0)
+
+    def test_groups_spread_over_shards(self):
+        layer = benchmarks.build_layer(self.config)
+        shards = {layer.consistent_hash(f"private_chat_{i}") for i in range(20)}
+        self.assertEqual(shards, {0, 1})
+
+
+@override_settings(CHAT_RATE_LIMIT_RATE=0, CHAT_RATE_LIMIT_USER_RATE=0)
+class LoadHarnessTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            User.objects.create_user(f"load{i}", password="pw") for i in range(4)
+        ]
+
+    async def test_clients_log_in_through_the_full_stack_and_time_echoes(self):
+        from django_project.asgi import application
+
+        cookies = {}
+        for user in self.users:
+            cookies[user.id] = await sync_to_async(loadtest.session_cookie)(user)
+        pairs = [(self.users[0], self.users[1]), (self.users[2], self.users[3])]
+        with loadtest.counting_queries() as query_count:
+            result = await loadtest.run_load(
+                lambda path, user: loadtest.InProcessClient(
+                    application, path, cookies[user.id]
+                ),
+                pairs,
+                3,
+                query_count,
+            )
+        self.assertEqual(
+            (len(result.connect_times), len(result.round_trips), result.resyncs),
+            (4, 12, 0),
+        )
+        self.assertGreater(result.queries, 0)
+        self.assertEqual(
+            await Message.objects.filter(sender__in=self.users).acount(), 12
+        )
+
+
+class AuthCacheTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pw")
+        cls.bob = User.objects.create_user("bob", password="pw")
+
+    def setUp(self):
+        super().setUp()
+        for name, value in (
+            ("session_users", auth.SessionUsers()),
+            ("metrics", Counter()),
+        ):
+            patcher = mock.patch.object(auth, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def scope(self, user):
+        cookie = loadtest.session_cookie(user)
+        return {"session": SessionStore(session_key=cookie.split("=", 1)[1])}
+
+    async def resolve(self, scope):
+        with loadtest.counting_queries() as query_count:
+            user = await auth.resolve_user(scope)
+        return user, query_count[0]
+
+    async def test_handshakes_after_the_first_skip_the_database(self):
+        scope = await sync_to_async(self.scope)(self.alice)
+        user, queries = await self.resolve(scope)
+        self.assertEqual((user.username, queries), ("alice", 2))
+        self.assertIn("email", user.get_deferred_fields())
+
+        user, queries = await self.resolve(
+            {"session": SessionStore(session_key=scope["session"].session_key)}
+        )
+        self.assertEqual((user.username, queries), ("alice", 0))
+        self.assertEqual((auth.metrics["misses"], auth.metrics["hits"]), (1, 1))
+
+        user, queries = await self.resolve({"session": SessionStore()})
+        self.assertEqual((user.is_authenticated, queries), (False, 0))
+
+    async def test_password_change_and_logout_drop_cached_sessions(self):
+        scope = await sync_to_async(self.scope)(self.alice)
+        await self.resolve(scope)
+        self.alice.set_password("new")
+        await self.alice.asave()
+        user, queries = await self.resolve(
+            {"session": SessionStore(session_key=scope["session"].session_key)}
+        )
+        self.assertFalse(user.is_authenticated)
+        self.assertGreater(queries, 0)
+
+        scope = await sync_to_async(self.scope)(self.bob)
+        await self.resolve(scope)
+        await sync_to_async(user_logged_out.send)(
+            sender=User, request=None, user=self.bob
+        )
+        self.assertEqual(auth.session_users.sessions, {})
+
+    def test_logout_from_another_thread_while_sessions_churn(self):
+        users = [mock.Mock(id=i % 10) for i in range(2000)]
+        errors = []
+
+        def churn():
+            try:
+                for i, user in enumerate(users):
+                    auth.session_users.put(f"{threading.get_ident()}-{i}", user)
+                    auth.session_users.get(f"{threading.get_ident()}-{i - 5}")
+            except Exception as exc:
+                errors.append(exc)
+
+        def log_out():
+            try:
+                for i in range(2000):
+                    auth.session_users.discard_user(i % 10)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [
+            threading.Thread(target=target)
+            for target in (churn, churn, log_out, log_out)
+        ]
+        # Switch threads as often as possible so unguarded iteration would trip
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    async def test_full_stack_authenticates_socket_from_cookie(self):
+        from django_project.asgi import application
+
+        cookie = await sync_to_async(loadtest.session_cookie)(self.alice)
+        client = loadtest.InProcessClient(application, "/ws/private/bob/", cookie)
+        await client.connect()
+        self.assertEqual((await client.receive())["type"], "history")
+        await client.close()
+
+        anonymous = loadtest.InProcessClient(application, "/ws/chat/", "sessionid=nope")
+        with self.assertRaises(ConnectionError):
+            await anonymous.connect()
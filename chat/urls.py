@@ -3,6 +3,12 @@ from . import views
 
 urlpatterns = [
     path('users/', views.availableUsers, name='show_users'),
-    path('room/<str:room_name>/', views.chatRoomView, name='chat_room'),
+    path('users/search/', views.user_directory, name='user_directory'),
+    path('room/<str:username>/', views.chatRoomView, name='chat_room'),
     path('home/', views.recent_chats, name='home'),
+    path('search/', views.search_messages, name='search_messages'),
+    path('rooms/', views.create_group, name='create_group'),
+    path('rooms/<int:room_id>/join/', views.join_group, name='join_group'),
+    path('rooms/<int:room_id>/leave/', views.leave_group, name='leave_group'),
+    path('rooms/<int:room_id>/history/', views.export_history, name='export_history'),
 ]
@@ -1,8 +1,12 @@
-from django.shortcuts import render, get_object_or_404
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q, Max
-from django.http import HttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render
+from django.views.decorators.http import require_POST
+
+from . import conversations, directory, groups, history, rooms, search
 from .models import ChatRoom, Message
 
 User = get_user_model()
@@ -10,67 +14,148 @@ User = get_user_model()
 
 @login_required
 def availableUsers(request):
-    """Show all users. If logged in, exclude the current user."""
-    if request.user.is_authenticated:
-        users = User.objects.exclude(id=request.user.id)
-    else:
-        users = User.objects.all()
+    """One page of other users, optionally filtered by username prefix."""
+    prefix = request.GET.get("q", "").strip()
+    users, next_after = directory.search(
+        exclude=request.user, prefix=prefix, after=request.GET.get("after")
+    )
 
-    return render(request, "chatRoomDashborad.html", {"users": users})
+    # Counter-backed: one indexed query instead of COUNT(*) over each history
+    unread = conversations.unread_counts(request.user)
+    for usr in users:
+        usr["unread"] = unread.get(usr["id"], 0)
+
+    return render(request, "chatRoomDashborad.html", {
+        "users": users,
+        "q": prefix,
+        "next_after": next_after,
+    })
 
 
 @login_required
-def recent_chats(request):
-    user = request.user
-    conversations = (
-        Message.objects.filter(Q(sender=user) | Q(recipient=user))
-        .select_related("sender", "recipient")
-        .order_by("-time_stamp")
+def user_directory(request):
+    """JSON flavour of availableUsers for incremental search-as-you-type."""
+    users, next_after = directory.search(
+        exclude=request.user,
+        prefix=request.GET.get("q", "").strip(),
+        after=request.GET.get("after"),
     )
+    for usr in users:
+        usr["last_login"] = usr["last_login"].isoformat() if usr["last_login"] else None
+    return JsonResponse({"users": users, "next": next_after})
 
-    chats = []
-    seen_users = set()
 
-    for msg in conversations:
-        other_user = msg.recipient if msg.sender == user else msg.sender
-        if other_user and other_user.id not in seen_users:
-            seen_users.add(other_user.id)
-            # build sorted room_name
-            usernames = sorted([user.username, other_user.username])
-            room_name = "_".join(usernames)
-            chats.append({
-                "message": msg,
-                "other_user": other_user,
-                "room_name": room_name
-            })
+@login_required
+def recent_chats(request):
+    """One page of the user's conversations, most recently active first."""
+    try:
+        chats, cursor = conversations.recent_for(
+            request.user, before=request.GET.get("before")
+        )
+    except history.InvalidCursor:
+        return HttpResponse("Invalid cursor.", status=400)
 
-    return render(request, "welcome.html", {"chats": chats})
+    return render(request, "welcome.html", {"chats": chats, "next_cursor": cursor})
 
 @login_required
 
 
-def chatRoomView(request, room_name):
+def chatRoomView(request, username):
     """
-    Open a chat room between the logged-in user and another user.
-    Room name is deterministic: alphabetically ordered "user1_user2".
+    Open the chat room between the logged-in user and `username`.
+    The room is keyed by both users' ids; see rooms.room_name.
     """
-    usernames = sorted(room_name.split("_"))
-    room_name = "_".join(usernames)
-
-    if request.user.username not in usernames:
-        return HttpResponse("You are not part of this conversation.", status=403)
-    room, _ = ChatRoom.objects.get_or_create(name=room_name)
-
-    
-    try:
-        other_username = next(u for u in usernames if u != request.user.username)
-    except StopIteration:
+    other_user = get_object_or_404(User, username=username)
+    if other_user == request.user:
         return HttpResponse("Invalid room.", status=400)
-
-    other_user = get_object_or_404(User, username=other_username)
+    room = rooms.get_or_create_room(request.user, other_user)
 
     return render(request, "chatRoom.html", {
         "room": room,
         "other_user": other_user,
     })
 
+
+@login_required
+def search_messages(request):
+    """Keyword search across every conversation the user is in, best match first."""
+    try:
+        results, cursor = search.search_messages(
+            request.user, request.GET.get("q", ""), after=request.GET.get("after")
+        )
+    except history.InvalidCursor:
+        return JsonResponse({"error": "invalid cursor"}, status=400)
+
+    return JsonResponse({
+        "results": [
+            {
+                "room": m.conversation_id,
+                "score": m.score,
+                **history.serialize(m),
+            }
+            for m in results
+        ],
+        "next": cursor,
+    })
+
+
+@login_required
+@require_POST
+def create_group(request):
+    """
+    Create a group room with the posted title and member usernames; the
+    creator is a member.
+    """
+    title = request.POST.get("title", "").strip()
+    if not title:
+        return JsonResponse({"error": "title is required"}, status=400)
+    usernames = set(request.POST.getlist("members"))
+    members = list(User.objects.filter(username__in=usernames))
+    if len(members) != len(usernames):
+        return JsonResponse({"error": "unknown members"}, status=400)
+
+    room = groups.create(request.user, title, members)
+    return JsonResponse({"room": room.id, "title": room.title}, status=201)
+
+
+@login_required
+@require_POST
+def join_group(request, room_id):
+    """A member adds the posted `username` to the room; nobody joins on their own."""
+    room = get_object_or_404(ChatRoom, id=room_id, is_group=True)
+    if request.user.id not in groups.member_ids(room.id):
+        return JsonResponse({"error": "not a member"}, status=403)
+    user = User.objects.filter(username=request.POST.get("username", "")).first()
+    if user is None:
+        return JsonResponse({"error": "unknown user"}, status=400)
+    groups.join(room, user)
+    return JsonResponse({"room": room.id, "user": user.username, "member": True})
+
+
+@login_required
+@require_POST
+def leave_group(request, room_id):
+    room = get_object_or_404(ChatRoom, id=room_id, is_group=True)
+    groups.leave(room, request.user)
+    return JsonResponse({"room": room.id, "member": False})
+
+
+@login_required
+def export_history(request, room_id):
+    """A room's whole history as JSON, streamed so it never sits in memory whole."""
+    room = get_object_or_404(ChatRoom, id=room_id)
+    if room.is_group:
+        member = request.user.id in groups.member_ids(room.id)
+    else:
+        # Room names can't be split back into usernames, which may contain "_"
+        member = Message.objects.filter(conversation=room).filter(
+            Q(sender=request.user) | Q(recipient=request.user)
+        ).exists()
+    if not member:
+        return JsonResponse({"error": "not a member"}, status=403)
+    # Under ASGI a sync iterator would be read into memory whole before sending
+    if isinstance(request, ASGIRequest):
+        stream = history.astream_json(room)
+    else:
+        stream = history.stream_json(room)
+    return StreamingHttpResponse(stream, content_type="application/json")
@@ -0,0 +1,156 @@
+"""
+Wire encodings for chat websocket frames.
+
+Consumers build every outgoing frame as a plain dict in which timestamps
+are integer Unix epochs and people appear both by name and by id (e.g.
+"sender" and "sender_id"). The encoding picked at handshake decides what
+actually goes on the socket:
+
+* JSON, the default and what existing clients speak: text frames with
+  usernames and "%Y-%m-%d %H:%M:%S" timestamps, exactly as before.
+* MessagePack, negotiated with the "chat.msgpack" websocket subprotocol:
+  binary frames with one-letter keys, integer timestamps and user ids in
+  place of usernames. History frames carry a {user id: username} map so
+  clients can still render names. Clients may send frames with either
+  the short or the long keys.
+
+MessagePack support needs the optional msgpack package; without it the
+subprotocol is simply never accepted and every client gets JSON.
+"""
+import json
+from datetime import datetime
+from datetime import timezone as dt_timezone
+
+from django.utils import timezone
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = "chat.msgpack"
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Outgoing long key -> short key. Frames never contain two long keys that
+# share a short one.
+SHORT_KEYS = {
+    "type": "t",
+    "room": "r",
+    "id": "i",
+    "sender_id": "u",
+    "user_id": "u",
+    "reader_id": "u",
+    "message": "b",
+    "content": "b",
+    "timestamp": "s",
+    "messages": "m",
+    "cursor": "c",
+    "more": "g",
+    "peer": "p",
+    "peer_online": "o",
+    "online": "o",
+    "users": "n",
+    "up_to": "x",
+    "error": "e",
+}
+
+# Incoming short key -> the long key consumers read
+LONG_KEYS = {
+    "t": "type",
+    "r": "room",
+    "b": "message",
+    "c": "cursor",
+    "a": "after",
+    "l": "limit",
+    "p": "peer",
+    "x": "up_to",
+}
+
+
+def epoch(stamp):
+    return int(stamp.timestamp())
+
+
+def format_epoch(value):
+    stamp = timezone.localtime(datetime.fromtimestamp(value, dt_timezone.utc))
+    return stamp.strftime(TIMESTAMP_FORMAT)
+
+
+class JsonEncoding:
+    name = "json"
+    subprotocol = None
+
+    def encode(self, frame):
+        return {"text_data": json.dumps(self.legacy(frame))}
+
+    def legacy(self, frame):
+        """The frame as JSON clients expect it: names, not ids, formatted timestamps."""
+        frame = {
+            key: value
+            for key, value in frame.items()
+            if not key.endswith("_id") and key != "users"
+        }
+        if isinstance(frame.get("timestamp"), int):
+            frame["timestamp"] = format_epoch(frame["timestamp"])
+        if "messages" in frame:
+            frame["messages"] = [self.legacy(message) for message in frame["messages"]]
+        return frame
+
+    def decode(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data if text_data is not None else bytes_data)
+        except (TypeError, ValueError):
+            return None
+        return data if isinstance(data, dict) else None
+
+
+class MsgpackEncoding:
+    name = "msgpack"
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def encode(self, frame):
+        return {"bytes_data": msgpack.packb(self.compact(frame))}
+
+    def compact(self, frame):
+        """Short keys, and ids instead of names wherever the frame has both."""
+        compact = {}
+        for key, value in frame.items():
+            if f"{key}_id" in frame:
+                continue
+            if key == "messages":
+                value = [self.compact(message) for message in value]
+            compact[SHORT_KEYS.get(key, key)] = value
+        return compact
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            return JsonEncoding().decode(text_data)
+        try:
+            data = msgpack.unpackb(bytes_data, strict_map_key=False)
+        except (ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError):
+            return None
+        if not isinstance(data, dict):
+            return None
+        return {LONG_KEYS.get(key, key): value for key, value in data.items()}
+
+
+JSON = JsonEncoding()
+MSGPACK = MsgpackEncoding() if msgpack is not None else None
+ENCODINGS = [encoding for encoding in (JSON, MSGPACK) if encoding is not None]
+
+
+def encode_once(frame):
+    """
+    {encoding name: send() kwargs} for every supported encoding, so a frame
+    broadcast to many sockets is encoded once per format rather than once
+    per recipient.
+    """
+    return {encoding.name: encoding.encode(frame) for encoding in ENCODINGS}
+
+
+def negotiate(subprotocols):
+    """Pick the encoding for a socket from the subprotocols its client offered."""
+    if MSGPACK is not None and MSGPACK_SUBPROTOCOL in (subprotocols or ()):
+        return MSGPACK
+    return JSON
@@ -13,10 +13,10 @@ import django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_project.settings')
 django.setup()
 
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 import chat.routing
+from chat.auth import CachedAuthMiddlewareStack
 
 
 from django.core.asgi import get_asgi_application
@@ -26,7 +26,7 @@ from django.core.asgi import get_asgi_application
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "websocket": CachedAuthMiddlewareStack(
         URLRouter(
             chat.routing.websocket_urlpatterns
         )
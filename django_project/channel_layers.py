@@ -0,0 +1,44 @@
+"""
+CHANNEL_LAYERS built from the environment.
+
+CHANNEL_LAYER selects the backend:
+
+* ``memory`` (default) - channels' InMemoryChannelLayer; single process only.
+* ``redis`` - channels_redis' RedisChannelLayer. CHANNEL_REDIS_URLS is a
+  comma-separated list of Redis-protocol servers; with more than one,
+  channels and groups are sharded across them by consistent hashing.
+* ``redis-pubsub`` - channels_redis' RedisPubSubChannelLayer over the same
+  hosts, trading delivery guarantees for lower latency.
+
+Every worker process must point at the same hosts, in the same order, so
+they agree on which shard owns a group.
+"""
+
+BACKENDS = {
+    "memory": "channels.layers.InMemoryChannelLayer",
+    "redis": "channels_redis.core.RedisChannelLayer",
+    "redis-pubsub": "channels_redis.pubsub.RedisPubSubChannelLayer",
+}
+
+
+def channel_layers_from_env(environ):
+    kind = environ.get("CHANNEL_LAYER", "memory")
+    if kind not in BACKENDS:
+        raise ValueError(
+            f"CHANNEL_LAYER must be one of {sorted(BACKENDS)}, not {kind!r}"
+        )
+
+    if kind == "memory":
+        return {"default": {"BACKEND": BACKENDS[kind]}}
+
+    urls = environ.get("CHANNEL_REDIS_URLS", "redis://127.0.0.1:6379")
+    hosts = [url.strip() for url in urls.split(",") if url.strip()]
+    config = {"hosts": hosts}
+    if kind == "redis":
+        config["capacity"] = int(environ.get("CHANNEL_LAYER_CAPACITY", 100))
+        config["expiry"] = int(environ.get("CHANNEL_LAYER_EXPIRY", 60))
+        config["group_expiry"] = int(environ.get("CHANNEL_LAYER_GROUP_EXPIRY", 86400))
+    prefix = environ.get("CHANNEL_LAYER_PREFIX")
+    if prefix:
+        config["prefix"] = prefix
+    return {"default": {"BACKEND": BACKENDS[kind], "CONFIG": config}}
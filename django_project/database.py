@@ -0,0 +1,64 @@
+"""
+DATABASES built from the environment.
+
+DATABASE_URL is parsed by dj-database-url. How connections are kept:
+
+* DB_CONN_MAX_AGE - seconds a connection stays open for reuse by later
+  requests and consumer queries on the same thread; 0 (the default)
+  closes it after each, "none" never does. Django runs every ASGI HTTP
+  request on a thread of its own, so on PostgreSQL prefer the pool.
+* DB_CONN_HEALTH_CHECKS - check a reused connection still works before
+  handing it out; on by default whenever connections are kept.
+* DB_POOL - "1" for Django's native connection pool on PostgreSQL. It
+  needs Django 5.1 or later and psycopg 3 with its pool extra
+  (``psycopg[pool]``), not psycopg2.
+  DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE and DB_POOL_TIMEOUT (seconds to wait
+  for a free connection) size it. A pool replaces persistent connections,
+  so CONN_MAX_AGE is 0 with it.
+
+SQLite transactions are BEGIN IMMEDIATE so concurrent writers wait for
+each other rather than erroring. Django only takes that option from 5.1;
+before it, keep CHAT_DB_THREADS at 0 on SQLite.
+"""
+import dj_database_url
+import django
+
+
+def flag(environ, name, default):
+    value = environ.get(name)
+    if value is None or value == "":
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def databases_from_env(environ):
+    url = environ.get("DATABASE_URL")
+    if not url:
+        return {"default": {}}
+
+    max_age = environ.get("DB_CONN_MAX_AGE", "0")
+    max_age = None if max_age.lower() == "none" else int(max_age)
+    config = dj_database_url.parse(
+        url,
+        conn_max_age=max_age,
+        conn_health_checks=flag(environ, "DB_CONN_HEALTH_CHECKS", max_age != 0),
+    )
+
+    if config["ENGINE"] == "django.db.backends.sqlite3" and django.VERSION >= (5, 1):
+        # Writers take the lock when their transaction begins, so with several
+        # threads they queue on the busy timeout instead of failing with
+        # "database is locked" when a read tries to upgrade to a write
+        config.setdefault("OPTIONS", {}).setdefault("transaction_mode", "IMMEDIATE")
+
+    if flag(environ, "DB_POOL", False):
+        if config["ENGINE"] != "django.db.backends.postgresql":
+            raise ValueError(f"DB_POOL needs PostgreSQL, not {config['ENGINE']}")
+        if django.VERSION < (5, 1):
+            raise ValueError(f"DB_POOL needs Django 5.1+, not {django.get_version()}")
+        config["CONN_MAX_AGE"] = 0
+        config.setdefault("OPTIONS", {})["pool"] = {
+            "min_size": int(environ.get("DB_POOL_MIN_SIZE", 2)),
+            "max_size": int(environ.get("DB_POOL_MAX_SIZE", 10)),
+            "timeout": float(environ.get("DB_POOL_TIMEOUT", 10)),
+        }
+    return {"default": config}
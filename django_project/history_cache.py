@@ -0,0 +1,24 @@
+"""
+CHAT_HISTORY_CACHE_BACKEND and CHAT_HISTORY_CACHE_SIZE defaults from the environment.
+
+A "local" history cache only sees the messages its own process saved, so
+with several workers a first page opened on one of them can leave out
+messages saved on another until the room expires. Unless set explicitly:
+
+* with CACHE_URL the backend is "cache", shared by every worker;
+* without it, but with a channel layer other than "memory" (so several
+  workers), the cache is off;
+* otherwise it is "local", holding 100 messages per room.
+"""
+
+
+def history_cache_from_env(environ):
+    """(backend, size) for the history cache."""
+    backend = environ.get("CHAT_HISTORY_CACHE_BACKEND")
+    if not backend:
+        backend = "cache" if environ.get("CACHE_URL") else "local"
+    size = environ.get("CHAT_HISTORY_CACHE_SIZE")
+    if not size:
+        several_workers = environ.get("CHANNEL_LAYER", "memory") != "memory"
+        size = 0 if backend == "local" and several_workers else 100
+    return backend, int(size)
@@ -0,0 +1,52 @@
+"""
+CACHES and SESSION_ENGINE built from the environment.
+
+CACHE_URL picks the default cache:
+
+* unset - Django's per-process LocMemCache.
+* ``redis://host:port/db`` - Django's RedisCache, shared by every worker.
+
+SESSION_BACKEND picks where sessions live:
+
+* ``db`` - the django_session table; one SELECT per request that has a
+  session cookie. The default without CACHE_URL.
+* ``cached_db`` - the same rows with the cache in front: reads come from
+  the cache and fall back to the table, writes go to both. The default
+  with CACHE_URL. With the per-process cache and several workers, a
+  logout only clears the worker that served it, so only pick it without
+  CACHE_URL for a single process.
+* ``cache`` - the cache only; sessions vanish if it evicts or restarts.
+* ``signed_cookies`` - no server-side storage at all; a session can't be
+  revoked before it expires, so logout only works for that browser.
+"""
+
+ENGINES = {
+    "db": "django.contrib.sessions.backends.db",
+    "cached_db": "django.contrib.sessions.backends.cached_db",
+    "cache": "django.contrib.sessions.backends.cache",
+    "signed_cookies": "django.contrib.sessions.backends.signed_cookies",
+}
+
+
+def caches_from_env(environ):
+    url = environ.get("CACHE_URL")
+    if not url:
+        return {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    if not url.startswith(("redis://", "rediss://")):
+        raise ValueError(f"CACHE_URL must be a redis:// URL, not {url!r}")
+    return {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": url,
+        }
+    }
+
+
+def session_engine_from_env(environ):
+    default = "cached_db" if environ.get("CACHE_URL") else "db"
+    kind = environ.get("SESSION_BACKEND") or default
+    if kind not in ENGINES:
+        raise ValueError(
+            f"SESSION_BACKEND must be one of {sorted(ENGINES)}, not {kind!r}"
+        )
+    return ENGINES[kind]
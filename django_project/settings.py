@@ -12,7 +12,11 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 
 import os
 from pathlib import Path
-import dj_database_url
+
+from django_project.channel_layers import channel_layers_from_env
+from django_project.database import databases_from_env
+from django_project.history_cache import history_cache_from_env
+from django_project.sessions import caches_from_env, session_engine_from_env
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -110,15 +114,16 @@ TEMPLATES = [
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    # 'default': {
-    #     'ENGINE': 'django.db.backends.sqlite3',
-    #     'NAME': BASE_DIR / 'db.sqlite3',
-    # }
-    "default": dj_database_url.config(
-        default=os.environ.get("DATABASE_URL")
-    )
-}
+# DATABASE_URL, plus DB_CONN_MAX_AGE / DB_CONN_HEALTH_CHECKS for persistent
+# connections or DB_POOL=1 for psycopg 3's pool on PostgreSQL; see
+# django_project/database.py.
+DATABASES = databases_from_env(os.environ)
+
+# CACHE_URL=redis://... for a cache shared by every worker (default: per
+# process); SESSION_BACKEND=db|cached_db|cache|signed_cookies. See
+# django_project/sessions.py.
+CACHES = caches_from_env(os.environ)
+SESSION_ENGINE = session_engine_from_env(os.environ)
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -167,14 +172,101 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 ASGI_APPLICATION = 'django_project.asgi.application'
 
-CHANNEL_LAYERS = {
-    # 'default': {
-    #     'BACKEND': 'channels_redis.core.RedisChannelLayer',
-    #     'CONFIG': {
-    #         "hosts": [('127.0.0.1', 6379)],
-
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
-        
-    }
-}
+# CHANNEL_LAYER=memory|redis|redis-pubsub; see django_project/channel_layers.py.
+# Anything but memory is required to run more than one ASGI worker.
+CHANNEL_LAYERS = channel_layers_from_env(os.environ)
+
+# Chat history is replayed in keyset-paginated pages; clients ask for
+# older pages over the socket with the cursor they were handed.
+CHAT_HISTORY_PAGE_SIZE = int(os.environ.get("CHAT_HISTORY_PAGE_SIZE", 50))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.environ.get("CHAT_HISTORY_MAX_PAGE_SIZE", 200))
+
+# "sync" writes each chat message before broadcasting it; "batched" broadcasts
+# first and persists through an in-process write-behind queue with bulk_create.
+CHAT_MESSAGE_DURABILITY = os.environ.get("CHAT_MESSAGE_DURABILITY", "sync")
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("CHAT_WRITE_BEHIND_BATCH_SIZE", 100))
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = float(
+    os.environ.get("CHAT_WRITE_BEHIND_FLUSH_INTERVAL", 0.25)
+)
+
+# Recent chats are served from per-user Conversation summaries, keyset-paginated.
+CHAT_RECENT_CHATS_PAGE_SIZE = int(os.environ.get("CHAT_RECENT_CHATS_PAGE_SIZE", 50))
+
+# Page size for the username-prefix user directory.
+CHAT_DIRECTORY_PAGE_SIZE = int(os.environ.get("CHAT_DIRECTORY_PAGE_SIZE", 50))
+
+# Page size for message search results.
+CHAT_SEARCH_PAGE_SIZE = int(os.environ.get("CHAT_SEARCH_PAGE_SIZE", 20))
+
+# Presence: sockets silent for CHAT_PRESENCE_TTL seconds are dropped; changes
+# are coalesced for CHAT_PRESENCE_COALESCE seconds and sent only to the
+# owners of a user's CHAT_PRESENCE_FANOUT_LIMIT most recent conversations.
+CHAT_PRESENCE_TTL = int(os.environ.get("CHAT_PRESENCE_TTL", 60))
+CHAT_PRESENCE_SWEEP_INTERVAL = int(os.environ.get("CHAT_PRESENCE_SWEEP_INTERVAL", 15))
+CHAT_PRESENCE_COALESCE = float(os.environ.get("CHAT_PRESENCE_COALESCE", 1.0))
+CHAT_PRESENCE_FANOUT_LIMIT = int(os.environ.get("CHAT_PRESENCE_FANOUT_LIMIT", 500))
+
+# Most conversations one multiplexed ws/chat/ socket may have open at once.
+CHAT_MAX_SUBSCRIPTIONS = int(os.environ.get("CHAT_MAX_SUBSCRIPTIONS", 100))
+
+# Group rooms: member sets are cached for CHAT_GROUP_MEMBERS_CACHE_TTL seconds
+# (use a cache shared between workers so join/leave invalidation reaches all
+# of them); messages to a room are broadcast in batches of up to
+# CHAT_GROUP_BATCH_SIZE collected over CHAT_GROUP_BATCH_WINDOW seconds.
+CHAT_GROUP_MEMBERS_CACHE_TTL = int(os.environ.get("CHAT_GROUP_MEMBERS_CACHE_TTL", 60))
+CHAT_GROUP_BATCH_SIZE = int(os.environ.get("CHAT_GROUP_BATCH_SIZE", 50))
+CHAT_GROUP_BATCH_WINDOW = float(os.environ.get("CHAT_GROUP_BATCH_WINDOW", 0.01))
+
+# Token-bucket limits on incoming websocket frames (rate = frames/second, 0 =
+# off), per connection and per user. "reject" drops over-limit frames with a
+# retry_after; "delay" holds them up to CHAT_RATE_LIMIT_MAX_DELAY seconds.
+# CHAT_RATE_LIMIT_BACKEND = "cache" counts per-user frames in the shared cache.
+# History, resume, read and (un)subscribe frames use their own per-connection
+# CHAT_RATE_LIMIT_CONTROL_RATE / _BURST bucket instead.
+CHAT_RATE_LIMIT_RATE = float(os.environ.get("CHAT_RATE_LIMIT_RATE", 5))
+CHAT_RATE_LIMIT_BURST = int(os.environ.get("CHAT_RATE_LIMIT_BURST", 10))
+CHAT_RATE_LIMIT_USER_RATE = float(os.environ.get("CHAT_RATE_LIMIT_USER_RATE", 10))
+CHAT_RATE_LIMIT_USER_BURST = int(os.environ.get("CHAT_RATE_LIMIT_USER_BURST", 20))
+CHAT_RATE_LIMIT_MODE = os.environ.get("CHAT_RATE_LIMIT_MODE", "reject")
+CHAT_RATE_LIMIT_MAX_DELAY = float(os.environ.get("CHAT_RATE_LIMIT_MAX_DELAY", 1.0))
+CHAT_RATE_LIMIT_BACKEND = os.environ.get("CHAT_RATE_LIMIT_BACKEND", "local")
+CHAT_RATE_LIMIT_CONTROL_RATE = float(os.environ.get("CHAT_RATE_LIMIT_CONTROL_RATE", 20))
+CHAT_RATE_LIMIT_CONTROL_BURST = int(
+    os.environ.get("CHAT_RATE_LIMIT_CONTROL_BURST", 100)
+)
+
+# Frames waiting to be written to one socket are capped at
+# CHAT_OUTBOUND_QUEUE_LIMIT. When a slow client's queue is full,
+# "drop_oldest" discards its oldest frame, "coalesce" folds queued chat
+# messages into one "resync" frame, and "disconnect" closes it with code 4008.
+CHAT_OUTBOUND_QUEUE_LIMIT = int(os.environ.get("CHAT_OUTBOUND_QUEUE_LIMIT", 100))
+CHAT_OUTBOUND_QUEUE_POLICY = os.environ.get("CHAT_OUTBOUND_QUEUE_POLICY", "coalesce")
+
+# The newest CHAT_HISTORY_CACHE_SIZE messages of up to CHAT_HISTORY_CACHE_ROOMS
+# recently opened rooms are kept for CHAT_HISTORY_CACHE_TTL seconds and serve
+# the first history page (0 = off). "local" keeps them per process; "cache"
+# shares them through the Django cache and drops a room on each new message.
+# Defaults follow CACHE_URL and CHANNEL_LAYER; see django_project/history_cache.py.
+CHAT_HISTORY_CACHE_BACKEND, CHAT_HISTORY_CACHE_SIZE = history_cache_from_env(os.environ)
+CHAT_HISTORY_CACHE_ROOMS = int(os.environ.get("CHAT_HISTORY_CACHE_ROOMS", 1000))
+CHAT_HISTORY_CACHE_TTL = int(os.environ.get("CHAT_HISTORY_CACHE_TTL", 60))
+
+# Rows fetched per round trip when streaming a room's whole history
+# (GET /rooms/<id>/history/).
+CHAT_HISTORY_EXPORT_CHUNK_SIZE = int(
+    os.environ.get("CHAT_HISTORY_EXPORT_CHUNK_SIZE", 2000)
+)
+
+# Websocket handshakes resolve session -> user through a per-process cache of
+# up to CHAT_AUTH_CACHE_SIZE sessions (0 = off), each kept for
+# CHAT_AUTH_CACHE_TTL seconds and dropped on logout or when the user is saved.
+CHAT_AUTH_CACHE_SIZE = int(os.environ.get("CHAT_AUTH_CACHE_SIZE", 10000))
+CHAT_AUTH_CACHE_TTL = int(os.environ.get("CHAT_AUTH_CACHE_TTL", 60))
+
+# Chat DB calls run on CHAT_DB_THREADS dedicated threads, one connection
+# each; match it to DB_POOL_MAX_SIZE. 0 keeps channels' single shared thread.
+CHAT_DB_THREADS = int(os.environ.get("CHAT_DB_THREADS", 0))
+
+# "async" serves ws/private/ with the consumer that queries through Django's
+# async ORM instead of database_sync_to_async. Read once, at startup.
+CHAT_CONSUMER_ORM = os.environ.get("CHAT_CONSUMER_ORM", "sync")